@@ -3,16 +3,4550 @@ from tkinter import messagebox, ttk, scrolledtext, filedialog
 import requests
 import json
 import os
-from PIL import Image, ImageTk
+from PIL import Image, ImageOps, ImageTk
 import webbrowser
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import time
 import threading
-import urllib.request
 import tempfile
 import configparser
 import sqlite3
+import csv
+import re
+import argparse
+import asyncio
+import heapq
+import random
+import itertools
+import queue
+import zlib
+import hashlib
+import base64
+import struct
+import io
+import shutil
+import ipaddress
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
 from functools import partial
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, parse_qs
+from pathlib import Path
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+
+DASHSCOPE_BASE_URL = "https://dashscope.aliyuncs.com"
+KF2V_API_URL = DASHSCOPE_BASE_URL + "/api/v1/services/aigc/image2video/video-synthesis"
+VIDEO_SYNTHESIS_API_URL = DASHSCOPE_BASE_URL + "/api/v1/services/aigc/video-generation/video-synthesis"
+TASK_STATUS_URL = DASHSCOPE_BASE_URL + "/api/v1/tasks/{task_id}"
+
+# 配置文件和数据库的默认路径
+CONFIG_FILE = os.path.join(os.path.expanduser("~"), ".aliyun_video_generator_config.ini")
+DB_FILE = os.path.join(os.path.expanduser("~"), ".aliyun_video_generator_history.db")
+DOWNLOAD_DIR = os.path.join(os.path.expanduser("~"), "Videos", "aliyun_video_generator")
+THUMBNAIL_DIR = os.path.join(os.path.expanduser("~"), ".aliyun_video_generator_thumbnails")
+UPLOAD_DIR = os.path.join(os.path.expanduser("~"), ".aliyun_video_generator_uploads")
+NORMALIZED_DIR = os.path.join(os.path.expanduser("~"), ".aliyun_video_generator_normalized")
+
+# 生成的视频URL有效期（DashScope只保留24小时）
+VIDEO_URL_TTL = 24 * 3600
+
+# 任务终态（到达后不再轮询）
+TERMINAL_STATUSES = ("SUCCEEDED", "FAILED", "CANCELED", "UNKNOWN")
+
+# DashScope响应中 submit_time / scheduled_time / end_time 使用北京时间
+DASHSCOPE_TIMEZONE = timezone(timedelta(hours=8))
+
+# 任务状态在界面和历史记录中的显示名称
+STATUS_LABELS = {
+    "SUCCEEDED": "成功",
+    "FAILED": "失败",
+    "RUNNING": "处理中"
+}
+
+
+class HttpClient:
+    """共享的HTTP会话：连接池、keep-alive、超时和gzip
+
+    所有DashScope请求和图片下载都通过同一个会话，
+    避免每次调用都重新建立TCP+TLS连接。
+    """
+
+    def __init__(self, pool_connections=8, pool_maxsize=32, connect_timeout=5, read_timeout=30):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.headers.update({
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive"
+        })
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def connection_stats(self):
+        """返回请求数、新建连接数和连接复用率"""
+        requests_sent = 0
+        new_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_sent += pool.num_requests
+            new_connections += pool.num_connections
+
+        reuse_rate = 1 - new_connections / requests_sent if requests_sent else 0.0
+        return {"requests": requests_sent, "connections": new_connections, "reuse_rate": reuse_rate}
+
+    def close(self):
+        self.session.close()
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def http_client():
+    """获取全局共享的HTTP客户端"""
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient()
+        return _http_client
+
+
+def configure_http_client(**kwargs):
+    """按给定的连接池大小和超时重新创建全局HTTP客户端"""
+    global _http_client
+    with _http_client_lock:
+        if _http_client is not None:
+            _http_client.close()
+        _http_client = HttpClient(**kwargs)
+        return _http_client
+
+
+def format_connection_stats(stats):
+    return (f"HTTP请求 {stats['requests']} 次，新建连接 {stats['connections']} 个，"
+            f"连接复用率 {stats['reuse_rate']:.1%}")
+
+
+class TokenBucket:
+    """线程安全的令牌桶（按GCRA虚拟调度实现）：平均每秒 rate 个请求，最多连续 burst 个
+
+    reserve() 立即预订一个令牌并返回需要等待的秒数，等待不占用锁：
+    线程中用 time.sleep，协程中用 asyncio.sleep。预订按调用顺序排队，等待时间依次递增。
+    pause(seconds) 用于服务端限流（429/Retry-After）：暂停结束前不发放令牌，结束后也不会立即突发。
+    """
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(1, burst) - 1) * self.interval
+        self._tat = 0.0  # 理论上下一个请求的到达时间
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            tat = max(self._tat, now)
+            self._tat = tat + self.interval
+            return max(0.0, tat - self.tolerance - now, self._paused_until - now)
+
+    def pause(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tat = max(self._tat, self._paused_until + self.tolerance)
+
+
+class CircuitOpenError(Exception):
+    """接口连续失败、熔断器断开期间发出的请求直接失败，retry_in 秒后可以再试"""
+
+    def __init__(self, retry_in):
+        super().__init__(f"接口暂时不可用（连续失败），{retry_in:.0f}秒后重试")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """熔断器：连续 failure_threshold 次网络错误或5xx后断开 reset_timeout 秒
+
+    断开期间 before_call() 抛出 CircuitOpenError，不再向出错的接口发请求；
+    到时间后只放行一个试探请求，成功则恢复，失败则再次断开，断开时间加倍（最长 max_timeout 秒）。
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=10, max_timeout=300):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.state = "closed"  # closed -> open -> half_open -> closed/open
+        self._failures = 0
+        self._timeout = reset_timeout
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            retry_in = self._opened_at + self._timeout - time.monotonic()
+            if self.state == "open" and retry_in <= 0:
+                self.state = "half_open"  # 放行这一个试探请求
+                return
+            raise CircuitOpenError(max(retry_in, 1.0))
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._failures = 0
+            self._timeout = self.reset_timeout
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open":
+                self._timeout = min(self._timeout * 2, self.max_timeout)
+            elif self._failures < self.failure_threshold:
+                return
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+class ApiLimiter:
+    """单个API Key调用单个接口的限制和容错：令牌桶限速、同时进行中的请求数上限、熔断器和结果计数"""
+
+    # 计数项：成功、重试、被限流、额度不足、服务端错误、网络错误、不可重试的拒绝、熔断时直接失败
+    OUTCOMES = ("ok", "retried", "throttled", "quota", "server_error", "network_error", "rejected", "circuit_open")
+
+    def __init__(self, rate, burst=1, max_concurrent=None, breaker=None):
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self.stats = dict.fromkeys(self.OUTCOMES, 0)
+        self._stats_lock = threading.Lock()
+
+    def reserve(self):
+        return self.bucket.reserve()
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+    def count(self, outcome):
+        with self._stats_lock:
+            self.stats[outcome] += 1
+
+    @contextmanager
+    def slot(self):
+        if self._slots is None:
+            yield
+            return
+        with self._slots:
+            yield
+
+
+# 默认限制（百炼控制台中各模型的QPS和并发限制不同，可在配置文件[RateLimit]中调整）
+RATE_LIMIT_DEFAULTS = {
+    "create_qps": 2.0,
+    "create_burst": 2,
+    "create_concurrency": 2,
+    "query_qps": 20.0,
+    "query_burst": 20,
+    "query_concurrency": 10,
+    "max_tasks": 0
+}
+
+# 同一请求最多尝试的次数（网络错误、5xx和限流会重试）
+RETRY_ATTEMPTS = 4
+
+# 不可重试的错误码：内容审核、侵权和参数错误，重试只会得到同样的结果
+NON_RETRYABLE_CODES = ("DataInspectionFailed", "IPInfringementSuspect", "InvalidParameter", "InvalidApiKey",
+                       "AccessDenied")
+
+# 额度类错误：账户欠费或分配的额度用完，短时间内重试同一个Key不会成功（Key池会换用其他Key）
+QUOTA_ERROR_CODES = ("Arrearage", "Throttling.AllocationQuota", "AllocationQuota")
+
+_rate_limit_settings = dict(RATE_LIMIT_DEFAULTS)
+_key_rate_settings = {}  # API Key -> 覆盖全局设置的限速项（Key池中各Key单独的配额）
+_api_limiters = {}
+_api_limiters_lock = threading.Lock()
+
+
+def configure_rate_limits(**settings):
+    """更新限速设置（见 RATE_LIMIT_DEFAULTS），之后新建的限速器使用新设置"""
+    with _api_limiters_lock:
+        _rate_limit_settings.update(settings)
+        _api_limiters.clear()
+
+
+def configure_key_rate_limits(api_key, **settings):
+    """为单个API Key设置不同于全局的限速项（如 create_qps），其余项沿用全局设置"""
+    with _api_limiters_lock:
+        _key_rate_settings[api_key] = settings
+        for key in [key for key in _api_limiters if key[0] == api_key]:
+            del _api_limiters[key]
+
+
+def api_limiter(api_key, endpoint, kind):
+    """返回 (API Key, 接口URL) 对应的限速器，kind 为 "create" 或 "query"，决定使用哪一组预算"""
+    key = (api_key, endpoint)
+    with _api_limiters_lock:
+        limiter = _api_limiters.get(key)
+        if limiter is None:
+            settings = dict(_rate_limit_settings, **_key_rate_settings.get(api_key, {}))
+            limiter = ApiLimiter(settings[f"{kind}_qps"], settings[f"{kind}_burst"], settings[f"{kind}_concurrency"])
+            _api_limiters[key] = limiter
+        return limiter
+
+
+def retry_after_seconds(response, default=1.0):
+    """读取 Retry-After 响应头（秒数或HTTP日期），没有时返回 default"""
+    value = (response.headers or {}).get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return default
+
+
+def _error_code(response):
+    try:
+        code = response.json().get("code", "")
+    except (ValueError, AttributeError):
+        return ""
+    return code if isinstance(code, str) else ""
+
+
+def classify_response(response):
+    """把响应分为 ok、quota（欠费或额度用完）、throttled（429/Throttling）、server_error（5xx）
+    和 rejected（其他错误，不重试）"""
+    if response.status_code < 400:
+        return "ok"
+    code = _error_code(response)
+    if code.startswith(QUOTA_ERROR_CODES):
+        return "quota"
+    if code.startswith(NON_RETRYABLE_CODES):
+        return "rejected"
+    if response.status_code == 429 or code.startswith("Throttling"):
+        return "throttled"
+    if response.status_code >= 500:
+        return "server_error"
+    return "rejected"
+
+
+def is_retryable_error(error, idempotent=True):
+    """网络错误是否可以重试
+
+    创建任务不是幂等的：请求发出后连接中断或读取超时，服务端可能已经创建了任务，
+    因此只有连接没有建立（连接超时）时才重试。
+    """
+    if not isinstance(error, requests.RequestException):
+        return False
+    return idempotent or isinstance(error, requests.ConnectTimeout)
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """第 attempt 次重试前的等待时间：指数退避，一半固定一半随机抖动，避免多个请求同时重试"""
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def resilient_call(limiter, send, reserved=False, idempotent=True, attempts=None):
+    """按限速器发送请求 send()，按错误类型重试，返回最后一次响应
+
+    每次尝试前检查熔断器（断开时抛出 CircuitOpenError），然后等待令牌和并发名额。
+    被限流时按 Retry-After 暂停整个接口；5xx和可重试的网络错误按 backoff_delay 等待后重试，
+    并计入熔断器；额度不足和其他错误（如内容审核失败）直接返回。重试用完后返回最后的响应或抛出最后的异常。
+    reserved 为True时调用方已经预订并等待过第一个令牌（协程中用asyncio.sleep等待）。
+    """
+    attempts = attempts or RETRY_ATTEMPTS
+    for attempt in range(attempts):
+        try:
+            limiter.breaker.before_call()
+        except CircuitOpenError:
+            limiter.count("circuit_open")
+            raise
+
+        last = attempt == attempts - 1
+        try:
+            with limiter.slot():
+                if not reserved:
+                    time.sleep(limiter.reserve())
+                reserved = False
+                response = send()
+        except Exception as e:
+            limiter.count("network_error")
+            limiter.breaker.record_failure()
+            if last or not is_retryable_error(e, idempotent):
+                raise
+            limiter.count("retried")
+            time.sleep(backoff_delay(attempt))
+            continue
+
+        outcome = classify_response(response)
+        limiter.count(outcome)
+        if outcome == "server_error":
+            limiter.breaker.record_failure()
+        else:
+            limiter.breaker.record_success()
+        if last or outcome in ("ok", "quota", "rejected"):
+            return response
+
+        limiter.count("retried")
+        if outcome == "throttled":
+            limiter.pause(retry_after_seconds(response, default=backoff_delay(attempt, base=1.0)))
+        else:
+            time.sleep(backoff_delay(attempt))
+
+
+def format_api_stats(limiters=None):
+    """汇总各接口的调用结果计数，用于调试菜单和批量模式的输出"""
+    labels = {"ok": "成功", "retried": "重试", "throttled": "被限流", "quota": "额度不足", "server_error": "服务端错误",
+              "network_error": "网络错误", "rejected": "被拒绝", "circuit_open": "熔断"}
+    lines = []
+    with _api_limiters_lock:
+        items = list((limiters if limiters is not None else _api_limiters).items())
+    for (api_key, endpoint), limiter in items:
+        name = "查询任务" if endpoint == TASK_STATUS_URL else "创建任务 " + urlsplit(endpoint).path.rsplit("/", 2)[-2]
+        counts = "，".join(f"{labels[k]} {v}" for k, v in limiter.stats.items() if v)
+        lines.append(f"{name}（Key ...{api_key[-4:]}，熔断器 {limiter.breaker.state}）: {counts or '无调用'}")
+    return "\n".join(lines) or "还没有调用过接口"
+
+
+class NoAvailableKeyError(Exception):
+    """Key池中所有API Key都已达到任务上限或暂停使用"""
+
+
+class PooledKey:
+    """Key池中的一个API Key：名称、同时处理的任务上限、进行中的任务数和暂停截止时间"""
+
+    def __init__(self, name, api_key, max_tasks=0):
+        self.name = name
+        self.api_key = api_key
+        self.max_tasks = max_tasks  # 0为不限
+        self.in_flight = 0
+        self.assigned = 0  # 最近一次分配的序号，负载相同时轮流分配
+        self.suspended_until = 0.0
+        self.suspend_reason = ""
+
+    @property
+    def load(self):
+        # 未设置上限的Key按100个任务的容量计算，与设置了上限的Key按比例比较
+        return self.in_flight / (self.max_tasks or 100)
+
+    @property
+    def full(self):
+        return bool(self.max_tasks) and self.in_flight >= self.max_tasks
+
+
+class ApiKeyPool:
+    """多个API Key之间的负载均衡（线程安全）
+
+    acquire() 选出负载（进行中的任务数/任务上限）最低的健康Key并占用一个任务名额，
+    创建接口的熔断器断开的Key排在最后；任务结束后调用 release() 归还名额。
+    Key返回额度类错误（见 QUOTA_ERROR_CODES）时 suspend() 暂停 suspend_seconds 秒，
+    期间不分配新任务，已经提交的任务仍用原Key轮询。
+    任务归属的Key名称保存在历史记录的 api_key_name 列，查询状态时用 key_for_task() 找回原Key。
+    """
+
+    def __init__(self, suspend_seconds=600):
+        self.suspend_seconds = suspend_seconds
+        self.keys = {}  # 名称 -> PooledKey，按加入顺序
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, name, api_key, max_tasks=0, **rates):
+        """加入或更新一个Key；rates 为该Key单独的限速项（如 create_qps），见 configure_key_rate_limits"""
+        with self._lock:
+            key = self.keys.get(name)
+            if key is None:
+                key = self.keys[name] = PooledKey(name, api_key, max_tasks)
+            key.api_key = api_key
+            key.max_tasks = max_tasks
+        if rates:
+            configure_key_rate_limits(api_key, **rates)
+        return key
+
+    def remove(self, name):
+        with self._lock:
+            self.keys.pop(name, None)
+
+    def set_default(self, api_key, max_tasks=0):
+        """设置界面输入或命令行提供的Key（名为 "default"），为空或与池中其他Key相同时移除"""
+        with self._lock:
+            duplicate = any(key.api_key == api_key for name, key in self.keys.items() if name != "default")
+        if api_key and not duplicate:
+            self.add("default", api_key, max_tasks)
+        else:
+            self.remove("default")
+
+    def get(self, name):
+        with self._lock:
+            return self.keys.get(name)
+
+    def __len__(self):
+        with self._lock:
+            return len(self.keys)
+
+    def acquire(self, api_url=None):
+        """为一个新任务分配Key并占用名额，没有可用Key时返回None"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [key for key in self.keys.values() if key.suspended_until <= now and not key.full]
+            if not candidates:
+                return None
+
+            def rank(key):
+                broken = api_url is not None and api_limiter(key.api_key, api_url, "create").breaker.state == "open"
+                return broken, key.load, key.assigned
+
+            key = min(candidates, key=rank)
+            key.in_flight += 1
+            key.assigned = next(self._seq)
+            return key
+
+    def claim(self, name=None):
+        """为已经创建的任务占用原Key的名额（不检查上限），原Key不在池中时使用默认Key"""
+        with self._lock:
+            key = self.keys.get(name) or self._fallback()
+            if key is not None:
+                key.in_flight += 1
+            return key
+
+    def release(self, key):
+        with self._lock:
+            key.in_flight = max(0, key.in_flight - 1)
+
+    def suspend(self, key, reason="", seconds=None):
+        """暂停分配新任务给该Key（暂停前已分配给该Key的并发请求可能随后也返回额度错误，只提示一次）"""
+        seconds = seconds or self.suspend_seconds
+        with self._lock:
+            now = time.monotonic()
+            already = key.suspended_until > now
+            key.suspended_until = max(key.suspended_until, now + seconds)
+            key.suspend_reason = reason
+        if not already:
+            print(f"API Key {key.name} 暂停使用 {seconds:.0f} 秒: {reason}")
+
+    def retry_in(self):
+        """没有可用Key时建议等待的秒数：有Key只是达到任务上限时为1秒（等其他任务结束），
+        所有Key都暂停时为最早恢复的Key的剩余暂停时间"""
+        now = time.monotonic()
+        with self._lock:
+            waits = [key.suspended_until - now for key in self.keys.values()]
+        return max(1.0, min(waits)) if waits else 1.0
+
+    def key_for_task(self, conn, task_id):
+        """返回创建该任务的Key（按历史记录中的 api_key_name），找不到时返回默认Key"""
+        row = conn.execute("SELECT api_key_name FROM history WHERE task_id = ?", (task_id,)).fetchone()
+        return self.key_named(row[0] if row else None)
+
+    def key_named(self, name):
+        """返回名称对应的Key，不在池中时返回默认Key"""
+        with self._lock:
+            return self.keys.get(name) or self._fallback()
+
+    def _fallback(self):
+        # 没有记录Key的任务（如启用Key池之前创建的任务）使用 "default"，没有时使用第一个Key
+        return self.keys.get("default") or next(iter(self.keys.values()), None)
+
+    def describe(self):
+        now = time.monotonic()
+        with self._lock:
+            keys = list(self.keys.values())
+        lines = []
+        for key in keys:
+            limit = key.max_tasks or "不限"
+            line = f"{key.name}（...{key.api_key[-4:]}）: 处理中 {key.in_flight}/{limit}"
+            if key.suspended_until > now:
+                line += f"，暂停中（还剩 {key.suspended_until - now:.0f} 秒: {key.suspend_reason}）"
+            lines.append(line)
+        return "\n".join(lines) or "没有配置API Key"
+
+
+def create_task_with_pool(pool, api_url, request_body):
+    """用Key池中负载最低的健康Key创建任务，返回 (PooledKey, 响应)
+
+    Key返回额度类错误时暂停该Key并换下一个Key重新提交；所有Key都不可用时抛出 NoAvailableKeyError。
+    返回的Key已占用一个任务名额，调用方在任务结束（或创建失败）后调用 pool.release(key)。
+    """
+    while True:
+        key = pool.acquire(api_url)
+        if key is None:
+            raise NoAvailableKeyError("所有API Key都已达到同时处理的任务上限或因额度不足暂停使用，请稍后再试")
+        try:
+            response = create_video_task(key.api_key, api_url, request_body)
+        except Exception:
+            pool.release(key)
+            raise
+        if classify_response(response) != "quota":
+            return key, response
+        pool.suspend(key, describe_create_error(response))
+        pool.release(key)
+
+
+# 内存中保留的预览图（PhotoImage）数量
+PREVIEW_CACHE_SIZE = 32
+
+# 图片URL的限制：最大10MB，宽高360-2000像素
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+IMAGE_MIN_SIDE = 360
+IMAGE_MAX_SIDE = 2000
+
+# JPEG的帧头标记（SOF0-SOF15，不含DHT/JPG/DAC）
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def parse_image_header(data):
+    """从文件开头的字节解析 (格式, 宽, 高)
+
+    支持JPEG、PNG、BMP、WEBP和GIF，只读取文件头，不解码像素。
+    数据还不足以确定尺寸时返回None；无法识别的格式抛出ValueError。
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        if len(data) < 24:
+            return None
+        width, height = struct.unpack(">II", data[16:24])
+        return "PNG", width, height
+
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        if len(data) < 10:
+            return None
+        width, height = struct.unpack("<HH", data[6:10])
+        return "GIF", width, height
+
+    if data[:2] == b"BM":
+        if len(data) < 26:
+            return None
+        if struct.unpack("<I", data[14:18])[0] == 12:
+            width, height = struct.unpack("<HH", data[18:22])
+        else:
+            width, height = struct.unpack("<ii", data[18:26])
+        return "BMP", width, abs(height)
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        if len(data) < 30:
+            return None
+        chunk = data[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", data[26:30])
+            return "WEBP", width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return "WEBP", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return "WEBP", int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+        raise ValueError("无法识别的WEBP格式")
+
+    if data[:2] == b"\xff\xd8":
+        # 逐段跳过，直到帧头（EXIF等段可能较大）
+        pos = 2
+        while pos + 4 <= len(data):
+            if data[pos] != 0xFF:
+                raise ValueError("JPEG文件头损坏")
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                pos += 1
+                continue
+            if marker in _JPEG_SOF_MARKERS:
+                if pos + 9 > len(data):
+                    return None
+                height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+                return "JPEG", width, height
+            pos += 2 + struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        return None
+
+    if len(data) >= 16:
+        raise ValueError("无法识别的图片格式")
+    return None
+
+
+def probe_image_url(url, timeout=10, first_range=16 * 1024, max_header_bytes=256 * 1024, read_size=4096):
+    """只读取图片文件头来检查图片URL，返回图片信息字典
+
+    先用Range请求取文件开头 first_range 字节，边读边解析；文件头更长时（如带大段EXIF的JPEG）
+    再续取后面的部分，最多 max_header_bytes 字节。通常只传输几KB。
+    服务器不支持Range时读到尺寸后立即断开。文件大小取自 Content-Range 或 Content-Length。
+    timeout 为整个检查的时间上限（秒）。
+    返回 {"format", "width", "height", "size", "content_type", "transferred"}。
+    """
+    deadline = time.monotonic() + timeout
+    data = b""
+    header = None
+    size = None
+    content_type = ""
+    end = first_range
+
+    while header is None and len(data) < max_header_bytes:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"检查图片超时（{timeout}秒）")
+
+        headers = {"User-Agent": "Mozilla/5.0", "Range": f"bytes={len(data)}-{end - 1}",
+                   "Accept-Encoding": "identity"}
+        with http_client().get(url, headers=headers, stream=True,
+                               timeout=(min(5, remaining), remaining)) as response:
+            response.raise_for_status()
+
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+            if not content_type.startswith("image/"):
+                raise ValueError(f"URL不是图片链接（内容类型: {content_type}）")
+
+            partial_content = response.status_code == 206
+            if partial_content:
+                _, size = _content_range_total(response.headers.get("Content-Range"))
+            elif not data:
+                length = response.headers.get("Content-Length")
+                size = int(length) if length and length.isdigit() else None
+            else:
+                raise ValueError("服务器不再支持Range请求")
+
+            received = 0
+            for chunk in response.iter_content(read_size):
+                data += chunk
+                received += len(chunk)
+                header = parse_image_header(data)
+                if header or len(data) >= max_header_bytes:
+                    break
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"检查图片超时（{timeout}秒）")
+
+        if not partial_content or not received or (size is not None and len(data) >= size):
+            # 不支持Range（整个响应已读完或已达上限），或已读到文件末尾
+            break
+        end = min(end * 4, max_header_bytes)
+
+    if not header:
+        raise ValueError("无法从文件头读取图片尺寸")
+
+    image_format, width, height = header
+    return {"format": image_format, "width": width, "height": height, "size": size,
+            "content_type": content_type, "transferred": len(data)}
+
+
+def check_image_limits(info):
+    """按API限制检查图片信息，返回警告信息列表"""
+    warnings = []
+    if info["size"] and info["size"] > IMAGE_MAX_BYTES:
+        warnings.append(f"图片大小为{info['size'] / (1024 * 1024):.2f}MB，超过10MB可能会导致API拒绝")
+
+    width, height = info["width"], info["height"]
+    if width < IMAGE_MIN_SIDE or height < IMAGE_MIN_SIDE:
+        warnings.append(f"图片分辨率({width}x{height})小于最小要求({IMAGE_MIN_SIDE}x{IMAGE_MIN_SIDE})")
+    elif width > IMAGE_MAX_SIDE or height > IMAGE_MAX_SIDE:
+        warnings.append(f"图片分辨率({width}x{height})超过最大限制({IMAGE_MAX_SIDE}x{IMAGE_MAX_SIDE})")
+    return warnings
+
+
+class ThumbnailCache:
+    """图片预览缩略图的磁盘缓存
+
+    缩略图按原图内容的SHA-256保存为 <cache_dir>/<哈希>.png，不同URL指向同一张图片时共用；
+    每个URL另有一个小的元数据文件记录 ETag / Last-Modified 和内容哈希，
+    再次预览时发送条件请求，服务器返回304时直接使用磁盘上的缩略图。
+    JPEG用 draft 在解码时按比例缩小，其他格式用 thumbnail（内部先 reduce 再重采样）。
+    方法可在任意线程调用；PhotoImage的内存缓存由界面线程自行维护。
+    """
+
+    def __init__(self, cache_dir=THUMBNAIL_DIR, max_size=200, max_entries=2000, max_bytes=4 * IMAGE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._prune(max_entries)
+
+    def _meta_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _thumb_path(self, sha256):
+        return os.path.join(self.cache_dir, sha256 + ".png")
+
+    def _read_meta(self, url):
+        try:
+            with open(self._meta_path(url), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url or not os.path.exists(self._thumb_path(meta.get("sha256", ""))):
+            return None
+        return meta
+
+    def _open_thumb(self, sha256):
+        img = Image.open(self._thumb_path(sha256))
+        img.load()
+        return img
+
+    def cached(self, url):
+        """只读磁盘缓存（不访问网络），没有时返回None"""
+        meta = self._read_meta(url)
+        if not meta:
+            return None
+        try:
+            return self._open_thumb(meta["sha256"])
+        except OSError:
+            return None
+
+    def get(self, url, timeout=30):
+        """返回URL对应的缩略图（PIL图像），必要时用条件请求重新验证或重新下载"""
+        meta = self._read_meta(url)
+        headers = {"User-Agent": "Mozilla/5.0"}
+        if meta and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        deadline = time.monotonic() + timeout
+        try:
+            with http_client().get(url, headers=headers, stream=True, timeout=(5, timeout)) as response:
+                if response.status_code == 304 and meta:
+                    return self._open_thumb(meta["sha256"])
+                response.raise_for_status()
+
+                data = bytearray()
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    data += chunk
+                    if len(data) > self.max_bytes:
+                        raise ValueError("图片过大，无法预览")
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"下载预览图片超时（{timeout}秒）")
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except requests.RequestException:
+            if meta:
+                # 网络不可用时使用已缓存的缩略图
+                return self._open_thumb(meta["sha256"])
+            raise
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        thumb_path = self._thumb_path(sha256)
+        if os.path.exists(thumb_path):
+            # 内容相同（如换了URL或服务器不支持条件请求），复用已有缩略图
+            img = self._open_thumb(sha256)
+        else:
+            img = self._make_thumbnail(io.BytesIO(data))
+            temp_path = thumb_path + ".tmp"
+            img.save(temp_path, "PNG")
+            os.replace(temp_path, thumb_path)
+
+        meta_path = self._meta_path(url)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified, "sha256": sha256}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+        return img
+
+    def _make_thumbnail(self, fp):
+        img = Image.open(fp)
+        # JPEG在解码时直接按1/2、1/4、1/8缩小，避免解码整张大图
+        img.draft("RGB", (self.max_size, self.max_size))
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        img.thumbnail((self.max_size, self.max_size), Image.LANCZOS)
+        return img
+
+    def _prune(self, max_entries):
+        """缓存文件超过 max_entries 个时按修改时间删除最旧的一半（启动时执行一次）"""
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file()]
+        except OSError:
+            return
+        if len(entries) <= max_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - max_entries // 2]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def build_video_request(model, prompt, first_frame_url="", last_frame_url="", img_url="",
+                        resolution="720P", prompt_extend=True, seed=None, size="1280*720"):
+    """根据模型构建创建任务的接口URL和请求体"""
+    if model == "wanx2.1-kf2v-plus":  # 首尾帧模式
+        api_url = KF2V_API_URL
+
+        input_data = {
+            "prompt": prompt,
+            "first_frame_url": first_frame_url,
+            "last_frame_url": last_frame_url
+        }
+
+        parameters = {
+            "resolution": resolution,
+            "prompt_extend": prompt_extend
+        }
+
+        # Add seed if provided
+        if seed not in (None, ""):
+            parameters["seed"] = int(seed)
+
+    elif model == "wanx2.1-t2v-turbo":  # 文本生成模式
+        api_url = VIDEO_SYNTHESIS_API_URL
+
+        input_data = {
+            "prompt": prompt
+        }
+
+        parameters = {
+            "size": size
+        }
+
+    elif model == "wanx2.1-i2v-turbo":  # 单图生成模式
+        api_url = VIDEO_SYNTHESIS_API_URL
+
+        input_data = {
+            "prompt": prompt,
+            "img_url": img_url
+        }
+
+        parameters = {
+            "resolution": resolution,
+            "prompt_extend": prompt_extend
+        }
+
+    else:
+        raise ValueError(f"不支持的模型: {model}")
+
+    request_body = {
+        "model": model,
+        "input": input_data,
+        "parameters": parameters
+    }
+
+    return api_url, request_body
+
+
+def request_fingerprint(request_body):
+    """请求的规范指纹：model、input、parameters按键排序后的紧凑JSON的SHA-256（十六进制）
+
+    input中的文本去掉首尾空白；未指定seed的请求指纹中没有seed，与指定了seed的请求不同。
+    """
+    input_data = {key: value.strip() if isinstance(value, str) else value
+                  for key, value in (request_body.get("input") or {}).items()}
+    canonical = {
+        "model": request_body.get("model", ""),
+        "input": input_data,
+        "parameters": request_body.get("parameters") or {}
+    }
+    text = json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def request_fingerprint_text(text):
+    """从请求JSON文本计算指纹（注册为SQL函数，用于导入），不是JSON对象时返回None"""
+    try:
+        request = json.loads(unpack_json(text))
+    except (TypeError, ValueError):
+        return None
+    return request_fingerprint(request) if isinstance(request, dict) else None
+
+
+def create_video_task(api_key, api_url, request_body, reserved=False):
+    """提交异步视频生成任务，返回HTTP响应（按该API Key的创建任务预算限速，见 resilient_call）"""
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+        "X-DashScope-Async": "enable"
+    }
+    send = partial(http_client().post, api_url, json=request_body, headers=headers)
+    return resilient_call(api_limiter(api_key, api_url, "create"), send, reserved, idempotent=False)
+
+
+def query_task(api_key, task_id, reserved=False):
+    """查询任务状态，返回HTTP响应（按该API Key的查询预算限速，见 resilient_call）"""
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    send = partial(http_client().get, TASK_STATUS_URL.format(task_id=task_id), headers=headers)
+    return resilient_call(api_limiter(api_key, TASK_STATUS_URL, "query"), send, reserved)
+
+
+def describe_create_error(response):
+    """把创建任务失败的响应转换为友好的错误提示"""
+    try:
+        error_json = response.json()
+    except ValueError:
+        return f"HTTP {response.status_code}"
+
+    error_code = error_json.get("code", "")
+    error_message = error_json.get("message", "")
+
+    if error_code == "InvalidParameter.DataInspection":
+        return "无法下载图片资源，请确保URL可直接访问。不要使用Google Drive等需要授权的链接。"
+    elif error_code == "IPInfringementSuspect":
+        return "输入数据（提示词或图像）涉嫌知识产权侵权，请修改内容。"
+    elif error_code == "DataInspectionFailed":
+        return "输入数据（提示词或图像）可能包含敏感内容，请修改内容。"
+    return f"{error_code}: {error_message}"
+
+
+def parse_task_response(response_data):
+    """解析任务查询结果，返回(任务状态, 视频URL, 错误信息)"""
+    output = response_data.get("output", {})
+    task_status = output.get("task_status", "")
+    video_url = output.get("video_url", "")
+
+    error_info = ""
+    if task_status == "FAILED":
+        # 错误码可能出现在顶层或output中
+        error_code = response_data.get("code", "") or output.get("code", "")
+        error_message = response_data.get("message", "") or output.get("message", "")
+        if error_code and error_message:
+            error_info = f"{error_code}: {error_message}"
+        else:
+            error_info = "未知错误"
+
+    return task_status, video_url, error_info
+
+
+def request_resolution(request_body):
+    """取请求中的分辨率参数（t2v为size），用于按分辨率统计耗时"""
+    parameters = (request_body or {}).get("parameters", {})
+    return parameters.get("resolution") or parameters.get("size") or ""
+
+
+def _parse_api_time(value):
+    """解析DashScope返回的时间字符串，如 2025-03-29 00:43:40.123"""
+    for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def api_timestamp(value):
+    """把DashScope返回的时间字符串转为epoch秒（浮点），无法解析时返回None"""
+    parsed = _parse_api_time(value)
+    if parsed is None:
+        return None
+    return parsed.replace(tzinfo=DASHSCOPE_TIMEZONE).timestamp()
+
+
+def pack_json(data):
+    """把响应序列化为紧凑JSON并用zlib压缩（保存到历史记录）"""
+    return pack_json_text(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+
+def pack_json_text(text):
+    """压缩已序列化的JSON文本；也注册为SQL函数供批量导入使用"""
+    if text is None or isinstance(text, bytes):
+        return text
+    return zlib.compress(text.encode("utf-8"))
+
+
+def unpack_json(value):
+    """读取保存的JSON文本：压缩数据解压，旧版未压缩的文本原样返回"""
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value or ""
+
+
+def format_json(value):
+    """把保存的JSON转为缩进格式用于界面显示（非JSON文本原样返回）"""
+    text = unpack_json(value)
+    try:
+        return json.dumps(json.loads(text), indent=2, ensure_ascii=False)
+    except ValueError:
+        return text
+
+
+def task_transitions(response_data, observed_at=None):
+    """从任务响应提取状态转换，返回 [(状态, epoch秒, 是否为观察时间)]
+
+    PENDING/RUNNING/终态的时间分别取自 submit_time / scheduled_time / end_time。
+    当前状态在响应中没有对应时间（如刚创建的任务）时，若提供了 observed_at
+    则以观察到的时间记录，之后拿到服务端时间时再修正。
+    """
+    output = (response_data or {}).get("output") or {}
+    task_status = output.get("task_status")
+
+    transitions = []
+    for status, key in (("PENDING", "submit_time"), ("RUNNING", "scheduled_time")):
+        changed_at = api_timestamp(output.get(key))
+        if changed_at is not None:
+            transitions.append((status, changed_at, 0))
+
+    if task_status in TERMINAL_STATUSES:
+        changed_at = api_timestamp(output.get("end_time"))
+        if changed_at is not None:
+            transitions.append((task_status, changed_at, 0))
+
+    if task_status and observed_at is not None and task_status not in [t[0] for t in transitions]:
+        transitions.append((task_status, observed_at, 1))
+
+    return transitions
+
+
+class PollingPolicy:
+    """基于历史耗时分布的自适应轮询策略
+
+    耗时样本取自历史记录中已成功任务响应里的 submit_time / scheduled_time / end_time，
+    按 (模型, 分辨率) 分组；样本不足时退回到按模型统计，再退回到默认值。
+    """
+
+    DEFAULT_STATS = {"queue_p50": 60.0, "p50": 420.0, "p90": 600.0}  # 约7-10分钟
+    MIN_SAMPLES = 5
+
+    def __init__(self, samples=None, min_interval=5, max_interval=120, min_deadline=1800):
+        self.min_interval = min_interval  # 接近预期完成时间时的轮询间隔
+        self.max_interval = max_interval  # 退避的最大间隔
+        self.min_deadline = min_deadline  # 最长等待时间的下限（秒）
+        self.stats = {}
+        self._build_stats(samples or [])
+
+    @classmethod
+    def from_history(cls, store, limit=2000, **kwargs):
+        """从历史记录存储读取最近成功任务的耗时样本"""
+        samples = []
+        try:
+            cursor = store.read().cursor()
+            cursor.execute(
+                "SELECT model, request_json, response_json FROM history "
+                "WHERE status IN ('成功', 'SUCCEEDED') ORDER BY id DESC LIMIT ?",
+                (limit,)
+            )
+            for model, request_json, response_json in cursor:
+                sample = cls.sample_from_row(model, request_json, response_json)
+                if sample:
+                    samples.append(sample)
+        except Exception as e:
+            print(f"读取历史耗时失败: {str(e)}")
+
+        return cls(samples, **kwargs)
+
+    @staticmethod
+    def sample_from_row(model, request_json, response_json):
+        """从一条历史记录提取 (模型, 分辨率, 排队秒数, 总耗时秒数)"""
+        try:
+            output = json.loads(unpack_json(response_json)).get("output", {})
+            resolution = request_resolution(json.loads(request_json)) if request_json else ""
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+        submit_time = _parse_api_time(output.get("submit_time"))
+        scheduled_time = _parse_api_time(output.get("scheduled_time"))
+        end_time = _parse_api_time(output.get("end_time"))
+        if not submit_time or not end_time:
+            return None
+
+        total = (end_time - submit_time).total_seconds()
+        queued_s = (scheduled_time - submit_time).total_seconds() if scheduled_time else 0.0
+        if total <= 0:
+            return None
+        return model, resolution, max(queued_s, 0.0), total
+
+    def _build_stats(self, samples):
+        groups = {}
+        for model, resolution, queued, total in samples:
+            for key in ((model, resolution), (model, None)):
+                groups.setdefault(key, ([], []))
+                groups[key][0].append(queued)
+                groups[key][1].append(total)
+
+        for key, (queues, totals) in groups.items():
+            if len(totals) < self.MIN_SAMPLES:
+                continue
+            queues.sort()
+            totals.sort()
+            self.stats[key] = {
+                "queue_p50": _percentile(queues, 0.5),
+                "p50": _percentile(totals, 0.5),
+                "p90": _percentile(totals, 0.9)
+            }
+
+    def stats_for(self, model, resolution=""):
+        return self.stats.get((model, resolution)) or self.stats.get((model, None)) or self.DEFAULT_STATS
+
+    def deadline(self, model, resolution=""):
+        """该模型/分辨率任务的最长等待时间（秒）"""
+        return max(self.min_deadline, 3 * self.stats_for(model, resolution)["p90"])
+
+    def next_delay(self, model, resolution, elapsed, task_status="", pending_checks=0):
+        """计算距离下一次状态检查的秒数
+
+        elapsed 为任务创建以来的秒数，pending_checks 为连续查询到 PENDING 的次数。
+        """
+        stats = self.stats_for(model, resolution)
+
+        if task_status == "PENDING":
+            # 仍在排队：从预期排队时间开始指数退避
+            base = max(self.min_interval, stats["queue_p50"] / 2)
+            return min(base * (2 ** pending_checks), self.max_interval)
+
+        expected = stats["p50"]
+        if elapsed < expected * 0.8:
+            # 远未到预期完成时间：直接等到预期完成时间附近（分段等待以便更新界面）
+            return max(self.min_interval, min(expected * 0.8 - elapsed, self.max_interval * 2))
+
+        if elapsed < stats["p90"]:
+            # 预期完成时间附近：密集轮询，减少完成后的额外延迟
+            return self.min_interval
+
+        # 已超过大多数任务的耗时：逐渐放慢
+        overrun = (elapsed - stats["p90"]) / max(stats["p90"], 1)
+        return min(self.max_interval, self.min_interval * (1 + 4 * overrun))
+
+
+def _migrate_v1(conn):
+    """v1：原始历史记录表"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id TEXT UNIQUE,
+        model TEXT,
+        timestamp TEXT,
+        prompt TEXT,
+        status TEXT,
+        video_url TEXT,
+        request_json TEXT,
+        response_json TEXT
+    )
+    ''')
+
+
+def _migrate_v2(conn):
+    """v2：整数创建/更新时间戳，以及列表和筛选查询用的索引"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+    if "created_at" not in columns:
+        conn.execute("ALTER TABLE history ADD COLUMN created_at INTEGER")
+    if "updated_at" not in columns:
+        conn.execute("ALTER TABLE history ADD COLUMN updated_at INTEGER")
+
+    # 旧记录只有本地时间文本，尽量换算成epoch秒
+    conn.execute(
+        """UPDATE history SET created_at = COALESCE(
+               CAST(strftime('%s', timestamp, 'utc') AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER))
+           WHERE created_at IS NULL"""
+    )
+    conn.execute("UPDATE history SET updated_at = created_at WHERE updated_at IS NULL")
+
+    # 历史列表按创建时间倒序；按状态/模型筛选时同样按创建时间排序。
+    # 索引带上列表显示的短字段，只有提示词需要按rowid回表
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_created "
+                 "ON history(created_at, id, task_id, model, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_status_created "
+                 "ON history(status, created_at, id, task_id, model)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_model_created "
+                 "ON history(model, created_at, id, task_id, status)")
+
+
+def _migrate_v3(conn):
+    """v3：提示词全文索引（FTS5外部内容表，由触发器与history表同步）"""
+    # trigram分词支持中文子串匹配；旧版SQLite不支持时退回unicode61
+    for tokenizer in ("trigram", "unicode61"):
+        try:
+            conn.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5("
+                f"prompt, content='history', content_rowid='id', tokenize='{tokenizer}')"
+            )
+            break
+        except sqlite3.OperationalError as e:
+            last_error = e
+    else:
+        # SQLite未编译FTS5，搜索退回LIKE
+        print(f"无法创建全文索引: {str(last_error)}")
+        return
+
+    _create_fts_triggers(conn)
+    conn.execute("INSERT INTO history_fts(history_fts) VALUES ('rebuild')")
+
+
+def _migrate_v4(conn):
+    """v4：任务状态转换日志；响应改为紧凑JSON压缩存储，请求改为紧凑JSON"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS task_transitions (
+        id INTEGER PRIMARY KEY,
+        task_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        changed_at REAL NOT NULL,
+        observed INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (task_id, status)
+    )
+    ''')
+
+    # 每个任务一行：提交、开始生成、结束时间，以及排队和生成耗时（秒）
+    terminal = ", ".join(f"'{status}'" for status in TERMINAL_STATUSES)
+    conn.execute(f'''
+    CREATE VIEW IF NOT EXISTS task_timings AS
+    SELECT task_id, model, final_status, submitted_at, started_at, finished_at,
+           started_at - submitted_at AS queue_seconds,
+           finished_at - started_at AS render_seconds
+    FROM (
+        SELECT t.task_id, h.model,
+               MAX(CASE WHEN t.status IN ({terminal}) THEN t.status END) AS final_status,
+               MAX(CASE WHEN t.status = 'PENDING' THEN t.changed_at END) AS submitted_at,
+               MAX(CASE WHEN t.status = 'RUNNING' THEN t.changed_at END) AS started_at,
+               MAX(CASE WHEN t.status IN ({terminal}) THEN t.changed_at END) AS finished_at
+        FROM task_transitions t LEFT JOIN history h ON h.task_id = t.task_id
+        GROUP BY t.task_id
+    )
+    ''')
+
+    # 从已保存的最后一次响应补录状态转换，同时压缩旧记录
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, task_id, request_json, response_json FROM history WHERE id > ? ORDER BY id LIMIT 1000",
+            (last_id,)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        updates = []
+        transitions = []
+        for row_id, task_id, request_json, response_json in rows:
+            if isinstance(request_json, str):
+                try:
+                    request_json = json.dumps(json.loads(request_json), ensure_ascii=False, separators=(",", ":"))
+                except ValueError:
+                    pass
+
+            if isinstance(response_json, str):
+                try:
+                    response_data = json.loads(response_json)
+                except ValueError:
+                    # 非JSON文本（如HTTP错误页）原样压缩
+                    response_json = pack_json_text(response_json)
+                else:
+                    response_json = pack_json(response_data)
+                    if isinstance(response_data, dict):
+                        transitions.extend((task_id,) + t for t in task_transitions(response_data))
+
+            updates.append((request_json, response_json, row_id))
+
+        conn.executemany("UPDATE history SET request_json = ?, response_json = ? WHERE id = ?", updates)
+        _record_transitions(conn, transitions)
+
+
+def _migrate_v5(conn):
+    """v5：视频下载到本地后的路径、大小和SHA-256"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+    for column, column_type in (("local_path", "TEXT"), ("video_size", "INTEGER"), ("video_sha256", "TEXT")):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE history ADD COLUMN {column} {column_type}")
+
+
+def _migrate_v6(conn):
+    """v6：本地视频库索引（按SHA-256内容寻址）和由触发器维护的占用空间计数"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS videos (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        last_access INTEGER NOT NULL,
+        pinned INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    ''')
+    # 淘汰时按最近访问时间顺序取未固定的视频
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_videos_lru ON videos(pinned, last_access)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_video ON history(video_sha256)")
+
+    # 总占用空间只有一行，配额检查不需要对videos求和
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS video_usage (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_size INTEGER NOT NULL,
+        video_count INTEGER NOT NULL
+    )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO video_usage VALUES (1, 0, 0)")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS videos_usage_insert AFTER INSERT ON videos BEGIN
+        UPDATE video_usage SET total_size = total_size + new.size, video_count = video_count + 1 WHERE id = 1;
+    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS videos_usage_delete AFTER DELETE ON videos BEGIN
+        UPDATE video_usage SET total_size = total_size - old.size, video_count = video_count - 1 WHERE id = 1;
+    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS videos_usage_update AFTER UPDATE OF size ON videos BEGIN
+        UPDATE video_usage SET total_size = total_size - old.size + new.size WHERE id = 1;
+    END""")
+
+
+def _migrate_v7(conn):
+    """v7：已上传的本地图片（按SHA-256和上传后端），用于跳过重复上传"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS uploads (
+        sha256 TEXT NOT NULL,
+        backend TEXT NOT NULL,
+        url TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        uploaded_at INTEGER NOT NULL,
+        PRIMARY KEY (sha256, backend)
+    ) WITHOUT ROWID
+    ''')
+
+
+def _migrate_v8(conn):
+    """v8：请求指纹（见 request_fingerprint），用于复用相同请求的任务"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+    if "request_fingerprint" not in columns:
+        conn.execute("ALTER TABLE history ADD COLUMN request_fingerprint TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_fingerprint ON history(request_fingerprint, created_at)")
+
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, request_json FROM history WHERE id > ? AND request_json IS NOT NULL ORDER BY id LIMIT 1000",
+            (last_id,)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        updates = []
+        for row_id, request_json in rows:
+            try:
+                request = json.loads(unpack_json(request_json))
+            except ValueError:
+                continue
+            if isinstance(request, dict):
+                updates.append((request_fingerprint(request), row_id))
+        conn.executemany("UPDATE history SET request_fingerprint = ? WHERE id = ?", updates)
+
+
+def _migrate_v9(conn):
+    """v9：创建任务所用API Key的名称（Key池），查询状态时使用同一个Key"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+    if "api_key_name" not in columns:
+        conn.execute("ALTER TABLE history ADD COLUMN api_key_name TEXT")
+
+
+def _migrate_v10(conn):
+    """v10：持久化任务队列（见 JobQueue），程序退出后未提交和未结束的任务在下次启动时继续"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        seq INTEGER,
+        state TEXT NOT NULL DEFAULT 'queued',
+        api_url TEXT,
+        request_json TEXT,
+        context_json TEXT,
+        task_id TEXT,
+        api_key_name TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires REAL NOT NULL DEFAULT 0,
+        result TEXT,
+        error TEXT,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL,
+        UNIQUE (source, seq)
+    )
+    ''')
+    # 只索引未结束的任务，已完成的任务再多也不影响领取速度
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_jobs_active ON jobs(source, id)
+        WHERE state IN ('queued', 'submitted', 'polling')""")
+
+
+def _migrate_v11(conn):
+    """v11：批量任务按请求指纹（而不是清单行号）去重，清单插入或删除行后重跑仍能对应到原任务
+
+    已有的批量任务按请求计算指纹；同一来源中重复的请求只有第一个任务记下指纹。
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+    if "fingerprint" not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN fingerprint TEXT")
+
+    seen = set()
+    updates = []
+    rows = conn.execute("""SELECT id, source, request_json FROM jobs
+        WHERE source LIKE 'batch:%' AND request_json IS NOT NULL AND fingerprint IS NULL ORDER BY id""")
+    for job_id, source, request_json in rows:
+        try:
+            request = json.loads(request_json)
+        except ValueError:
+            continue
+        if not isinstance(request, dict):
+            continue
+        key = (source, request_fingerprint(request))
+        if key not in seen:
+            seen.add(key)
+            updates.append((key[1], job_id))
+    conn.executemany("UPDATE jobs SET fingerprint = ? WHERE id = ?", updates)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_fingerprint ON jobs(source, fingerprint)")
+
+
+# 保持全文索引与history表同步的触发器
+HISTORY_FTS_TRIGGERS = {
+    "history_fts_insert": """CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+        INSERT INTO history_fts(rowid, prompt) VALUES (new.id, new.prompt);
+    END""",
+    "history_fts_delete": """CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+        INSERT INTO history_fts(history_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+    END""",
+    "history_fts_update": """CREATE TRIGGER IF NOT EXISTS history_fts_update AFTER UPDATE OF prompt ON history
+        WHEN old.prompt IS NOT new.prompt BEGIN
+        INSERT INTO history_fts(history_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+        INSERT INTO history_fts(rowid, prompt) VALUES (new.id, new.prompt);
+    END"""
+}
+
+
+def _create_fts_triggers(conn):
+    for sql in HISTORY_FTS_TRIGGERS.values():
+        conn.execute(sql)
+
+
+def _suspend_fts_triggers(conn):
+    """批量导入前移除全文索引触发器（逐行更新全文索引比导入后重建慢得多）"""
+    for name in HISTORY_FTS_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+
+def _resume_fts_triggers(conn):
+    """恢复全文索引触发器并重建索引"""
+    if history_fts_tokenizer(conn) is None:
+        return
+    _create_fts_triggers(conn)
+    conn.execute("INSERT INTO history_fts(history_fts) VALUES ('rebuild')")
+
+
+def _ensure_fts_triggers(conn):
+    """启动时检查触发器是否完整（批量导入中途退出会留下缺失的触发器）"""
+    if history_fts_tokenizer(conn) is None:
+        return
+    names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    if not set(HISTORY_FTS_TRIGGERS) <= names:
+        conn.execute("BEGIN IMMEDIATE")
+        _resume_fts_triggers(conn)
+        conn.execute("COMMIT")
+
+
+# 按顺序执行的历史记录表迁移，第i个迁移完成后 user_version = i
+HISTORY_MIGRATIONS = [
+    _migrate_v1,
+    _migrate_v2,
+    _migrate_v3,
+    _migrate_v4,
+    _migrate_v5,
+    _migrate_v6,
+    _migrate_v7,
+    _migrate_v8,
+    _migrate_v9,
+    _migrate_v10,
+    _migrate_v11
+]
+
+
+def create_history_schema(conn):
+    """把历史记录数据库迁移到最新版本（记录在PRAGMA user_version中）"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for target in range(version + 1, len(HISTORY_MIGRATIONS) + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            HISTORY_MIGRATIONS[target - 1](conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    _ensure_fts_triggers(conn)
+
+
+def _record_transitions(conn, transitions):
+    """追加状态转换 (task_id, 状态, 时间, 是否为观察时间)
+
+    同一任务的同一状态只记录一次；已有记录是观察时间而新记录带服务端时间时，修正为服务端时间。
+    """
+    conn.executemany(
+        """INSERT INTO task_transitions (task_id, status, changed_at, observed) VALUES (?, ?, ?, ?)
+        ON CONFLICT(task_id, status) DO UPDATE SET changed_at = excluded.changed_at, observed = 0
+        WHERE task_transitions.observed = 1 AND excluded.observed = 0""",
+        transitions
+    )
+
+
+def _save_history_row(conn, task_id, model="", prompt="", status="", video_url="", request=None, response=None,
+                      api_key_name=None):
+    """插入或更新一条历史记录（在写线程中执行）
+
+    request/response 为请求体和最近一次响应对象：请求保存为紧凑JSON，响应压缩保存，
+    并从响应中提取状态转换追加到 task_transitions。
+    未提供（为空）的字段保留原值，因此轮询更新不会覆盖已保存的请求JSON；
+    created_at 只在插入时写入，之后只更新 updated_at。api_key_name 为创建任务的Key池成员名称。
+    """
+    observed_at = time.time()
+    now = int(observed_at)
+    timestamp = datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S")
+    request_json = json.dumps(request, ensure_ascii=False, separators=(",", ":")) if request else None
+    fingerprint = request_fingerprint(request) if request else None
+    response_json = pack_json(response) if response else None
+
+    conn.execute(
+        """INSERT INTO history
+        (task_id, model, timestamp, prompt, status, video_url, request_json, response_json, created_at, updated_at,
+         request_fingerprint, api_key_name)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(task_id) DO UPDATE SET
+            model = COALESCE(excluded.model, model),
+            prompt = COALESCE(excluded.prompt, prompt),
+            status = COALESCE(excluded.status, status),
+            video_url = COALESCE(excluded.video_url, video_url),
+            request_json = COALESCE(excluded.request_json, request_json),
+            response_json = COALESCE(excluded.response_json, response_json),
+            request_fingerprint = COALESCE(excluded.request_fingerprint, request_fingerprint),
+            api_key_name = COALESCE(excluded.api_key_name, api_key_name),
+            updated_at = excluded.updated_at""",
+        (task_id, model or None, timestamp, prompt or None, status or None, video_url or None,
+         request_json, response_json, now, now, fingerprint, api_key_name or None)
+    )
+
+    if isinstance(response, dict):
+        _record_transitions(conn, [(task_id,) + t for t in task_transitions(response, observed_at)])
+
+
+def _history_filters(model=None, status=None, prefix=""):
+    clauses = []
+    params = []
+    if model:
+        clauses.append(f"{prefix}model = ?")
+        params.append(model)
+    if status:
+        clauses.append(f"{prefix}status = ?")
+        params.append(status)
+    return clauses, params
+
+
+def fetch_history_page(conn, before=None, limit=200, model=None, status=None):
+    """按创建时间倒序取一页历史记录（键集分页）
+
+    before 为上一页最后一行的 (created_at, id)；只取列表需要的短字段，
+    提示词在SQL中截断，请求/响应JSON留到查看详情时再读取。
+    返回 (task_id, model, created_at, 提示词前51个字符, status, id) 列表。
+    """
+    clauses, params = _history_filters(model, status)
+    if before is not None:
+        clauses.append("(created_at, id) < (?, ?)")
+        params.extend(before)
+
+    sql = "SELECT task_id, model, created_at, substr(prompt, 1, 51), status, id FROM history"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    params.append(limit)
+    return conn.execute(sql, params).fetchall()
+
+
+def history_fts_tokenizer(conn):
+    """返回全文索引使用的分词器（trigram/unicode61），没有全文索引时返回None"""
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'history_fts'").fetchone()
+    if not row:
+        return None
+    return "trigram" if "trigram" in row[0] else "unicode61"
+
+
+def _like_pattern(term):
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def search_history(conn, text, model=None, status=None, offset=0, limit=200):
+    """全文搜索提示词，可叠加模型和状态筛选，按相关度排序
+
+    多个关键词之间为AND。trigram分词按子串匹配（少于3个字符的词用LIKE过滤），
+    unicode61分词按前缀匹配。命中部分在片段中用【】标出。
+    返回与 fetch_history_page 相同结构的行，提示词列为高亮片段。
+    """
+    tokenizer = history_fts_tokenizer(conn)
+    fts_terms = []
+    like_terms = []
+    for term in text.split():
+        if tokenizer == "unicode61":
+            fts_terms.append('"' + term.replace('"', '""') + '"*')
+        elif tokenizer == "trigram" and len(term) >= 3:
+            fts_terms.append('"' + term.replace('"', '""') + '"')
+        else:
+            like_terms.append(term)
+
+    if fts_terms:
+        clauses, params = _history_filters(model, status, prefix="h.")
+        clauses.insert(0, "history_fts MATCH ?")
+        params.insert(0, " AND ".join(fts_terms))
+        for term in like_terms:
+            clauses.append("h.prompt LIKE ? ESCAPE '\\'")
+            params.append(_like_pattern(term))
+
+        sql = (
+            "SELECT h.task_id, h.model, h.created_at, "
+            "snippet(history_fts, 0, '【', '】', '…', 24), h.status, h.id "
+            "FROM history_fts JOIN history h ON h.id = history_fts.rowid "
+            "WHERE " + " AND ".join(clauses) +
+            " ORDER BY rank, h.created_at DESC LIMIT ? OFFSET ?"
+        )
+    else:
+        # 只有短关键词：按时间顺序扫描，找到一页即停止
+        clauses, params = _history_filters(model, status)
+        for term in like_terms:
+            clauses.append("prompt LIKE ? ESCAPE '\\'")
+            params.append(_like_pattern(term))
+
+        sql = "SELECT task_id, model, created_at, substr(prompt, 1, 51), status, id FROM history"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?"
+
+    params.extend([limit, offset])
+    return conn.execute(sql, params).fetchall()
+
+
+def summarize_task_timings(conn, limit=2000):
+    """按模型统计最近成功任务的排队时间和生成时间（秒）
+
+    返回 {模型: {"count", "queue_p50", "queue_p90", "render_p50", "render_p90"}}。
+    """
+    groups = {}
+    cursor = conn.execute(
+        """SELECT model, queue_seconds, render_seconds FROM task_timings
+        WHERE final_status = 'SUCCEEDED' AND queue_seconds IS NOT NULL AND render_seconds IS NOT NULL
+        ORDER BY finished_at DESC LIMIT ?""",
+        (limit,)
+    )
+    for model, queue_seconds, render_seconds in cursor:
+        queues, renders = groups.setdefault(model or "未知模型", ([], []))
+        queues.append(max(queue_seconds, 0.0))
+        renders.append(max(render_seconds, 0.0))
+
+    summary = {}
+    for model, (queues, renders) in groups.items():
+        queues.sort()
+        renders.sort()
+        summary[model] = {
+            "count": len(renders),
+            "queue_p50": _percentile(queues, 0.5),
+            "queue_p90": _percentile(queues, 0.9),
+            "render_p50": _percentile(renders, 0.5),
+            "render_p90": _percentile(renders, 0.9)
+        }
+    return summary
+
+
+def format_task_timings(summary):
+    if not summary:
+        return "暂无已完成任务的状态转换记录"
+    lines = []
+    for model, stats in sorted(summary.items()):
+        lines.append(
+            f"{model}（{stats['count']} 个任务）\n"
+            f"  排队: 中位数 {stats['queue_p50']:.0f} 秒，P90 {stats['queue_p90']:.0f} 秒\n"
+            f"  生成: 中位数 {stats['render_p50']:.0f} 秒，P90 {stats['render_p90']:.0f} 秒"
+        )
+    return "\n\n".join(lines)
+
+
+# 导出文件中的标量列（请求/响应JSON另外处理）
+EXPORT_COLUMNS = ("task_id", "model", "timestamp", "created_at", "updated_at", "prompt", "status", "video_url")
+
+EXPORT_FORMATS = {
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".json": "json",
+    ".csv": "csv",
+    ".parquet": "parquet"
+}
+
+# JSON字符串内不会出现原始换行，因此换行及其后的缩进一定是格式空白
+_JSON_LINE_BREAK = re.compile(r"\n\s*")
+
+
+def _compact_json(raw):
+    """把已保存的JSON文本压成一行，不做解析和重新序列化"""
+    if not raw:
+        return "null"
+    raw = unpack_json(raw).strip()
+    if raw[:1] not in ("{", "["):
+        # 非JSON文本（如HTTP错误页）按字符串导出
+        return json.dumps(raw, ensure_ascii=False)
+    return _JSON_LINE_BREAK.sub("", raw)
+
+
+def parse_date(value, end=False):
+    """把 YYYY-MM-DD 转为本地时间的epoch秒；end=True 时返回次日零点（不含）"""
+    if not value:
+        return None
+    day = datetime.strptime(value, "%Y-%m-%d")
+    if end:
+        day = datetime.fromordinal(day.toordinal() + 1)
+    return int(time.mktime(day.timetuple()))
+
+
+def _export_filters(since=None, until=None, model=None, status=None):
+    clauses, params = _history_filters(model, status)
+    if since is not None:
+        clauses.append("created_at >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("created_at < ?")
+        params.append(until)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def iter_history_export(conn, since=None, until=None, model=None, status=None, chunk_size=1000):
+    """按块读取要导出的历史记录（生成器），内存占用与总行数无关"""
+    where, params = _export_filters(since, until, model, status)
+    cursor = conn.execute(
+        "SELECT task_id, model, timestamp, created_at, updated_at, prompt, status, video_url, "
+        "request_json, response_json FROM history" + where + " ORDER BY created_at, id",
+        params
+    )
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+def export_history_file(conn, path, fmt=None, since=None, until=None, model=None, status=None,
+                        chunk_size=1000, progress=None):
+    """流式导出历史记录，返回导出的行数
+
+    fmt 为 ndjson/json/csv/parquet，默认按扩展名判断；progress(已导出, 总数) 每块调用一次。
+    先写入临时文件，完成后再替换目标文件。
+    """
+    fmt = fmt or EXPORT_FORMATS.get(os.path.splitext(path)[1].lower(), "ndjson")
+
+    where, params = _export_filters(since, until, model, status)
+    total = conn.execute("SELECT COUNT(*) FROM history" + where, params).fetchone()[0]
+    chunks = iter_history_export(conn, since, until, model, status, chunk_size)
+
+    temp_path = path + ".part"
+    exported = 0
+    try:
+        if fmt == "parquet":
+            exported = _export_parquet(temp_path, chunks, total, progress)
+        else:
+            with open(temp_path, "w", encoding="utf-8", newline="") as f:
+                if fmt == "csv":
+                    writer = csv.writer(f)
+                    writer.writerow(EXPORT_COLUMNS + ("request_json", "response_json"))
+                elif fmt == "json":
+                    f.write("[")
+
+                for rows in chunks:
+                    for row in rows:
+                        if fmt == "csv":
+                            writer.writerow(row[:8] + (_compact_json(row[8]), _compact_json(row[9])))
+                            continue
+
+                        # 标量字段正常序列化，已保存的JSON原样拼接
+                        head = json.dumps(dict(zip(EXPORT_COLUMNS, row[:8])), ensure_ascii=False)
+                        line = (head[:-1] + ', "request_json": ' + _compact_json(row[8]) +
+                                ', "response_json": ' + _compact_json(row[9]) + "}")
+                        if fmt == "json":
+                            f.write(("\n" if exported == 0 else ",\n") + line)
+                        else:
+                            f.write(line + "\n")
+                        exported += 1
+
+                    if fmt == "csv":
+                        exported += len(rows)
+                    if progress:
+                        progress(exported, total)
+
+                if fmt == "json":
+                    f.write("\n]\n")
+
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return exported
+
+
+def _export_parquet(path, chunks, total, progress=None):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("导出Parquet需要安装pyarrow（pip install pyarrow）")
+
+    schema = pa.schema([
+        ("task_id", pa.string()),
+        ("model", pa.string()),
+        ("timestamp", pa.string()),
+        ("created_at", pa.int64()),
+        ("updated_at", pa.int64()),
+        ("prompt", pa.string()),
+        ("status", pa.string()),
+        ("video_url", pa.string()),
+        ("request_json", pa.string()),
+        ("response_json", pa.string())
+    ])
+
+    exported = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            columns[8] = [_compact_json(value) for value in columns[8]]
+            columns[9] = [_compact_json(value) for value in columns[9]]
+            writer.write_table(pa.table(columns, schema=schema))
+            exported += len(rows)
+            if progress:
+                progress(exported, total)
+
+    return exported
+
+
+# 导入合并时视为终态的状态（终态总是覆盖未完成状态）
+FINAL_STATUS_LABELS = ("成功", "失败") + TERMINAL_STATUSES
+
+
+def iter_import_records(path, read_size=1024 * 1024):
+    """流式读取导出文件，逐条产出每条记录的原始JSON文本（生成器）
+
+    支持NDJSON（每行一条）和JSON数组（包括旧版缩进格式）。JSON数组用 raw_decode
+    定位每个元素的边界后直接截取原文，不会把整个文件读入内存。
+    记录字段由SQLite的JSON函数解析，Python端不做反序列化。
+    """
+    decoder = json.JSONDecoder()
+
+    with open(path, "r", encoding="utf-8-sig") as f:
+        buffer = f.read(read_size)
+        start = len(buffer) - len(buffer.lstrip())
+
+        if not buffer[start:start + 1] == "[":
+            # NDJSON
+            f.seek(0)
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+            return
+
+        pos = start + 1
+        eof = False
+        while True:
+            # 跳过空白和分隔符
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+
+            try:
+                _, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # 记录跨越了缓冲区边界，继续读取
+                more = f.read(read_size)
+                eof = not more
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+
+            yield buffer[pos:end]
+            pos = end
+            if pos > read_size:
+                buffer = buffer[pos:]
+                pos = 0
+
+
+def _import_history_rows(conn, records):
+    """批量合并历史记录（在写线程中执行），返回实际插入或更新的行数
+
+    records 为原始JSON文本，字段用 json_extract 在SQLite中提取；
+    请求/响应对象会被压缩成一行JSON，无效或缺少task_id的记录被跳过。
+    旧版导出没有 created_at 时按本地时间文本换算。
+    task_id冲突时，更新时间较新的记录胜出；终态总是覆盖未完成的状态。
+    """
+    final = ", ".join(f"'{status}'" for status in FINAL_STATUS_LABELS)
+    cursor = conn.executemany(
+        f"""INSERT INTO history
+        (task_id, model, timestamp, prompt, status, video_url, request_json, response_json, created_at, updated_at,
+         request_fingerprint)
+        SELECT json_extract(j, '$.task_id'), json_extract(j, '$.model'),
+               COALESCE(json_extract(j, '$.timestamp'), ''), json_extract(j, '$.prompt'),
+               json_extract(j, '$.status'), NULLIF(json_extract(j, '$.video_url'), ''),
+               NULLIF(json_extract(j, '$.request_json'), ''), pack_json_text(NULLIF(json_extract(j, '$.response_json'), '')),
+               created, COALESCE(json_extract(j, '$.updated_at'), created),
+               request_fingerprint_text(NULLIF(json_extract(j, '$.request_json'), ''))
+        FROM (
+            SELECT j, COALESCE(json_extract(j, '$.created_at'),
+                               CAST(strftime('%s', json_extract(j, '$.timestamp'), 'utc') AS INTEGER),
+                               CAST(strftime('%s', 'now') AS INTEGER)) AS created
+            FROM (SELECT CASE WHEN json_valid(?) THEN ?1 END AS j)
+        )
+        WHERE json_extract(j, '$.task_id') IS NOT NULL
+        ON CONFLICT(task_id) DO UPDATE SET
+            model = COALESCE(excluded.model, model),
+            prompt = COALESCE(excluded.prompt, prompt),
+            status = excluded.status,
+            video_url = COALESCE(excluded.video_url, video_url),
+            request_json = COALESCE(excluded.request_json, request_json),
+            response_json = COALESCE(excluded.response_json, response_json),
+            request_fingerprint = COALESCE(excluded.request_fingerprint, request_fingerprint),
+            created_at = MIN(created_at, excluded.created_at),
+            updated_at = MAX(updated_at, excluded.updated_at)
+        WHERE (excluded.updated_at > history.updated_at AND NOT
+                  (history.status IN ({final}) AND excluded.status NOT IN ({final})))
+           OR (history.status NOT IN ({final}) AND excluded.status IN ({final}))""",
+        ((record,) for record in records)
+    )
+    return cursor.rowcount
+
+
+def import_history_file(store, path, batch_size=5000, progress=None):
+    """把导出文件合并进历史记录，返回 (读取条数, 写入条数)
+
+    记录按 batch_size 条一组用 executemany 写入，由写线程合并成大事务提交；
+    最多同时排队两组，避免解析速度快于写入时占用过多内存。
+    导入期间暂停全文索引触发器，结束后一次性重建索引。
+    progress(已读取, 已写入) 每组调用一次。
+    """
+    pending = []
+    read = 0
+    written = 0
+    batch = []
+
+    def drain(limit):
+        nonlocal written
+        while len(pending) > limit:
+            written += pending.pop(0).result()
+
+    store.submit(_suspend_fts_triggers).result()
+    try:
+        for record in iter_import_records(path):
+            batch.append(record)
+            read += 1
+
+            if len(batch) >= batch_size:
+                pending.append(store.submit(_import_history_rows, batch))
+                batch = []
+                drain(2)
+                if progress:
+                    progress(read, written)
+
+        if batch:
+            pending.append(store.submit(_import_history_rows, batch))
+        drain(0)
+    finally:
+        for future in pending:
+            future.exception()
+        store.submit(_resume_fts_triggers).result()
+
+    if progress:
+        progress(read, written)
+
+    return read, written
+
+
+def _delete_history_rows(conn, task_ids):
+    conn.executemany("DELETE FROM history WHERE task_id = ?", [(task_id,) for task_id in task_ids])
+
+
+def fetch_pending_downloads(conn, max_age=VIDEO_URL_TTL):
+    """返回URL可能仍有效、但还没有下载过的成功任务 [(task_id, video_url, response_json)]
+
+    已下载后被视频库淘汰的任务保留了哈希，不会被重新下载。
+    """
+    return conn.execute(
+        """SELECT task_id, video_url, response_json FROM history
+        WHERE status IN ('成功', 'SUCCEEDED') AND created_at >= ?
+          AND video_url IS NOT NULL AND video_sha256 IS NULL""",
+        (int(time.time()) - max_age,)
+    ).fetchall()
+
+
+# 任务仍在服务端处理中的状态（可以接着轮询）
+IN_FLIGHT_STATUSES = ("等待中", "处理中", "PENDING", "RUNNING")
+
+
+def find_matching_task(conn, fingerprint, max_age=VIDEO_URL_TTL):
+    """查找与请求指纹相同、可以复用的任务，没有时返回None
+
+    返回字典 task_id、status、video_url、local_path、api_key_name、in_flight。优先返回视频已在本地的成功任务，
+    其次是视频URL仍然有效的成功任务，最后是 max_age 秒内创建、仍在处理中的任务；失败的任务不复用。
+    """
+    rows = conn.execute(
+        """SELECT task_id, status, video_url, local_path, response_json, created_at, api_key_name FROM history
+        WHERE request_fingerprint = ? ORDER BY created_at DESC LIMIT 20""",
+        (fingerprint,)
+    ).fetchall()
+
+    now = time.time()
+    succeeded, in_flight = [], []
+    for task_id, status, video_url, local_path, response_json, created_at, api_key_name in rows:
+        match = {"task_id": task_id, "status": status, "video_url": video_url or "",
+                 "local_path": local_path or "", "api_key_name": api_key_name, "in_flight": False}
+        if status in ("成功", "SUCCEEDED"):
+            if local_path and os.path.exists(local_path):
+                return match
+            if video_url:
+                try:
+                    response_data = json.loads(unpack_json(response_json) or "{}")
+                except ValueError:
+                    response_data = None
+                if video_url_expiry(video_url, response_data if isinstance(response_data, dict) else None) > now:
+                    succeeded.append(match)
+        elif status in IN_FLIGHT_STATUSES and (created_at or 0) >= now - max_age:
+            match["in_flight"] = True
+            in_flight.append(match)
+    candidates = succeeded + in_flight
+    return candidates[0] if candidates else None
+
+
+def _log_write_error(future):
+    if future.exception() is not None:
+        # 这里我们不显示错误消息框，以免干扰用户操作
+        print(f"保存历史记录失败: {str(future.exception())}")
+
+
+class _WriterConnection(sqlite3.Connection):
+    """写线程的连接：写操作可以登记事务提交后执行的文件操作（on_commit），
+    以及回滚时撤销已做文件操作的补偿（on_rollback），使文件和索引保持一致"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_commit = []
+        self.on_rollback = []
+
+    def mark(self):
+        return len(self.on_commit), len(self.on_rollback)
+
+    def settle(self, committed, mark=(0, 0)):
+        """提交或回滚后执行 mark 之后登记的操作（回滚补偿按相反顺序执行）并清除"""
+        actions = self.on_commit[mark[0]:] if committed else self.on_rollback[mark[1]:][::-1]
+        del self.on_commit[mark[0]:]
+        del self.on_rollback[mark[1]:]
+        for action in actions:
+            try:
+                action()
+            except Exception as e:
+                print(f"{'提交' if committed else '回滚'}后的文件操作失败: {str(e)}")
+
+
+class HistoryStore:
+    """历史记录存储
+
+    数据库以WAL模式打开并保持长连接。所有写操作进入队列，由唯一的写线程
+    把同一时刻排队的写操作合并成一个事务提交（每个写操作在各自的保存点中执行，出错时只撤销该操作）；
+    读操作使用各线程自己的连接，WAL下读不会被写阻塞。这样即使大量任务同时轮询，Tk主线程也不必等待磁盘fsync。
+    """
+
+    def __init__(self, db_file, batch_size=500):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        conn = self._connect()
+        create_history_schema(conn)
+        conn.close()
+
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self, factory=sqlite3.Connection):
+        conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None, factory=factory)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.create_function("pack_json_text", 1, pack_json_text, deterministic=True)
+        conn.create_function("request_fingerprint_text", 1, request_fingerprint_text, deterministic=True)
+        return conn
+
+    def read(self):
+        """返回当前线程的读连接（首次调用时创建并复用）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only=ON")
+            self._local.conn = conn
+        return conn
+
+    def release_read(self):
+        """关闭当前线程的读连接（用于短期后台线程）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def submit(self, func, *args):
+        """把写操作 func(conn, *args) 放入写队列，返回Future"""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("历史记录存储已关闭")
+            self._queue.put((func, args, future))
+        return future
+
+    def save(self, task_id, model, prompt, status, video_url="", request=None, response=None, api_key_name=None):
+        """排队保存一条历史记录，不等待写入完成（序列化和压缩在写线程中进行）"""
+        future = self.submit(_save_history_row, task_id, model, prompt, status, video_url, request, response,
+                             api_key_name)
+        future.add_done_callback(_log_write_error)
+        return future
+
+    def delete(self, *task_ids):
+        """排队删除历史记录（同一个写操作，全部删除或全部保留），返回Future"""
+        return self.submit(_delete_history_rows, task_ids)
+
+    def barrier(self):
+        """返回一个Future，此前排队的写操作全部提交后完成（不阻塞调用方）"""
+        return self.submit(lambda conn: None)
+
+    def flush(self, timeout=None):
+        """等待此前排队的写操作全部提交，超时返回False"""
+        try:
+            self.barrier().result(timeout)
+            return True
+        except Exception:
+            return False
+
+    def close(self, timeout=5):
+        """提交剩余的写操作并关闭，最多等待timeout秒，返回是否全部写入"""
+        with self._lock:
+            if self._closed:
+                return True
+            self._closed = True
+            self._queue.put(None)
+
+        self._writer.join(timeout)
+        self.release_read()
+        if self._writer.is_alive():
+            print(f"历史记录在 {timeout} 秒内未写完，约 {self._queue.qsize()} 项写操作未提交")
+            return False
+        return True
+
+    def _write_loop(self):
+        conn = self._connect(_WriterConnection)
+        stopping = False
+
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+            if not batch:
+                continue
+
+            results = []
+            try:
+                conn.execute("BEGIN")
+                for func, args, future in batch:
+                    # 每个写操作在自己的保存点中执行，失败时只撤销它已做的修改，不影响同批的其他操作
+                    conn.execute("SAVEPOINT op")
+                    mark = conn.mark()
+                    try:
+                        result = func(conn, *args)
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO op")
+                        conn.settle(False, mark)
+                        results.append((future, None, e))
+                    else:
+                        results.append((future, result, None))
+                    conn.execute("RELEASE op")
+                conn.execute("COMMIT")
+                conn.settle(True)
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                conn.settle(False)
+                results = [(future, None, e) for _, _, future in batch]
+
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+        conn.close()
+
+
+# 任务队列的状态：queued（未提交）-> submitted（已创建任务）-> polling（轮询中）-> done/failed
+JOB_ACTIVE_STATES = ("queued", "submitted", "polling")
+
+# 租约时长（秒）：持有者定期续约，进程异常退出后租约过期，其他进程（或重启后的程序）才能接手
+JOB_LEASE_SECONDS = 60
+
+# 同一任务最多提交的次数（提交请求发出后、记下任务ID前进程退出，重启后会重新提交）
+JOB_MAX_ATTEMPTS = 3
+
+_JOB_COLUMNS = "id, source, seq, state, api_url, request_json, context_json, task_id, api_key_name, attempts"
+
+
+def _job_record(row):
+    job_id, source, seq, state, api_url, request_json, context_json, task_id, api_key_name, attempts = row
+    return {"id": job_id, "source": source, "seq": seq, "state": state, "api_url": api_url,
+            "request": json.loads(request_json) if request_json else None,
+            "context": json.loads(context_json) if context_json else {},
+            "task_id": task_id, "api_key_name": api_key_name, "attempts": attempts}
+
+
+def _enqueue_jobs(conn, rows, owner=None, lease_expires=0):
+    """插入任务 [(source, seq, fingerprint, state, api_url, request, context, result, error)]，
+    (source, seq) 或 (source, fingerprint) 已存在的跳过
+
+    返回每行新任务的id（跳过的为None）。owner 不为空时直接持有新任务的租约并计为一次提交尝试。
+    因指纹相同而跳过的行，其清单行（context 中的 lines）合并到未结束的原任务，结束时一起输出。
+    """
+    now = int(time.time())
+    ids = []
+    for source, seq, fingerprint, state, api_url, request, context, result, error in rows:
+        cursor = conn.execute(
+            """INSERT OR IGNORE INTO jobs (source, seq, fingerprint, state, api_url, request_json, context_json,
+                attempts, lease_owner, lease_expires, result, error, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (source, seq, fingerprint, state, api_url,
+             json.dumps(request, ensure_ascii=False, separators=(",", ":")) if request else None,
+             json.dumps(context or {}, ensure_ascii=False, separators=(",", ":")),
+             1 if owner else 0, owner, lease_expires, result, error, now, now)
+        )
+        if cursor.rowcount:
+            ids.append(cursor.lastrowid)
+            continue
+        ids.append(None)
+        if fingerprint and context and context.get("lines"):
+            _merge_job_lines(conn, source, fingerprint, context)
+    return ids
+
+
+def _merge_job_lines(conn, source, fingerprint, new_context):
+    """把请求相同的清单行（new_context 中的 lines: [[行号, job_id]]）合并到该指纹未结束的任务
+
+    context 中的 run 标识一次入队：同一次入队的行累加，上次运行记下的行号（清单可能已改动）被替换。
+    """
+    row = conn.execute(
+        """SELECT id, context_json FROM jobs WHERE source = ? AND fingerprint = ?
+        AND state IN ('queued', 'submitted', 'polling')""",
+        (source, fingerprint)
+    ).fetchone()
+    if row is None:
+        return
+    context = json.loads(row[1]) if row[1] else {}
+    if context.get("run") != new_context.get("run"):
+        context["run"] = new_context.get("run")
+        context["lines"] = []
+    merged = context.setdefault("lines", [])
+    added = [line for line in new_context["lines"] if line not in merged]
+    if added:
+        merged.extend(added)
+        conn.execute("UPDATE jobs SET context_json = ? WHERE id = ?",
+                     (json.dumps(context, ensure_ascii=False, separators=(",", ":")), row[0]))
+
+
+def _claim_jobs(conn, source, owner, limit, lease_expires):
+    """领取最多 limit 个租约已过期的未结束任务，未提交的任务提交尝试次数加一"""
+    rows = conn.execute(
+        """SELECT id FROM jobs WHERE source = ? AND state IN ('queued', 'submitted', 'polling')
+            AND lease_expires < ? ORDER BY id LIMIT ?""",
+        (source, time.time(), limit)
+    ).fetchall()
+    ids = [row[0] for row in rows]
+    if not ids:
+        return []
+
+    placeholders = ", ".join("?" * len(ids))
+    conn.execute(
+        f"""UPDATE jobs SET lease_owner = ?, lease_expires = ?,
+            attempts = attempts + (state = 'queued'), updated_at = ? WHERE id IN ({placeholders})""",
+        [owner, lease_expires, int(time.time())] + ids
+    )
+    rows = conn.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id IN ({placeholders}) ORDER BY id", ids)
+    return [_job_record(row) for row in rows]
+
+
+# 允许 _update_job 修改的列
+_JOB_UPDATE_COLUMNS = ("state", "task_id", "api_key_name", "lease_owner", "lease_expires", "result", "error")
+
+
+def _update_job(conn, job_id, owner, fields):
+    """更新任务（仅当租约仍由 owner 持有，避免覆盖已被其他进程接手的任务）"""
+    assert set(fields) <= set(_JOB_UPDATE_COLUMNS)
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    conn.execute(
+        f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ? AND lease_owner = ?",
+        list(fields.values()) + [int(time.time()), job_id, owner]
+    )
+
+
+def _delete_finished_jobs(conn, source):
+    conn.execute("DELETE FROM jobs WHERE source = ? AND state IN ('done', 'failed')", (source,))
+
+
+def _renew_job_leases(conn, owner, lease_expires):
+    conn.execute(
+        """UPDATE jobs SET lease_expires = ? WHERE lease_owner = ?
+        AND state IN ('queued', 'submitted', 'polling') AND lease_expires > 0""",
+        (lease_expires, owner)
+    )
+
+
+class JobQueue:
+    """持久化的任务队列（与历史记录同一个数据库的jobs表，写操作经由HistoryStore的写线程）
+
+    每个任务按 queued -> submitted -> polling -> done/failed 推进，每一步都先写入数据库。
+    处理任务前先领取租约（claim），后台线程定期续约；正常退出时 close() 归还租约，
+    异常退出时租约在 JOB_LEASE_SECONDS 秒后过期。重启后领取到的任务：
+    已有task_id的接着轮询，没有task_id的重新提交（最多 JOB_MAX_ATTEMPTS 次）。
+    任务按来源（source）区分，如批量清单的路径或 "gui"。
+    """
+
+    def __init__(self, history, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.history = history
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_loop, name="job-lease", daemon=True)
+        self._heartbeat.start()
+
+    def enqueue(self, source, seq, api_url, request_body, context=None, claim=False):
+        """加入一个任务，返回Future（结果为新任务的id，(source, seq) 已存在时为None）
+
+        claim 为True时直接持有租约（调用方马上提交）。
+        """
+        row = (source, seq, None, "queued", api_url, request_body, context, None, None)
+        future = self.history.submit(_enqueue_jobs, [row], self.owner if claim else None,
+                                     self._lease_expires() if claim else 0)
+        result = Future()
+
+        def unwrap(f):
+            if f.exception() is not None:
+                result.set_exception(f.exception())
+            else:
+                result.set_result(f.result()[0])
+
+        future.add_done_callback(unwrap)
+        return result
+
+    def enqueue_many(self, rows):
+        """批量加入任务 [(source, seq, fingerprint, state, api_url, request, context, result, error)]，
+        state 可以直接是 failed（如清单中无效的行），返回Future（结果为每行新任务的id或None）"""
+        return self.history.submit(_enqueue_jobs, rows)
+
+    def claim(self, source, limit):
+        """领取最多 limit 个可以处理的任务（阻塞等待写线程），返回任务字典列表"""
+        return self.history.submit(_claim_jobs, source, self.owner, limit, self._lease_expires()).result()
+
+    def active_count(self, source):
+        """该来源未结束的任务数（包括其他进程持有租约的）"""
+        return self.history.read().execute(
+            "SELECT COUNT(*) FROM jobs WHERE source = ? AND state IN ('queued', 'submitted', 'polling')",
+            (source,)
+        ).fetchone()[0]
+
+    def clear_finished(self, source):
+        """删除该来源已结束的任务（重新开始一轮），返回Future"""
+        return self.history.submit(_delete_finished_jobs, source)
+
+    def mark_submitted(self, job, task_id, api_key_name=None):
+        return self._update(job, state="submitted", task_id=task_id, api_key_name=api_key_name)
+
+    def mark_polling(self, job):
+        return self._update(job, state="polling")
+
+    def finish(self, job, result, error=""):
+        """任务结束：result 为 SUCCEEDED 时记为done，其他结果（失败、超时、无效等）记为failed"""
+        state = "done" if result == "SUCCEEDED" else "failed"
+        return self._update(job, state=state, result=result, error=error or None, lease_expires=0)
+
+    def release(self, job):
+        """归还租约但保留状态（如退出前取消轮询），下次领取时继续"""
+        return self._update(job, lease_expires=0)
+
+    def close(self, timeout=5):
+        """停止续约并归还所有租约，最多等待timeout秒"""
+        self._stop.set()
+        try:
+            future = self.history.submit(_renew_job_leases, self.owner, 0)
+            future.result(timeout)
+        except Exception as e:
+            print(f"归还任务租约失败: {str(e)}")
+
+    def _lease_expires(self):
+        return time.time() + self.lease_seconds
+
+    def _update(self, job, **fields):
+        future = self.history.submit(_update_job, job["id"], self.owner, fields)
+        future.add_done_callback(_log_write_error)
+        return future
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.lease_seconds / 4):
+            try:
+                self.history.submit(_renew_job_leases, self.owner, self._lease_expires())
+            except RuntimeError:
+                return  # 历史记录存储已关闭
+
+
+def fetch_unfinished_tasks(conn, exclude=()):
+    """取仍处于处理中状态的历史记录，返回 [(task_id, status, api_key_name)]
+
+    跳过 exclude 中的任务和任务队列中由其他进程持有租约的任务（它们正在被轮询）。
+    """
+    placeholders = ", ".join("?" * len(IN_FLIGHT_STATUSES))
+    rows = conn.execute(
+        f"""SELECT task_id, status, api_key_name FROM history WHERE status IN ({placeholders})
+        AND task_id NOT IN (SELECT task_id FROM jobs WHERE task_id IS NOT NULL
+            AND state IN ('submitted', 'polling') AND lease_expires > ?)
+        ORDER BY created_at""",
+        list(IN_FLIGHT_STATUSES) + [time.time()]
+    ).fetchall()
+    return [row for row in rows if row[0] not in exclude]
+
+
+def _save_reconciled(conn, updates):
+    """写入对账得到的状态 [(task_id, status, video_url, response)]（作为一个写操作，在同一事务中提交）"""
+    for task_id, status, video_url, response in updates:
+        _save_history_row(conn, task_id, status=status, video_url=video_url, response=response)
+    return len(updates)
+
+
+def reconcile_tasks(history, keys, downloader=None, max_workers=16, exclude=(), progress=None):
+    """对账：并发查询历史记录中所有未结束的任务，把最新状态一次写回，并把新成功的视频加入下载队列
+
+    每个任务用创建它的Key查询，请求受该Key的查询限速和熔断器约束（max_workers 只决定同时等待的请求数）。
+    exclude 为本进程正在轮询的task_id。progress(done, total) 在查询线程中调用。
+    返回计数 checked、updated（状态有变化）、succeeded、failed、downloads、errors。
+    """
+    rows = fetch_unfinished_tasks(history.read(), exclude)
+    counts = {"checked": len(rows), "updated": 0, "succeeded": 0, "failed": 0, "downloads": 0, "errors": 0}
+    if not rows or not len(keys):
+        return counts
+
+    def check(task_id, api_key_name):
+        response = query_task(keys.key_named(api_key_name).api_key, task_id)
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        return response.json()
+
+    updates, succeeded = [], []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(rows)), thread_name_prefix="reconcile") as executor:
+        futures = {executor.submit(check, task_id, api_key_name): (task_id, status)
+                   for task_id, status, api_key_name in rows}
+        for done, future in enumerate(as_completed(futures), 1):
+            task_id, old_status = futures[future]
+            try:
+                response_data = future.result()
+            except Exception as e:
+                counts["errors"] += 1
+                print(f"查询任务 {task_id} 失败: {str(e)}")
+            else:
+                task_status, video_url, _ = parse_task_response(response_data)
+                status = STATUS_LABELS.get(task_status, task_status)
+                if status and status != old_status:
+                    updates.append((task_id, status, video_url, response_data))
+                    if task_status == "SUCCEEDED":
+                        counts["succeeded"] += 1
+                        if video_url:
+                            succeeded.append((task_id, video_url, response_data))
+                    elif task_status in TERMINAL_STATUSES:
+                        counts["failed"] += 1
+            if progress:
+                progress(done, len(rows))
+
+    if updates:
+        counts["updated"] = history.submit(_save_reconciled, updates).result()
+    if downloader is not None:
+        for task_id, video_url, response_data in succeeded:
+            downloader.add(task_id, video_url, response_data)
+            counts["downloads"] += 1
+    return counts
+
+
+def format_reconcile_counts(counts):
+    return (f"已检查 {counts['checked']} 个未完成的任务: 状态更新 {counts['updated']}，成功 {counts['succeeded']}，"
+            f"失败或过期 {counts['failed']}，加入下载 {counts['downloads']}，查询失败 {counts['errors']}")
+
+
+def load_saved_api_key(config_file=CONFIG_FILE):
+    """从配置文件读取已保存的API key"""
+    config = configparser.ConfigParser()
+    if os.path.exists(config_file):
+        config.read(config_file)
+    return config.get('Settings', 'api_key', fallback='')
+
+
+def network_settings(config):
+    """读取配置文件中的[Network]连接池和超时设置"""
+    return {
+        "pool_connections": config.getint('Network', 'pool_connections', fallback=8),
+        "pool_maxsize": config.getint('Network', 'pool_maxsize', fallback=32),
+        "connect_timeout": config.getfloat('Network', 'connect_timeout', fallback=5),
+        "read_timeout": config.getfloat('Network', 'read_timeout', fallback=30)
+    }
+
+
+def rate_limit_settings(config):
+    """读取配置文件中的[RateLimit]限速设置，未配置的项使用 RATE_LIMIT_DEFAULTS"""
+    settings = {}
+    for name, default in RATE_LIMIT_DEFAULTS.items():
+        getter = config.getfloat if isinstance(default, float) else config.getint
+        settings[name] = getter('RateLimit', name, fallback=default)
+    return settings
+
+
+# Key池成员的配置节前缀：[ApiKey:名称]
+API_KEY_SECTION_PREFIX = "ApiKey:"
+
+
+def create_key_pool(config, default_key="", max_tasks=None):
+    """按配置文件中的[ApiKey:名称]各节创建Key池
+
+    每节包含 api_key，以及可选的 max_tasks 和 create_qps/query_qps 等限速项（未配置的项沿用[RateLimit]）。
+    default_key（界面输入或命令行提供的Key）不在池中时以 "default" 为名加入。
+    [KeyPool] suspend_minutes 为Key返回额度类错误后暂停分配新任务的时间。
+    """
+    rates = rate_limit_settings(config)
+    if max_tasks is None:
+        max_tasks = rates["max_tasks"]
+    pool = ApiKeyPool(suspend_seconds=config.getfloat('KeyPool', 'suspend_minutes', fallback=10) * 60)
+
+    for section in config.sections():
+        if not section.startswith(API_KEY_SECTION_PREFIX):
+            continue
+        name = section[len(API_KEY_SECTION_PREFIX):].strip()
+        api_key = config.get(section, 'api_key', fallback='').strip()
+        if not name or not api_key:
+            continue
+        overrides = {}
+        for option, default in RATE_LIMIT_DEFAULTS.items():
+            if option != "max_tasks" and config.has_option(section, option):
+                getter = config.getfloat if isinstance(default, float) else config.getint
+                overrides[option] = getter(section, option)
+        pool.add(name, api_key, config.getint(section, 'max_tasks', fallback=max_tasks), **overrides)
+
+    pool.set_default(default_key, max_tasks)
+    return pool
+
+
+def download_settings(config):
+    """读取配置文件中的[Download]自动下载设置"""
+    return {
+        "enabled": config.getboolean('Download', 'enabled', fallback=True),
+        "download_dir": config.get('Download', 'dir', fallback=DOWNLOAD_DIR),
+        "max_workers": config.getint('Download', 'workers', fallback=3),
+        "max_rate": config.getint('Download', 'max_rate_kbps', fallback=0) * 1024 or None,
+        "quota": int(config.getfloat('Download', 'quota_gb', fallback=0) * 1024 ** 3) or None,
+        "max_age": config.getint('Download', 'max_age_days', fallback=0) * 86400 or None
+    }
+
+
+def upload_settings(config):
+    """读取配置文件中的[Upload]本地图片上传设置
+
+    backend 选择 IMAGE_UPLOADERS 中的上传后端，其余选项原样传给后端的构造函数。
+    """
+    options = dict(config.items('Upload')) if config.has_section('Upload') else {}
+    return {
+        "backend": options.pop("backend", "local"),
+        "max_workers": int(options.pop("workers", 4)),
+        "normalize": _parse_bool(options.pop("normalize", None)),
+        "normalize_workers": int(options.pop("normalize_workers", 0)) or None,
+        "options": options
+    }
+
+
+def create_image_ingestor(store, settings):
+    """按 upload_settings 创建上传后端和本地图片导入器"""
+    backend = IMAGE_UPLOADERS.get(settings["backend"])
+    if backend is None:
+        raise ValueError(f"未知的上传后端: {settings['backend']}（可选: {', '.join(IMAGE_UPLOADERS)}）")
+    normalizer = ImageNormalizer(max_workers=settings["normalize_workers"]) if settings["normalize"] else None
+    return ImageIngestor(store, backend(**settings["options"]), max_workers=settings["max_workers"],
+                         normalizer=normalizer)
+
+
+def create_video_downloader(store, settings, on_update=None):
+    """按 download_settings 创建本地视频库和下载器"""
+    videos = VideoStore(store, settings["download_dir"], quota=settings["quota"], max_age=settings["max_age"])
+    return VideoDownloader(videos, max_workers=settings["max_workers"], max_rate=settings["max_rate"],
+                           on_update=on_update)
+
+
+# 任务清单中允许出现的字段
+MANIFEST_FIELDS = ("job_id", "model", "prompt", "first_frame_url", "last_frame_url", "img_url",
+                   "resolution", "prompt_extend", "seed", "size")
+
+
+def _parse_bool(value, default=True):
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "y", "on")
+
+
+def iter_manifest_jobs(manifest_path):
+    """逐行读取CSV/JSONL任务清单（生成器，不会一次性加载整个文件）
+
+    每次产出 (行号, 任务字典)；无法解析的行产出 (行号, {"error": ...})。
+    """
+    is_csv = manifest_path.lower().endswith(".csv")
+
+    with open(manifest_path, "r", encoding="utf-8-sig", newline="") as f:
+        if is_csv:
+            rows = csv.DictReader(f)
+            for row in rows:
+                yield rows.line_num, {k: (v or "").strip() for k, v in row.items() if k in MANIFEST_FIELDS}
+        else:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield line_no, {"error": f"无法解析JSON: {str(e)}"}
+                    continue
+                yield line_no, {k: v for k, v in row.items() if k in MANIFEST_FIELDS}
+
+
+def build_request_from_job(job):
+    """把任务清单中的一行转换为(接口URL, 请求体)"""
+    return build_video_request(
+        model=job.get("model") or "wanx2.1-kf2v-plus",
+        prompt=job.get("prompt", ""),
+        first_frame_url=job.get("first_frame_url", ""),
+        last_frame_url=job.get("last_frame_url", ""),
+        img_url=job.get("img_url", ""),
+        resolution=job.get("resolution") or "720P",
+        prompt_extend=_parse_bool(job.get("prompt_extend")),
+        seed=job.get("seed"),
+        size=job.get("size") or "1280*720"
+    )
+
+
+def job_image_urls(job):
+    """任务引用的图片URL：kf2v为首帧和尾帧，i2v为单张图片，t2v没有"""
+    model = job.get("model") or "wanx2.1-kf2v-plus"
+    if model == "wanx2.1-kf2v-plus":
+        return [job.get("first_frame_url", ""), job.get("last_frame_url", "")]
+    if model == "wanx2.1-i2v-turbo":
+        return [job.get("img_url", "")]
+    return []
+
+
+class ImageValidator:
+    """并发检查图片URL，结果按URL缓存
+
+    检查项：可以访问、内容类型为图片、不超过10MB、宽高在360-2000像素之间。
+    只读取文件头（见 probe_image_url）。检查在最多 max_workers 个线程中进行，
+    检查中的URL重复提交直接返回同一个Future。只缓存确定的结果（通过，或4xx、格式、尺寸等不合格），
+    超时、连接错误和5xx等临时错误不缓存，下次提交时重新检查；缓存最多保留 max_entries 个最近使用的URL。
+    """
+
+    def __init__(self, max_workers=16, timeout=10, max_entries=10000):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._results = OrderedDict()  # url -> Future，结果为 (是否通过, 说明)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-check")
+
+    def submit(self, url):
+        with self._lock:
+            future = self._results.get(url)
+            if future is not None:
+                self._results.move_to_end(url)
+                return future
+
+            future = Future()
+            self._results[url] = future
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+        def run():
+            try:
+                passed, message, definitive = self._check(url)
+            except Exception as e:
+                passed, message, definitive = False, str(e), False
+            if not definitive:
+                with self._lock:
+                    if self._results.get(url) is future:
+                        del self._results[url]
+            future.set_result((passed, message))
+
+        self._executor.submit(run)
+        return future
+
+    def check(self, url):
+        """返回 (是否通过, 说明)"""
+        return self.submit(url).result()
+
+    def check_job(self, job):
+        """检查任务引用的所有图片，返回失败说明列表（全部通过时为空）"""
+        urls = job_image_urls(job)
+        futures = [(url, self.submit(url)) for url in urls if url]
+        failures = [f"{url}: {future.result()[1]}" for url, future in futures if not future.result()[0]]
+        if any(not url for url in urls):
+            failures.append("缺少图片URL")
+        return failures
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _check(self, url):
+        """返回 (是否通过, 说明, 结果是否确定)"""
+        if "drive.google.com" in url:
+            return False, "Google Drive链接不能直接用于API", True
+        try:
+            info = probe_image_url(url, timeout=self.timeout)
+        except requests.HTTPError as e:
+            response = getattr(e, "response", None)
+            status = response.status_code if response is not None else 0
+            return False, f"无法访问: {str(e)}", 400 <= status < 500 and status not in (408, 429)
+        except requests.RequestException as e:
+            return False, f"无法访问: {str(e)}", False
+        except ValueError as e:
+            return False, str(e), True
+        except Exception as e:
+            return False, str(e), False
+
+        problems = check_image_limits(info)
+        if problems:
+            return False, "；".join(problems), True
+        return True, f"{info['format']} {info['width']}x{info['height']}", True
+
+
+def prevalidate_manifest(manifest_path, validator, progress=None, ingestor=None, max_pending=256):
+    """批量提交前并发检查清单中引用的所有图片URL，返回 (图片数, 未通过数)
+
+    清单按行流式读取，URL交给 validator 检查，结果保存在其缓存中（之后入队时读取）；
+    最多同时等待 max_pending 个检查，内存占用与清单长度无关。去重只记住最近的 validator.max_entries 个URL，
+    不同URL更多时图片数可能偏大。本地图片检查上传后的URL（见 ImageIngestor）。
+    progress(已检查, 已提交检查) 在每个URL检查完成后调用。
+    """
+    seen = OrderedDict()
+    pending = deque()
+    total = done = failed = 0
+
+    def drain(limit):
+        nonlocal done, failed
+        while len(pending) > limit:
+            if not pending.popleft().result()[0]:
+                failed += 1
+            done += 1
+            if progress:
+                progress(done, total)
+
+    for _, job in iter_batch_jobs(manifest_path, ingestor):
+        if "error" in job:
+            continue
+        for url in job_image_urls(job):
+            if not url:
+                continue
+            if url in seen:
+                seen.move_to_end(url)
+                continue
+            seen[url] = None
+            if len(seen) > validator.max_entries:
+                seen.popitem(last=False)
+            total += 1
+            pending.append(validator.submit(url))
+            drain(max_pending)
+    drain(0)
+    return total, failed
+
+
+def is_local_image(value):
+    """清单或输入框中的图片是否为本地文件（本地路径或file://链接）"""
+    return bool(value) and urlsplit(value).scheme.lower() not in ("http", "https")
+
+
+def local_image_path(value, base_dir=""):
+    """把本地路径或file://链接转换为绝对路径，相对路径相对于 base_dir"""
+    if value.lower().startswith("file://"):
+        value = urlsplit(value).path
+    return os.path.abspath(os.path.join(base_dir, os.path.expanduser(value)))
+
+
+def local_image_info(path):
+    """读取本地图片文件头，返回与 probe_image_url 相同字段的字典，不是支持的图片时抛出 ValueError"""
+    with open(path, "rb") as f:
+        header = f.read(64 * 1024)
+    try:
+        parsed = parse_image_header(header)
+    except ValueError:
+        raise ValueError(f"{os.path.basename(path)} 不是支持的图片格式")
+    if parsed is None:
+        raise ValueError(f"{os.path.basename(path)} 无法读取图片尺寸")
+    image_format, width, height = parsed
+    return {"format": image_format, "width": width, "height": height, "size": os.path.getsize(path)}
+
+
+def needs_normalization(width, height, size, target=None):
+    """图片是否超出API限制，或宽高与目标尺寸 target (宽, 高) 不同"""
+    if size > IMAGE_MAX_BYTES:
+        return True
+    if min(width, height) < IMAGE_MIN_SIDE or max(width, height) > IMAGE_MAX_SIDE:
+        return True
+    return bool(target) and (width, height) != tuple(target)
+
+
+def _pad_image(img, size):
+    """把图片居中放到 size 大小的画布上（RGB补黑边，带透明通道时补透明）"""
+    canvas = Image.new(img.mode, size)
+    canvas.paste(img, ((size[0] - img.width) // 2, (size[1] - img.height) // 2))
+    return canvas
+
+
+def _fit_scale(width, height, scale=1.0):
+    """等比缩放到各边在 IMAGE_MIN_SIDE - IMAGE_MAX_SIDE 之间的缩放系数（scale 为额外的缩小系数）"""
+    scale = min(scale, IMAGE_MAX_SIDE / max(width, height))
+    if min(width, height) * scale < IMAGE_MIN_SIDE:
+        scale = min(IMAGE_MIN_SIDE / min(width, height), IMAGE_MAX_SIDE / max(width, height))
+    return scale
+
+
+def normalized_size(width, height):
+    """图片调整到API限制内后的宽高（与 _fit_image_sides 的结果相同，符合限制的图片保持原尺寸）"""
+    scale = _fit_scale(width, height)
+    return (max(round(width * scale), IMAGE_MIN_SIDE, 1), max(round(height * scale), IMAGE_MIN_SIDE, 1))
+
+
+def _fit_image_sides(img, scale=1.0):
+    """等比缩放到各边在 IMAGE_MIN_SIDE - IMAGE_MAX_SIDE 之间（scale 为额外的缩小系数），
+    宽高比过于极端无法等比满足时短边补边"""
+    scale = _fit_scale(img.width, img.height, scale)
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    if size != img.size:
+        img = img.resize(size, Image.LANCZOS)
+    if min(img.size) < IMAGE_MIN_SIDE:
+        img = _pad_image(img, (max(img.width, IMAGE_MIN_SIDE), max(img.height, IMAGE_MIN_SIDE)))
+    return img
+
+
+def _fit_to_size(img, size):
+    """等比缩放到刚好放进 size (宽, 高)，再居中补边到正好 size"""
+    scale = min(size[0] / img.width, size[1] / img.height)
+    resized = (min(size[0], max(1, round(img.width * scale))), min(size[1], max(1, round(img.height * scale))))
+    if resized != img.size:
+        img = img.resize(resized, Image.LANCZOS)
+    if img.size != tuple(size):
+        img = _pad_image(img, tuple(size))
+    return img
+
+
+def normalize_image_file(src, dst_base, target=None):
+    """把图片调整到API限制内（在进程池中执行），返回输出文件路径 dst_base + 扩展名
+
+    target 不为None时等比缩放并补边到正好 target (宽, 高)（首尾帧使用同一个目标尺寸），
+    否则等比缩放到各边在360-2000像素之间；
+    编码后超过10MB时改存为JPEG并逐步降低质量，仍然超过时继续缩小（保持宽高比）。
+    JPEG输入输出JPEG，其他格式输出PNG（保留透明通道）。
+    """
+    with Image.open(src) as source:
+        fmt = "JPEG" if source.format == "JPEG" else "PNG"
+        img = ImageOps.exif_transpose(source)
+        img.load()
+
+    if img.mode not in ("RGB", "RGBA", "L"):
+        img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+    if fmt == "JPEG" and img.mode != "RGB":
+        img = img.convert("RGB")
+
+    fitted = _fit_to_size(img, target) if target else _fit_image_sides(img)
+    scale, quality = 1.0, 95
+    while True:
+        buffer = io.BytesIO()
+        if fmt == "JPEG":
+            fitted.save(buffer, "JPEG", quality=quality, optimize=True)
+        else:
+            fitted.save(buffer, "PNG", optimize=True)
+        if buffer.tell() <= IMAGE_MAX_BYTES:
+            break
+
+        if fmt != "JPEG":
+            fmt = "JPEG"
+            img = img.convert("RGB")
+            fitted = fitted.convert("RGB")
+        elif quality > 65:
+            quality -= 10
+        else:
+            scale *= 0.8
+            if target:
+                smaller = _fit_to_size(img, (max(1, round(target[0] * scale)), max(1, round(target[1] * scale))))
+            else:
+                smaller = _fit_image_sides(img, scale)
+            if smaller.size == fitted.size:
+                raise ValueError("无法把图片压缩到10MB以内")
+            fitted = smaller
+
+    path = dst_base + (".jpg" if fmt == "JPEG" else ".png")
+    temp_path = path + ".part"
+    with open(temp_path, "wb") as f:
+        f.write(buffer.getvalue())
+    os.replace(temp_path, path)
+    return path
+
+
+class ImageNormalizer:
+    """把本地图片自动调整到API限制内：缩小、补边或重新压缩
+
+    只有超出限制（或与目标尺寸不一致）的图片才会处理。处理在进程池中进行（默认每个CPU核心一个进程，
+    第一次需要时才启动），结果按 (内容哈希, 目标参数) 缓存在 cache_dir，
+    参数相同的同一张图片只处理一次。
+    """
+
+    # 处理算法变化时修改版本号，使旧的缓存失效
+    VERSION = 2
+
+    def __init__(self, cache_dir=NORMALIZED_DIR, max_workers=None):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self._futures = {}  # 缓存键 -> Future，结果为输出路径
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def cache_key(self, sha256, target=None):
+        target = f"{target[0]}x{target[1]}" if target else ""
+        params = f"{sha256}:{target}:{IMAGE_MIN_SIDE}:{IMAGE_MAX_SIDE}:{IMAGE_MAX_BYTES}:{self.VERSION}"
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def cached(self, key):
+        for ext in (".jpg", ".png"):
+            path = os.path.join(self.cache_dir, key + ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def normalize(self, path, sha256, info, target=None):
+        """返回符合API限制的文件路径：不需要处理时为原路径，否则为缓存中的输出（等待处理完成）
+
+        target 为输出的 (宽, 高)，为None时按API限制等比调整。
+        """
+        if not needs_normalization(info["width"], info["height"], info["size"], target):
+            return path
+
+        key = self.cache_key(sha256, target)
+        cached = self.cached(key)
+        if cached:
+            return cached
+
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                if self._executor is None:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                future = self._executor.submit(normalize_image_file, path, os.path.join(self.cache_dir, key),
+                                               target)
+                self._futures[key] = future
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self._futures.pop(key, None)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+class ImageUploader:
+    """图片上传后端：把本地文件放到可公开访问的位置并返回URL
+
+    子类设置 name 并实现 upload(path, sha256)；exists(sha256, url) 用于判断之前上传的文件是否还在，
+    不在时重新上传。新的后端注册到 IMAGE_UPLOADERS 后即可在配置文件[Upload]中选用。
+    """
+
+    name = ""
+
+    def upload(self, path, sha256):
+        raise NotImplementedError
+
+    def exists(self, sha256, url):
+        return True
+
+    def check(self):
+        """检查配置能否得到API可以访问的URL，不能时抛出 ValueError（每次上传前调用）"""
+
+    def close(self):
+        pass
+
+
+def is_public_url(url):
+    """URL是否可能从公网访问：http(s)，主机不是localhost或回环、内网、未指定地址"""
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname or parts.hostname == "localhost":
+        return False
+    try:
+        return ipaddress.ip_address(parts.hostname).is_global
+    except ValueError:
+        return True  # 域名
+
+
+class _QuietFileHandler(SimpleHTTPRequestHandler):
+    """只提供已知文件名的下载：不列出目录内容，不输出访问日志"""
+
+    def list_directory(self, path):
+        self.send_error(HTTPStatus.NOT_FOUND)
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalHttpUploader(ImageUploader):
+    """本机HTTP文件服务器（代替图床）
+
+    文件按SHA-256复制到 directory，由后台 ThreadingHTTPServer 提供访问，服务器在第一次上传时启动，
+    默认只监听本机（内网穿透转发到本机即可；端口映射需要把 host 设为 0.0.0.0）。
+    DashScope需要从公网访问图片，必须把 public_url 设置为指向本服务器的公网地址，否则拒绝上传。
+    """
+
+    name = "local"
+
+    def __init__(self, directory=UPLOAD_DIR, host="127.0.0.1", port=8765, public_url=""):
+        self.directory = directory
+        self.host = host
+        self.port = int(port)
+        self.public_url = public_url.rstrip("/")
+        self._server = None
+        self._lock = threading.Lock()
+
+    def _ensure_server(self):
+        with self._lock:
+            if self._server is None:
+                os.makedirs(self.directory, exist_ok=True)
+                handler = partial(_QuietFileHandler, directory=self.directory)
+                self._server = ThreadingHTTPServer((self.host, self.port), handler)
+                self._server.daemon_threads = True
+                threading.Thread(target=self._server.serve_forever, name="upload-server", daemon=True).start()
+
+    def _filename(self, path, sha256):
+        return sha256 + (Path(path).suffix.lower() or ".img")
+
+    def check(self):
+        if not self.public_url:
+            raise ValueError("local上传后端需要在配置文件[Upload]中设置 public_url（DashScope可以从公网访问的地址，"
+                             "如端口映射或内网穿透的地址），批量模式也可用 --public-url 指定")
+        if not is_public_url(self.public_url):
+            raise ValueError(f"public_url {self.public_url} 无法从公网访问（本机或内网地址），"
+                             f"请设置为端口映射或内网穿透的公网地址")
+
+    def upload(self, path, sha256):
+        self.check()
+        self._ensure_server()
+        target = os.path.join(self.directory, self._filename(path, sha256))
+        if not os.path.exists(target):
+            temp_path = target + ".part"
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, target)
+        return f"{self.public_url}/{os.path.basename(target)}"
+
+    def exists(self, sha256, url):
+        if not self.public_url or not url.startswith(self.public_url + "/"):
+            return False
+        self._ensure_server()
+        return os.path.exists(os.path.join(self.directory, url.rsplit("/", 1)[-1]))
+
+    def close(self):
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                self._server = None
+
+
+# 可在配置文件[Upload] backend 中选用的上传后端
+IMAGE_UPLOADERS = {
+    LocalHttpUploader.name: LocalHttpUploader
+}
+
+
+def _record_upload(conn, sha256, backend, url, size):
+    conn.execute(
+        """INSERT INTO uploads (sha256, backend, url, size, uploaded_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(sha256, backend) DO UPDATE SET url = excluded.url, uploaded_at = excluded.uploaded_at""",
+        (sha256, backend, url, size, int(time.time()))
+    )
+
+
+class ImageIngestor:
+    """把本地图片文件转换为API可用的URL
+
+    每个文件先计算SHA-256，相同内容之前已通过同一后端上传过（记录在历史数据库uploads表中）时直接返回原URL，
+    否则在最多 max_workers 个线程中并发上传。同一文件只处理一次，重复提交返回同一个Future；
+    内容相同的不同文件也只上传一次。上传前会检查文件头，不是图片的文件不会上传。
+    有 normalizer 时，超出API限制的图片先调整（见 ImageNormalizer），上传调整后的文件；
+    kf2v任务的首尾帧都是本地图片时，两帧都调整到首帧调整后的尺寸（见 normalized_size）。
+    """
+
+    # 任务中可以填写本地图片的字段
+    IMAGE_FIELDS = ("first_frame_url", "last_frame_url", "img_url")
+
+    def __init__(self, history, uploader, max_workers=4, normalizer=None):
+        self.history = history
+        self.uploader = uploader
+        self.normalizer = normalizer
+        self.stats = {"uploaded": 0, "skipped": 0, "normalized": 0}
+        self._futures = {}  # (绝对路径, 目标尺寸) -> Future，结果为URL
+        self._hash_locks = {}  # sha256 -> [Lock, 等待或持有的线程数]，没有线程使用时删除
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-upload")
+
+    def submit(self, path, target=None):
+        """排队处理一个本地文件，返回Future（结果为URL）；target 为调整时的目标 (宽, 高)
+
+        上传后端配置不完整（如没有公网地址）时直接抛出 ValueError。
+        """
+        self.uploader.check()
+        key = (os.path.abspath(path), tuple(target) if self.normalizer and target else None)
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                future = self._executor.submit(self._ingest, *key)
+                self._futures[key] = future
+            return future
+
+    def ingest(self, path, target=None):
+        return self.submit(path, target).result()
+
+    def job_images(self, job, base_dir=""):
+        """任务引用的本地图片列表 [(字段, 绝对路径, 目标尺寸)]"""
+        images = [(field, local_image_path(job[field], base_dir), None)
+                  for field in self.IMAGE_FIELDS if is_local_image(job.get(field, ""))]
+        if self.normalizer and [field for field, _, _ in images] == ["first_frame_url", "last_frame_url"]:
+            try:
+                info = local_image_info(images[0][1])
+            except (OSError, ValueError):
+                return images  # 首帧本身会上传失败
+            # 首尾帧调整到同一个最终尺寸，避免首帧因极端宽高比补边后与尾帧不一致
+            target = normalized_size(info["width"], info["height"])
+            images = [(field, path, target) for field, path, _ in images]
+        return images
+
+    def submit_job(self, job, base_dir=""):
+        """排队处理任务中引用的所有本地图片，返回 {(绝对路径, 目标尺寸): Future}"""
+        return {(path, target): self.submit(path, target) for _, path, target in self.job_images(job, base_dir)}
+
+    def resolve_job(self, job, base_dir=""):
+        """返回把本地图片替换为URL后的任务（等待上传完成），上传失败时抛出异常"""
+        resolved = dict(job)
+        for field, path, target in self.job_images(job, base_dir):
+            resolved[field] = self.ingest(path, target)
+        return resolved
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        if self.normalizer:
+            self.normalizer.shutdown()
+        self.uploader.close()
+
+    def _ingest(self, path, target=None):
+        info = local_image_info(path)
+        sha256 = file_sha256(path)
+        if self.normalizer:
+            normalized = self.normalizer.normalize(path, sha256, info, target)
+            if normalized != path:
+                self._count("normalized")
+                path, sha256 = normalized, file_sha256(normalized)
+
+        with self._lock:
+            entry = self._hash_locks.setdefault(sha256, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                return self._upload_once(path, sha256)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._hash_locks[sha256]
+
+    def _upload_once(self, path, sha256):
+        """内容相同的文件只上传一次（调用方持有该sha256的锁）"""
+        row = self.history.read().execute(
+            "SELECT url FROM uploads WHERE sha256 = ? AND backend = ?", (sha256, self.uploader.name)).fetchone()
+        if row and self.uploader.exists(sha256, row[0]):
+            self._count("skipped")
+            return row[0]
+
+        url = self.uploader.upload(path, sha256)
+        self.history.submit(_record_upload, sha256, self.uploader.name, url, os.path.getsize(path)).result()
+        self._count("uploaded")
+        return url
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+
+def ingest_manifest(manifest_path, ingestor, progress=None):
+    """批量提交前并发上传清单中引用的所有本地图片，返回 (文件数, 失败数)
+
+    相对路径相对于清单所在目录；progress(已处理, 总数) 在每个文件处理完成后调用。
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    futures = {}
+    for _, job in iter_manifest_jobs(manifest_path):
+        futures.update(ingestor.submit_job(job, base_dir))
+
+    failed = 0
+    for done, future in enumerate(futures.values(), 1):
+        if future.exception() is not None:
+            failed += 1
+        if progress:
+            progress(done, len(futures))
+    return len(futures), failed
+
+
+def iter_batch_jobs(manifest_path, ingestor=None):
+    """逐行读取任务清单，有导入器时把本地图片替换为上传后的URL
+
+    上传失败的任务产出 {"error": ...}，与无法解析的行一样记为INVALID。
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    for line_no, job in iter_manifest_jobs(manifest_path):
+        if ingestor is not None and "error" not in job:
+            try:
+                job = ingestor.resolve_job(job, base_dir)
+            except Exception as e:
+                job = dict(job, error=f"上传本地图片失败: {str(e)}")
+        yield line_no, job
+
+
+class EngineTask:
+    """异步引擎中的单个任务：状态、取消令牌和结果future"""
+
+    def __init__(self, key, api_url, request_body, loop, context=None):
+        self.key = key  # 调用方提供的唯一标识（如清单行号）
+        self.model = (request_body or {}).get("model", "")
+        self.resolution = request_resolution(request_body)
+        self.api_url = api_url
+        self.request_body = request_body
+        self.context = context  # 调用方附带的任意数据
+        self.task_id = None
+        self.pooled_key = None  # 创建（或接着轮询）该任务的Key池成员
+        self.state = "queued"  # queued -> submitting -> submitted -> PENDING/RUNNING -> 终态
+        self.video_url = ""
+        self.error = ""
+        self.response_data = None
+        self.cancel_event = asyncio.Event()
+        self.result = loop.create_future()
+
+    def cancel(self):
+        """取消该任务的本地轮询（不会取消服务端任务）"""
+        self.cancel_event.set()
+
+    @property
+    def done(self):
+        return self.result.done()
+
+
+class AsyncTaskEngine:
+    """基于asyncio的任务引擎，可同时跟踪任意数量的DashScope任务
+
+    HTTP请求在有限的线程池中执行，轮询间隔的等待全部交给事件循环，
+    因此几十上百个任务并行时也只占用少量线程。
+    每个任务有独立的取消令牌，取消一个任务不会影响其他任务。
+    新任务由Key池（ApiKeyPool）分配API Key，任务结束前一直占用该Key的一个任务名额，
+    所有Key都没有名额时等待其他任务结束；等待名额、令牌和退避期间都会响应取消。
+    批量模式使用该引擎；界面中的任务由按钮逐个触发，在后台线程中提交，由线程版的 PollScheduler 轮询。
+    """
+
+    def __init__(self, keys, max_workers=16, policy=None, max_wait=None, on_update=None):
+        self.keys = keys
+        self.policy = policy or PollingPolicy()
+        self.max_wait = max_wait  # 为None时使用策略给出的按模型最长等待时间
+        self.on_update = on_update  # on_update(task)，任务状态变化时在事件循环中调用
+        self.tasks = {}  # key -> EngineTask
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dashscope")
+        self._runners = set()
+
+    def submit(self, key, api_url, request_body, context=None):
+        """创建任务并开始轮询，返回EngineTask（须在事件循环中调用）"""
+        return self._start(EngineTask(key, api_url, request_body, asyncio.get_running_loop(), context))
+
+    def attach(self, key, task_id, model="", resolution="", context=None, key_name=None):
+        """跟踪一个已经创建的任务，只轮询不提交；key_name 为创建该任务的Key池成员名称"""
+        task = EngineTask(key, None, None, asyncio.get_running_loop(), context)
+        task.task_id = task_id
+        task.pooled_key = self.keys.claim(key_name)
+        task.model = model
+        task.resolution = resolution
+        task.state = "submitted"
+        return self._start(task)
+
+    def cancel(self, key):
+        task = self.tasks.get(key)
+        if task:
+            task.cancel()
+
+    def cancel_all(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+    async def join(self):
+        """等待所有任务结束"""
+        while self._runners:
+            await asyncio.gather(*list(self._runners), return_exceptions=True)
+
+    async def close(self):
+        """取消所有未完成的任务并释放线程池"""
+        self.cancel_all()
+        await self.join()
+        self._executor.shutdown(wait=False)
+
+    def _start(self, task):
+        self.tasks[task.key] = task
+        runner = asyncio.get_running_loop().create_task(self._run(task))
+        self._runners.add(runner)
+        runner.add_done_callback(self._runners.discard)
+        return task
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args))
+
+    def _set_state(self, task, state):
+        task.state = state
+        if self.on_update:
+            try:
+                self.on_update(task)
+            except Exception as e:
+                print(f"任务状态回调失败: {str(e)}")
+
+    def _finish(self, task, state, error=""):
+        task.error = error
+        self._set_state(task, state)
+        self.tasks.pop(task.key, None)
+        if not task.result.done():
+            task.result.set_result(task)
+
+    async def _run(self, task):
+        try:
+            if task.task_id is None:
+                await self._create(task)
+            if not task.done:
+                await self._poll(task)
+        except Exception as e:
+            self._finish(task, "ERROR", str(e))
+        finally:
+            if task.pooled_key is not None:
+                self.keys.release(task.pooled_key)
+
+    async def _cancelled_within(self, task, delay):
+        """等待 delay 秒，期间收到取消信号（或已经取消）时返回True"""
+        if task.cancel_event.is_set():
+            return True
+        try:
+            await asyncio.wait_for(task.cancel_event.wait(), timeout=max(delay, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _create(self, task):
+        self._set_state(task, "submitting")
+        while True:
+            if task.cancel_event.is_set():
+                self._finish(task, "CANCELLED")
+                return
+
+            key = self.keys.acquire(task.api_url)
+            if key is None:
+                if not len(self.keys):
+                    raise NoAvailableKeyError("没有配置API Key")
+                await self._cancelled_within(task, self.keys.retry_in())
+                continue
+
+            # 令牌在事件循环中等待，不占用线程池；熔断器断开时换用其他Key或稍后再试
+            limiter = api_limiter(key.api_key, task.api_url, "create")
+            if await self._cancelled_within(task, limiter.reserve()):
+                self.keys.release(key)
+                continue
+            try:
+                response = await self._call(create_video_task, key.api_key, task.api_url, task.request_body,
+                                            True)
+            except CircuitOpenError as e:
+                self.keys.release(key)
+                await self._cancelled_within(task, min(e.retry_in, 1.0))
+                continue
+            except Exception:
+                self.keys.release(key)
+                raise
+
+            if classify_response(response) == "quota":
+                # 额度不足：暂停该Key，换下一个Key重新提交
+                self.keys.suspend(key, describe_create_error(response))
+                self.keys.release(key)
+                continue
+            task.pooled_key = key
+            break
+
+        if response.status_code not in [200, 201, 202]:
+            self._finish(task, "CREATE_FAILED", describe_create_error(response))
+            return
+
+        try:
+            task.response_data = response.json()
+            task.task_id = task.response_data["output"]["task_id"]
+        except (ValueError, KeyError):
+            self._finish(task, "CREATE_FAILED", "响应中没有任务ID")
+            return
+
+        self._set_state(task, "submitted")
+
+    async def _poll(self, task):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + (self.max_wait or self.policy.deadline(task.model, task.resolution))
+        task_status = ""
+        pending_checks = 0
+
+        while True:
+            delay = self.policy.next_delay(task.model, task.resolution, loop.time() - started,
+                                           task_status, pending_checks)
+
+            # 等待轮询间隔和查询令牌，期间收到取消信号则立即结束
+            api_key = task.pooled_key.api_key
+            if (await self._cancelled_within(task, delay) or
+                    await self._cancelled_within(task, api_limiter(api_key, TASK_STATUS_URL, "query").reserve())):
+                self._finish(task, "CANCELLED")
+                return
+
+            try:
+                response = await self._call(query_task, api_key, task.task_id, True)
+            except Exception as e:
+                task.error = f"检查任务状态时发生错误: {str(e)}"
+                response = None
+
+            if response is not None and response.status_code == 200:
+                task.response_data = response.json()
+                task_status, video_url, error_info = parse_task_response(task.response_data)
+                task.video_url = video_url
+
+                if task_status in TERMINAL_STATUSES:
+                    self._finish(task, task_status, error_info)
+                    return
+
+                pending_checks = pending_checks + 1 if task_status == "PENDING" else 0
+                task.error = ""
+                self._set_state(task, task_status or "PENDING")
+            elif response is not None:
+                task.error = f"查询任务状态失败: HTTP {response.status_code}"
+
+            if loop.time() > deadline:
+                self._finish(task, "TIMEOUT", "超过最长等待时间")
+                return
+
+
+class PolledTask:
+    """轮询调度器中的单个任务记录（__slots__保持每条记录的内存占用很小）"""
+
+    __slots__ = ("due", "seq", "task_id", "api_key", "model", "resolution", "started", "deadline",
+                 "task_status", "pending_checks", "cancelled", "context", "callback")
+
+    def __init__(self, seq, task_id, api_key, model, resolution, started, deadline, context, callback):
+        self.due = started
+        self.seq = seq
+        self.task_id = task_id
+        self.api_key = api_key
+        self.model = model
+        self.resolution = resolution
+        self.started = started
+        self.deadline = deadline
+        self.task_status = ""
+        self.pending_checks = 0
+        self.cancelled = False
+        self.context = context
+        self.callback = callback
+
+    def __lt__(self, other):
+        return (self.due, self.seq) < (other.due, other.seq)
+
+
+class PollScheduler:
+    """单线程轮询调度器
+
+    所有待轮询任务按下次检查时间放在一个最小堆中，由一个调度线程取出到期任务，
+    交给有界线程池执行状态查询，未结束的任务按轮询策略重新入堆。
+    线程数固定为 1 + max_workers，与跟踪的任务数量无关。
+
+    回调在工作线程中执行：callback(record, event, payload)，event 取值：
+      "status"     payload 为解析后的响应字典
+      "http_error" payload 为HTTP响应
+      "error"      payload 为错误信息
+      "timeout"    超过最长等待时间，payload 为 None
+    """
+
+    def __init__(self, policy=None, max_workers=8):
+        self.policy = policy or PollingPolicy()
+        self._heap = []
+        self._tasks = {}  # task_id -> PolledTask
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="poll")
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="poll-scheduler", daemon=True)
+        self._thread.start()
+
+    def add(self, task_id, api_key, model="", resolution="", context=None, callback=None):
+        """开始轮询任务；同一task_id已在轮询时替换旧记录"""
+        now = time.time()
+        with self._cond:
+            old = self._tasks.get(task_id)
+            if old:
+                old.cancelled = True
+
+            record = PolledTask(next(self._seq), task_id, api_key, model, resolution, now,
+                                now + self.policy.deadline(model, resolution), context, callback)
+            record.due = now + self.policy.next_delay(model, resolution, 0)
+            self._tasks[task_id] = record
+            heapq.heappush(self._heap, record)
+            self._cond.notify()
+        return record
+
+    def cancel(self, task_id):
+        """停止轮询任务，返回是否确实取消了一个任务"""
+        with self._cond:
+            record = self._tasks.pop(task_id, None)
+            if record:
+                # 堆中的记录在出堆时跳过，避免O(n)删除
+                record.cancelled = True
+            return record is not None
+
+    def __contains__(self, task_id):
+        with self._cond:
+            return task_id in self._tasks
+
+    def __len__(self):
+        with self._cond:
+            return len(self._tasks)
+
+    def shutdown(self):
+        with self._cond:
+            self._stopped = True
+            for record in self._tasks.values():
+                record.cancelled = True
+            self._tasks.clear()
+            self._cond.notify()
+        self._executor.shutdown(wait=False)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    # 清理堆顶已取消的记录
+                    while self._heap and self._heap[0].cancelled:
+                        heapq.heappop(self._heap)
+
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+
+                    wait = self._heap[0].due - time.time()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+
+                if self._stopped:
+                    return
+                record = heapq.heappop(self._heap)
+
+            # 线程池满时在此等待，避免请求突发和无界排队
+            self._slots.acquire()
+            try:
+                self._executor.submit(self._check, record)
+            except RuntimeError:
+                self._slots.release()
+                return
+
+    def _check(self, record):
+        try:
+            if record.cancelled:
+                return
+
+            retry_in = 0
+            try:
+                response = query_task(record.api_key, record.task_id)
+                response_data = None
+                if response.status_code == 200:
+                    # 正文不是有效JSON（如被截断）时与网络错误一样通知并按计划重试
+                    response_data = response.json()
+                    if not isinstance(response_data, dict):
+                        raise ValueError("响应不是JSON对象")
+            except CircuitOpenError as e:
+                retry_in = e.retry_in
+                self._notify(record, "error", str(e))
+            except Exception as e:
+                self._notify(record, "error", str(e))
+            else:
+                if response_data is not None:
+                    record.task_status, _, _ = parse_task_response(response_data)
+                    if record.task_status == "PENDING":
+                        record.pending_checks += 1
+                    else:
+                        record.pending_checks = 0
+                    if record.task_status in TERMINAL_STATUSES:
+                        self._drop(record)
+                        self._notify(record, "status", response_data)
+                        return
+                    self._notify(record, "status", response_data)
+                else:
+                    self._notify(record, "http_error", response)
+
+            now = time.time()
+            if now > record.deadline:
+                self._drop(record)
+                self._notify(record, "timeout", None)
+                return
+
+            with self._cond:
+                if record.cancelled:
+                    return
+                record.due = now + max(retry_in, self.policy.next_delay(
+                    record.model, record.resolution, now - record.started, record.task_status,
+                    record.pending_checks))
+                heapq.heappush(self._heap, record)
+                self._cond.notify()
+        finally:
+            self._slots.release()
+
+    def _drop(self, record):
+        with self._cond:
+            if self._tasks.get(record.task_id) is record:
+                del self._tasks[record.task_id]
+
+    def _notify(self, record, event, payload):
+        if record.callback and not record.cancelled:
+            try:
+                record.callback(record, event, payload)
+            except Exception as e:
+                print(f"轮询回调失败: {str(e)}")
+
+
+class DownloadError(Exception):
+    """视频下载失败（retry 表示是否值得稍后重试）"""
+
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+
+class BandwidthLimiter:
+    """多个下载共享的带宽上限（令牌桶，字节/秒；rate为0或None时不限速）"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._allowance = rate or 0
+        self._last = time.monotonic()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            # 先记账再睡眠，多个线程同时超额时依次排在后面
+            self._allowance -= amount
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def video_url_expiry(video_url, response_data=None):
+    """估算视频URL的过期时间（epoch秒）
+
+    OSS签名URL的 Expires 参数即过期时间；没有时按任务结束时间（或当前时间）加24小时。
+    """
+    try:
+        return int(parse_qs(urlsplit(video_url).query)["Expires"][0])
+    except (KeyError, IndexError, ValueError):
+        pass
+    output = (response_data or {}).get("output") or {}
+    end_time = api_timestamp(output.get("end_time"))
+    return (end_time or time.time()) + VIDEO_URL_TTL
+
+
+def expected_md5(headers):
+    """从响应头取文件的MD5（Content-MD5，或OSS普通上传对象的ETag），没有时返回None"""
+    content_md5 = headers.get("Content-MD5")
+    if content_md5:
+        try:
+            return base64.b64decode(content_md5).hex()
+        except ValueError:
+            return None
+    etag = (headers.get("ETag") or "").strip('"').lower()
+    if re.fullmatch(r"[0-9a-f]{32}", etag) and "x-oss-server-side-encryption" not in headers:
+        return etag
+    return None
+
+
+def _content_range_total(value):
+    """解析 Content-Range: bytes 100-199/1000，返回 (起始位置, 总大小)"""
+    match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", value or "")
+    if not match:
+        return None, None
+    total = match.group(2)
+    return int(match.group(1)), (int(total) if total != "*" else None)
+
+
+def download_file(url, path, limiter=None, chunk_size=256 * 1024, cancelled=None, progress=None):
+    """分块流式下载到 path，支持断点续传，返回 (字节数, SHA-256)
+
+    数据先写入 path + ".part"，已有的部分文件通过Range请求续传；
+    完成后校验总大小和MD5（服务端提供时），通过后再改名为 path。
+    cancelled() 返回True时中止下载并保留部分文件；progress(已下载, 总大小) 每块调用一次。
+    """
+    part_path = path + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    # 续传时的字节偏移基于未压缩的原始内容
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+
+    with http_client().get(url, headers=headers, stream=True) as response:
+        if response.status_code == 416:
+            # 部分文件与服务器上的文件不一致，下次从头下载
+            os.remove(part_path)
+            raise DownloadError("续传位置无效，将重新下载")
+        if response.status_code in (403, 404):
+            raise DownloadError(f"HTTP {response.status_code}（链接可能已过期）", retry=False)
+        if response.status_code == 206:
+            start, total = _content_range_total(response.headers.get("Content-Range"))
+            if start != offset:
+                os.remove(part_path)
+                raise DownloadError("服务器返回的续传位置不正确，将重新下载")
+        elif response.status_code == 200:
+            offset = 0
+            length = response.headers.get("Content-Length")
+            total = int(length) if length and length.isdigit() else None
+        else:
+            raise DownloadError(f"HTTP {response.status_code}")
+
+        # 续传时先把已下载部分计入校验和
+        if offset:
+            with open(part_path, "rb") as f:
+                for block in iter(partial(f.read, 1024 * 1024), b""):
+                    sha256.update(block)
+                    md5.update(block)
+
+        done = offset
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(chunk_size):
+                if cancelled and cancelled():
+                    raise DownloadError("下载已取消", retry=False)
+                if limiter:
+                    limiter.consume(len(chunk))
+                f.write(chunk)
+                sha256.update(chunk)
+                md5.update(chunk)
+                done += len(chunk)
+                if progress:
+                    progress(done, total)
+
+        checksum = expected_md5(response.headers)
+
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        raise DownloadError(f"文件大小不完整: {size}/{total} 字节")
+    if checksum and md5.hexdigest() != checksum:
+        os.remove(part_path)
+        raise DownloadError("MD5校验失败，将重新下载")
+
+    os.replace(part_path, path)
+    return size, sha256.hexdigest()
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(partial(f.read, 1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _add_video(conn, root, task_id, temp_path, size, sha256, quota, max_age):
+    """把下载完成的文件移入视频库并登记（在写线程中执行），返回视频库中的路径
+
+    文件移动和索引更新都在写线程中进行，不会与淘汰操作交错。
+    文件在登记前移入（提交后索引指向的文件一定存在），事务回滚时移回原处；重复的临时文件在提交后删除。
+    """
+    path = os.path.join(root, sha256[:2], sha256 + ".mp4")
+    if os.path.exists(path):
+        # 相同内容已在库中
+        conn.on_commit.append(partial(os.remove, temp_path))
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        conn.on_rollback.append(partial(os.replace, path, temp_path))
+
+    now = int(time.time())
+    conn.execute(
+        """INSERT INTO videos (sha256, size, created_at, last_access) VALUES (?, ?, ?, ?)
+        ON CONFLICT(sha256) DO UPDATE SET size = excluded.size, last_access = excluded.last_access""",
+        (sha256, size, now, now)
+    )
+    conn.execute(
+        "UPDATE history SET local_path = ?, video_size = ?, video_sha256 = ?, updated_at = ? WHERE task_id = ?",
+        (path, size, sha256, now, task_id)
+    )
+    _evict_videos(conn, root, quota, max_age, keep=sha256)
+    return path
+
+
+def _evict_videos(conn, root, quota=None, max_age=None, keep=None):
+    """按最近访问时间淘汰未固定的视频，直到不超过配额且没有超过保留时间的视频
+
+    返回被淘汰视频的哈希列表。被淘汰视频的历史记录保留哈希，清空本地路径。
+    文件在事务提交后才删除，回滚时文件和索引都保持原样。
+    """
+    evicted = []
+
+    def remove_file(sha256):
+        # 同一批写操作中可能又登记了相同内容的视频，此时保留文件
+        if conn.execute("SELECT 1 FROM videos WHERE sha256 = ?", (sha256,)).fetchone():
+            return
+        try:
+            os.remove(os.path.join(root, sha256[:2], sha256 + ".mp4"))
+        except FileNotFoundError:
+            pass
+
+    def evict(sha256):
+        conn.on_commit.append(partial(remove_file, sha256))
+        conn.execute("DELETE FROM videos WHERE sha256 = ?", (sha256,))
+        conn.execute("UPDATE history SET local_path = NULL WHERE video_sha256 = ?", (sha256,))
+        evicted.append(sha256)
+
+    if max_age:
+        cutoff = int(time.time()) - max_age
+        rows = conn.execute(
+            "SELECT sha256 FROM videos WHERE pinned = 0 AND last_access < ? ORDER BY last_access",
+            (cutoff,)
+        ).fetchall()
+        for (sha256,) in rows:
+            if sha256 != keep:
+                evict(sha256)
+
+    if quota:
+        total = conn.execute("SELECT total_size FROM video_usage").fetchone()[0]
+        while total > quota:
+            rows = conn.execute(
+                "SELECT sha256, size FROM videos WHERE pinned = 0 AND sha256 IS NOT ? ORDER BY last_access LIMIT 50",
+                (keep,)
+            ).fetchall()
+            if not rows:
+                break
+            for sha256, size in rows:
+                if total <= quota:
+                    break
+                evict(sha256)
+                total -= size
+
+    return evicted
+
+
+def _touch_video(conn, sha256):
+    conn.execute("UPDATE videos SET last_access = ? WHERE sha256 = ?", (int(time.time()), sha256))
+
+
+def _pin_video(conn, sha256, pinned):
+    conn.execute("UPDATE videos SET pinned = ? WHERE sha256 = ?", (1 if pinned else 0, sha256))
+
+
+class VideoStore:
+    """按内容寻址的本地视频库
+
+    视频按SHA-256保存为 <root>/<哈希前两位>/<哈希>.mp4，相同内容只保存一份，
+    历史记录通过 video_sha256 关联。索引（大小、最近访问时间、是否固定）和总占用空间
+    保存在历史数据库中，查找和配额检查只读索引，不扫描目录。
+    超过配额 quota（字节）或超过保留时间 max_age（秒）时，按最近访问时间淘汰未固定的视频。
+    """
+
+    def __init__(self, history, root=DOWNLOAD_DIR, quota=None, max_age=None):
+        self.history = history
+        self.root = root
+        self.quota = quota
+        self.max_age = max_age
+
+    @property
+    def incoming_dir(self):
+        """下载中的临时文件目录（与视频库在同一文件系统，完成后直接改名移入）"""
+        return os.path.join(self.root, "incoming")
+
+    def path_for(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256 + ".mp4")
+
+    def add(self, task_id, temp_path, size, sha256):
+        """把下载完成的文件移入视频库并关联到任务，返回Future（结果为库中的路径）"""
+        return self.history.submit(_add_video, self.root, task_id, temp_path, size, sha256, self.quota,
+                                   self.max_age)
+
+    def lookup(self, sha256):
+        """返回视频在库中的路径（按主键查找索引），不在库中时返回None"""
+        row = self.history.read().execute("SELECT 1 FROM videos WHERE sha256 = ?", (sha256,)).fetchone()
+        path = self.path_for(sha256)
+        return path if row and os.path.exists(path) else None
+
+    def touch(self, sha256):
+        """记录一次访问（淘汰时最近访问的视频最后被删除）"""
+        self.history.submit(_touch_video, sha256).add_done_callback(_log_write_error)
+
+    def pin(self, sha256, pinned=True):
+        """固定的视频不会被淘汰"""
+        return self.history.submit(_pin_video, sha256, pinned)
+
+    def is_pinned(self, sha256):
+        row = self.history.read().execute("SELECT pinned FROM videos WHERE sha256 = ?", (sha256,)).fetchone()
+        return bool(row and row[0])
+
+    def usage(self):
+        """返回 (总字节数, 视频数)"""
+        return self.history.read().execute("SELECT total_size, video_count FROM video_usage").fetchone()
+
+    def evict(self):
+        """立即按配额和保留时间执行一次淘汰，返回Future（结果为被淘汰的哈希列表）"""
+        return self.history.submit(_evict_videos, self.root, self.quota, self.max_age)
+
+
+class DownloadJob:
+    """下载队列中的单个视频（按URL过期时间排序）"""
+
+    __slots__ = ("expires", "seq", "task_id", "video_url", "path", "attempts", "cancelled")
+
+    def __init__(self, seq, task_id, video_url, path, expires):
+        self.expires = expires
+        self.seq = seq
+        self.task_id = task_id
+        self.video_url = video_url
+        self.path = path
+        self.attempts = 0
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.expires, self.seq) < (other.expires, other.seq)
+
+
+class VideoDownloader:
+    """成功任务的视频自动下载
+
+    待下载视频按URL过期时间放在最小堆中，max_workers 个下载线程总是先取最早过期的视频，
+    所有下载共享 max_rate（字节/秒）的带宽上限。失败的下载保留部分文件，
+    退避后从断点续传；完成后移入视频库 videos（VideoStore）并关联到历史记录。
+
+    on_update(job, event, payload) 在下载线程中调用，event 取值：
+      "progress" payload 为 (已下载, 总大小)
+      "done"     payload 为本地路径
+      "error"    payload 为错误信息（不再重试）
+    """
+
+    def __init__(self, videos, max_workers=3, max_rate=None, max_attempts=5, on_update=None):
+        self.videos = videos
+        self.max_attempts = max_attempts
+        self.on_update = on_update
+        self.limiter = BandwidthLimiter(max_rate)
+        self._heap = []
+        self._jobs = {}  # task_id -> DownloadJob（排队、下载中或等待重试）
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._run, name=f"download-{i}", daemon=True)
+                         for i in range(max_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def add(self, task_id, video_url, response_data=None):
+        """把成功任务的视频加入下载队列；同一任务已在队列中时忽略"""
+        with self._cond:
+            if task_id in self._jobs or self._stopped:
+                return self._jobs.get(task_id)
+            job = DownloadJob(next(self._seq), task_id, video_url,
+                              os.path.join(self.videos.incoming_dir, f"{task_id}.mp4"),
+                              video_url_expiry(video_url, response_data))
+            self._jobs[task_id] = job
+            heapq.heappush(self._heap, job)
+            self._cond.notify()
+        return job
+
+    def resume_pending(self):
+        """把历史记录中尚未下载、URL可能仍有效的视频加入队列（启动时调用）"""
+        rows = fetch_pending_downloads(self.videos.history.read())
+        for task_id, video_url, response_json in rows:
+            try:
+                response_data = json.loads(unpack_json(response_json) or "{}")
+            except ValueError:
+                response_data = None
+            self.add(task_id, video_url, response_data)
+        return len(rows)
+
+    def cancel(self, task_id):
+        with self._cond:
+            job = self._jobs.pop(task_id, None)
+            if job:
+                job.cancelled = True
+            self._cond.notify_all()
+            return job is not None
+
+    def __contains__(self, task_id):
+        with self._cond:
+            return task_id in self._jobs
+
+    def __len__(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def join(self, timeout=None):
+        """等待队列中的下载全部结束，返回是否在超时前完成"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while self._jobs and not self._stopped:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return not self._jobs
+
+    def shutdown(self):
+        """停止下载；进行中的下载保留部分文件，下次启动时续传"""
+        with self._cond:
+            self._stopped = True
+            for job in self._jobs.values():
+                job.cancelled = True
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    while self._heap and self._heap[0].cancelled:
+                        heapq.heappop(self._heap)
+                    if self._heap:
+                        break
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                job = heapq.heappop(self._heap)
+
+            self._download(job)
+
+    def _download(self, job):
+        job.attempts += 1
+        try:
+            if job.expires < time.time():
+                raise DownloadError("视频链接已过期", retry=False)
+
+            os.makedirs(self.videos.incoming_dir, exist_ok=True)
+            if os.path.exists(job.path):
+                # 上次已下载完成但未移入视频库
+                size, sha256 = os.path.getsize(job.path), file_sha256(job.path)
+            else:
+                size, sha256 = download_file(job.video_url, job.path, self.limiter,
+                                             cancelled=lambda: job.cancelled,
+                                             progress=lambda done, total: self._notify(job, "progress",
+                                                                                       (done, total)))
+        except Exception as e:
+            if job.cancelled:
+                return
+            retry = getattr(e, "retry", True) and job.attempts < self.max_attempts
+            if retry:
+                # 退避后重新入堆，从部分文件续传
+                delay = min(60, 2 ** job.attempts)
+                print(f"下载 {job.task_id} 失败（第{job.attempts}次）: {str(e)}，{delay}秒后重试")
+                timer = threading.Timer(delay, self._requeue, (job,))
+                timer.daemon = True
+                timer.start()
+                return
+            self._finish(job)
+            self._notify(job, "error", str(e))
+            return
+
+        try:
+            path = self.videos.add(job.task_id, job.path, size, sha256).result()
+        except Exception as e:
+            self._finish(job)
+            self._notify(job, "error", f"保存到视频库失败: {str(e)}")
+            return
+
+        self._finish(job)
+        self._notify(job, "done", path)
+
+    def _requeue(self, job):
+        with self._cond:
+            if job.cancelled or self._stopped:
+                return
+            heapq.heappush(self._heap, job)
+            self._cond.notify()
+
+    def _finish(self, job):
+        with self._cond:
+            if self._jobs.get(job.task_id) is job:
+                del self._jobs[job.task_id]
+            self._cond.notify_all()
+
+    def _notify(self, job, event, payload):
+        if self.on_update and not job.cancelled:
+            try:
+                self.on_update(job, event, payload)
+            except Exception as e:
+                print(f"下载回调失败: {str(e)}")
+
+
+def run_batch(manifest_path, output_path, keys, db_file=DB_FILE, max_in_flight=50, max_wait=None,
+              download=None, check_images=True, validate_only=False, image_check_workers=16, upload=None,
+              force=False):
+    """无界面批量执行任务清单
+
+    清单按行流式读取，最多同时保持 max_in_flight 个任务在处理中，
+    每个任务到达终态后立即把结果追加写入 output_path（JSONL）。
+    download 为下载设置（见 download_settings）时，成功任务的视频自动下载到本地视频库，
+    全部任务结束后等待下载完成再返回；为None时不下载。
+    check_images 为True时，提交前先并发检查所有引用的图片，图片不合格的任务不提交，
+    结果记为 INVALID_IMAGE；validate_only 为True时只检查图片，每个任务输出 PASS/FAIL。
+    upload 为上传设置（见 upload_settings）时，清单中的本地图片先并发上传，再用上传后的URL提交；
+    为None时不处理本地图片。
+    请求与历史记录中已成功或仍在处理中的任务相同（见 request_fingerprint）时不重新提交：
+    成功的任务直接输出原结果（reused 为true），处理中的任务接着轮询。force 为True时总是提交新任务。
+    清单中的任务按请求指纹保存在持久化队列中（见 JobQueue），请求相同的行共用同一个任务：
+    中断或崩溃后用同一清单（即使中间插入或删除了行）重新运行，已结束的请求不再重复，
+    已提交的任务接着轮询，未提交的任务继续提交；上次运行已全部结束时重新开始。
+    keys 为Key池（见 create_key_pool），新任务分配给负载最低的健康Key，
+    每个Key同时在服务端处理中的任务数受其 max_tasks 限制（创建和查询的限速见 api_limiter）。
+    """
+    store = HistoryStore(db_file)
+    ingestor = None
+    validator = None
+
+    try:
+        if upload is not None:
+            ingestor = create_image_ingestor(store, upload)
+            total, failed = ingest_manifest(
+                manifest_path, ingestor,
+                progress=lambda done, total: print(f"\r已处理本地图片 {done}/{total}", end="", flush=True))
+            if total:
+                print(f"\n本地图片: 共 {total} 个，调整 {ingestor.stats['normalized']} 个，"
+                      f"上传 {ingestor.stats['uploaded']} 个，已上传过 {ingestor.stats['skipped']} 个，失败 {failed} 个")
+
+        if check_images or validate_only:
+            validator = ImageValidator(max_workers=image_check_workers)
+            total, failed = prevalidate_manifest(
+                manifest_path, validator,
+                progress=lambda done, total: print(f"\r已检查图片 {done}/{total}", end="", flush=True),
+                ingestor=ingestor)
+            print(f"\n图片检查完成: 共 {total} 个，未通过 {failed} 个")
+
+        if validate_only:
+            return _validate_manifest_jobs(manifest_path, output_path, validator, ingestor)
+
+        return _submit_manifest_jobs(manifest_path, output_path, keys, store, max_in_flight, max_wait,
+                                     download, validator, ingestor, force)
+    finally:
+        if validator:
+            validator.shutdown()
+        if ingestor:
+            ingestor.shutdown()
+        store.close(timeout=30)
+
+
+def run_reconcile(keys, db_file=DB_FILE, download=None):
+    """无界面对账：更新历史记录中所有未完成任务的状态，download 不为None时下载新成功的视频并等待完成"""
+    store = HistoryStore(db_file)
+    downloaded = [0]
+    downloader = None
+    try:
+        if download is not None:
+            def on_download(job, event, payload):
+                if event == "done":
+                    downloaded[0] += 1
+                    print(f"已下载 {job.task_id} -> {payload}")
+                elif event == "error":
+                    print(f"下载 {job.task_id} 失败: {payload}")
+
+            downloader = create_video_downloader(store, download, on_update=on_download)
+
+        counts = reconcile_tasks(store, keys, downloader, progress=lambda done, total: print(
+            f"\r已查询 {done}/{total} 个任务", end="", flush=True))
+        if counts["checked"]:
+            print()
+        if downloader:
+            if len(downloader):
+                print(f"等待 {len(downloader)} 个视频下载完成...")
+            downloader.join()
+        counts["downloaded"] = downloaded[0]
+        return counts
+    finally:
+        if downloader:
+            downloader.shutdown()
+        store.close(timeout=30)
+
+
+def _submit_manifest_jobs(manifest_path, output_path, keys, store, max_in_flight, max_wait, download,
+                          validator, ingestor, force=False):
+    """提交清单中的任务并等待全部结束（以及视频下载完成），返回计数"""
+    counts = {"submitted": 0, "succeeded": 0, "failed": 0, "downloaded": 0, "reused": 0, "resumed": 0}
+    policy = PollingPolicy.from_history(store)
+    jobs = JobQueue(store)
+
+    downloader = None
+    if download is not None:
+        def on_download(job, event, payload):
+            if event == "done":
+                counts["downloaded"] += 1
+                print(f"已下载 {job.task_id} -> {payload}")
+            elif event == "error":
+                print(f"下载 {job.task_id} 失败: {payload}")
+
+        downloader = create_video_downloader(store, download, on_update=on_download)
+
+    try:
+        with open(output_path, "a", encoding="utf-8") as out:
+            asyncio.run(_run_batch_async(manifest_path, out, keys, store, jobs, max_in_flight,
+                                         policy, max_wait, counts, downloader, validator, ingestor, force))
+        if downloader:
+            if len(downloader):
+                print(f"等待 {len(downloader)} 个视频下载完成...")
+            downloader.join()
+    finally:
+        # 中断退出时归还未完成任务的租约，重新运行同一清单时立即继续
+        jobs.close()
+        if downloader:
+            downloader.shutdown()
+
+    return counts
+
+
+def _validate_manifest_jobs(manifest_path, output_path, validator, ingestor=None):
+    """只检查图片：为每个任务写一行 PASS/FAIL 结果，不提交任务"""
+    counts = {"passed": 0, "failed": 0}
+    with open(output_path, "a", encoding="utf-8") as out:
+        for line_no, job in iter_batch_jobs(manifest_path, ingestor):
+            failures = [job["error"]] if "error" in job else validator.check_job(job)
+            status = "FAIL" if failures else "PASS"
+            counts["passed" if status == "PASS" else "failed"] += 1
+            result = {"line": line_no, "job_id": job.get("job_id", ""), "model": job.get("model", ""),
+                      "status": status, "error": "; ".join(failures)}
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+    return counts
+
+
+def _enqueue_manifest_jobs(manifest_path, jobs, source, validator=None, ingestor=None, chunk_size=500,
+                           on_invalid=None):
+    """把清单中的任务按请求指纹加入持久化队列，已在队列中的请求（上次运行加入的）跳过
+
+    请求相同的行共用一个任务（行号记在 context 的 lines 中）。无效的行（图片不合格、参数错误）
+    没有请求指纹，按行号直接记为failed，每批写入后交给 on_invalid(任务) 输出。返回新加入的任务数。
+    """
+    added = 0
+
+    def flush(rows):
+        nonlocal added
+        for row, job_id in zip(rows, jobs.enqueue_many(rows).result()):
+            if job_id is None:
+                continue
+            added += 1
+            if row[3] == "failed" and on_invalid:
+                on_invalid({"id": job_id, "seq": row[1], "context": row[6], "result": row[7], "error": row[8]})
+
+    rows = []
+    for line_no, job in iter_batch_jobs(manifest_path, ingestor):
+        api_url = request_body = result = error = None
+        if "error" in job:
+            result, error = "INVALID", job["error"]
+        else:
+            try:
+                api_url, request_body = build_request_from_job(job)
+            except Exception as e:
+                result, error = "INVALID", str(e)
+            else:
+                # 图片已在提交前检查过，这里一般只读缓存
+                failures = validator.check_job(job) if validator else []
+                if failures:
+                    result, error = "INVALID_IMAGE", "; ".join(failures)
+
+        context = dict(job, lines=[[line_no, job.get("job_id", "")]], run=jobs.owner)
+        if error:
+            rows.append((source, line_no, None, "failed", None, None, context, result, error))
+        else:
+            rows.append((source, None, request_fingerprint(request_body), "queued", api_url, request_body,
+                         context, None, None))
+        if len(rows) >= chunk_size:
+            flush(rows)
+            rows = []
+    if rows:
+        flush(rows)
+    return added
+
+
+def job_lines(job):
+    """批量任务对应的清单行 [[行号, job_id]]（指纹去重之前入队的任务只有自己的行号）"""
+    context = job["context"]
+    return context.get("lines") or [[job["seq"], context.get("job_id", "")]]
+
+
+async def _run_batch_async(manifest_path, out, keys, store, jobs, max_in_flight, policy, max_wait, counts,
+                           downloader=None, validator=None, ingestor=None, force=False):
+    source = "batch:" + os.path.abspath(manifest_path)
+    loop = asyncio.get_running_loop()
+
+    def emit(job, status, task_id="", video_url="", error="", reused=False):
+        """为任务对应的每个清单行输出一行结果（请求相同的其他行记为复用），再把任务标记为结束"""
+        context = job["context"]
+        for index, (line_no, job_id) in enumerate(job_lines(job)):
+            result = {
+                "line": line_no,
+                "job_id": job_id,
+                "model": context.get("model", ""),
+                "task_id": task_id,
+                "status": status,
+                "video_url": video_url,
+                "error": error
+            }
+            if reused or index:
+                counts["reused"] += 1
+                result["reused"] = True
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            if status == "SUCCEEDED":
+                counts["succeeded"] += 1
+            else:
+                counts["failed"] += 1
+        out.flush()
+        # 结果写入输出文件后再把队列中的任务标记为结束，进程在两者之间退出时最多重复输出一次
+        jobs.finish(job, status, error)
+
+    def on_update(task):
+        if not task.task_id or task.state == "CANCELLED":
+            return  # 本地取消（如退出）不改变服务端任务，历史记录保持处理中
+
+        job = task.context
+        if task.state == "submitted":
+            if not task.request_body:
+                return  # 接着轮询的已有任务，历史记录中已经保存
+            counts["submitted"] += 1
+            jobs.mark_submitted(job, task.task_id, task.pooled_key.name)
+            print(f"[{task.key}] 已提交任务 {task.task_id}（API Key {task.pooled_key.name}）")
+        elif task.state not in TERMINAL_STATUSES and job["state"] != "polling":
+            job["state"] = "polling"
+            jobs.mark_polling(job)
+
+        status = "等待中" if task.state == "submitted" else STATUS_LABELS.get(task.state, task.state)
+        prompt = ((task.request_body or {}).get("input") or {}).get("prompt", "")
+        key_name = task.pooled_key.name if task.request_body and task.pooled_key else None
+        store.save(task.task_id, task.model, prompt, status, video_url=task.video_url, request=task.request_body,
+                   response=task.response_data, api_key_name=key_name)
+
+        if downloader and task.state == "SUCCEEDED" and task.video_url:
+            downloader.add(task.task_id, task.video_url, task.response_data)
+
+    engine = AsyncTaskEngine(keys, max_workers=min(max_in_flight, 32), policy=policy,
+                             max_wait=max_wait, on_update=on_update)
+
+    def start(job):
+        """开始处理领取到的任务，返回EngineTask；已直接得出结果的返回None
+
+        清单中请求相同的行在入队时已合并为一个任务，这里只需要查找历史记录中的其他任务。
+        """
+        line_no = job_lines(job)[0][0]
+        request_body = job["request"]
+        if job["task_id"]:
+            # 上次运行已经提交，接着轮询
+            counts["resumed"] += 1
+            print(f"[{line_no}] 继续轮询上次提交的任务 {job['task_id']}")
+            return engine.attach(line_no, job["task_id"], (request_body or {}).get("model", ""),
+                                 request_resolution(request_body), context=job, key_name=job["api_key_name"])
+
+        if job["attempts"] > jobs.max_attempts:
+            emit(job, "ERROR", error=f"已提交 {job['attempts'] - 1} 次仍未得到任务ID，请检查历史记录中是否已有该任务")
+            return None
+
+        if force:
+            return engine.submit(line_no, job["api_url"], request_body, context=job)
+
+        match = find_matching_task(store.read(), request_fingerprint(request_body))
+        if match and not match["in_flight"]:
+            emit(job, "SUCCEEDED", match["task_id"], match["video_url"], reused=True)
+            print(f"[{line_no}] 复用已成功的任务 {match['task_id']}")
+            if downloader and not match["local_path"] and match["video_url"]:
+                downloader.add(match["task_id"], match["video_url"])
+            return None
+
+        if match:
+            job["reused"] = True
+            jobs.mark_submitted(job, match["task_id"], match["api_key_name"])
+            print(f"[{line_no}] 相同请求的任务 {match['task_id']} 仍在处理中，继续轮询")
+            return engine.attach(line_no, match["task_id"], request_body["model"], request_resolution(request_body),
+                                 context=job, key_name=match["api_key_name"])
+        return engine.submit(line_no, job["api_url"], request_body, context=job)
+
+    def complete(future):
+        task = future.result()
+        job = task.context
+        emit(job, task.state, task.task_id or "", task.video_url, task.error, reused=job.get("reused", False))
+        print(f"[{task.key}] 任务 {task.task_id or '-'}: {task.state}")
+
+    # 上次运行已全部结束时重新开始一轮（已成功的任务按请求指纹复用），否则接着上次中断的地方继续
+    if not jobs.active_count(source):
+        jobs.clear_finished(source).result()
+    added = _enqueue_manifest_jobs(manifest_path, jobs, source, validator, ingestor,
+                                   on_invalid=lambda job: emit(job, job["result"], error=job["error"]))
+    print(f"清单中新加入队列 {added} 个任务，队列中未完成 {jobs.active_count(source)} 个")
+
+    pending = set()
+    waiting_notice = False
+    try:
+        while True:
+            # 领取任务直到达到并发上限（包括上次运行留下的和租约已过期的任务）
+            while len(pending) < max_in_flight:
+                claimed = await loop.run_in_executor(None, jobs.claim, source, max_in_flight - len(pending))
+                if not claimed:
+                    break
+                for job in claimed:
+                    task = start(job)
+                    if task is not None:
+                        pending.add(task.result)
+
+            if not pending:
+                remaining = jobs.active_count(source)
+                if not remaining:
+                    break
+                # 其余任务的租约由其他仍在运行（或刚退出）的进程持有，等租约过期后接手
+                if not waiting_notice:
+                    print(f"还有 {remaining} 个任务由其他进程处理中，等待其完成或租约过期...")
+                    waiting_notice = True
+                await asyncio.sleep(jobs.lease_seconds / 4)
+                continue
+
+            done, pending = await asyncio.wait(pending, timeout=jobs.lease_seconds / 4,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                complete(future)
+    finally:
+        await engine.close()
 
 
 class AliyunVideoGenerationApp:
@@ -22,9 +4556,15 @@ class AliyunVideoGenerationApp:
         self.root.geometry("950x750")
 
         self.current_task_id = None
-        self.polling_active = False
         self.temp_dir = tempfile.mkdtemp()  # 创建临时目录存储测试图片
 
+        # 图片预览：内存中的PhotoImage（LRU，仅在Tk主线程访问）和磁盘缩略图缓存
+        self.preview_photos = OrderedDict()
+        try:
+            self.thumbnails = ThumbnailCache()
+        except OSError:
+            self.thumbnails = ThumbnailCache(os.path.join(self.temp_dir, "thumbnails"))
+
         # 定义可用的模型和对应的模式
         self.models = {
             "wanx2.1-kf2v-plus": "首尾帧生成模式",
@@ -36,17 +4576,37 @@ class AliyunVideoGenerationApp:
         self.current_model = tk.StringVar(value="wanx2.1-kf2v-plus")
 
         # 配置文件路径
-        self.config_file = os.path.join(os.path.expanduser("~"), ".aliyun_video_generator_config.ini")
+        self.config_file = CONFIG_FILE
 
         # 数据库路径
-        self.db_file = os.path.join(os.path.expanduser("~"), ".aliyun_video_generator_history.db")
+        self.db_file = DB_FILE
 
         # 创建/连接数据库
         self.setup_database()
 
+        # 根据历史耗时生成轮询策略，所有任务共用一个轮询调度器
+        self.polling_policy = PollingPolicy.from_history(self.history)
+        self.poll_scheduler = PollScheduler(self.polling_policy)
+        self.task_keys = {}  # 正在轮询的task_id -> 占用任务名额的Key池成员
+        self.task_jobs = {}  # 正在轮询的task_id -> 持久化队列中的任务
+
+        # 提交的任务先写入持久化队列，退出时未完成的任务在下次启动时继续
+        self.jobs = JobQueue(self.history)
+
         # 创建主框架前先加载配置
         self.load_config()
 
+        # 成功任务的视频在URL过期前自动下载到本地
+        settings = download_settings(self.config)
+        self.auto_download = settings["enabled"]
+        self.downloader = create_video_downloader(self.history, settings, on_update=self.handle_download_update)
+        self.videos = self.downloader.videos
+        if self.auto_download:
+            self.downloader.resume_pending()
+
+        # 本地图片上传后得到API可用的URL
+        self.ingestor = create_image_ingestor(self.history, upload_settings(self.config))
+
         self.create_menu()
 
         # 创建主滚动框架
@@ -80,28 +4640,14 @@ class AliyunVideoGenerationApp:
 
         self.create_widgets()
 
-    def setup_database(self):
-        """设置历史记录数据库"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-
-        # 创建历史记录表
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            task_id TEXT UNIQUE,
-            model TEXT,
-            timestamp TEXT,
-            prompt TEXT,
-            status TEXT,
-            video_url TEXT,
-            request_json TEXT,
-            response_json TEXT
-        )
-        ''')
+        # 继续上次退出时未完成的任务，然后对账历史记录中其他仍处于处理中状态的任务
+        self.reconciling = False
+        self.root.after(0, self.resume_jobs)
+        self.root.after(0, lambda: self.start_reconcile(startup=True))
 
-        conn.commit()
-        conn.close()
+    def setup_database(self):
+        """设置历史记录数据库（WAL模式，单写线程）"""
+        self.history = HistoryStore(self.db_file)
 
     def load_config(self):
         """加载配置文件，读取API key"""
@@ -116,6 +4662,13 @@ class AliyunVideoGenerationApp:
             self.saved_api_key = ''
             self.save_api_key_var = tk.BooleanVar(value=True)
 
+        # 按配置创建共享的HTTP连接池和各API Key的限速器
+        configure_http_client(**network_settings(self.config))
+        configure_rate_limits(**rate_limit_settings(self.config))
+
+        # 配置文件中的[ApiKey:名称]和界面输入的Key组成Key池，新任务分配给负载最低的Key
+        self.key_pool = create_key_pool(self.config, self.saved_api_key)
+
     def save_config(self):
         """保存配置到文件"""
         if not self.config.has_section('Settings'):
@@ -153,6 +4706,7 @@ class AliyunVideoGenerationApp:
         # File menu
         file_menu = tk.Menu(menubar, tearoff=0)
         file_menu.add_command(label="历史记录", command=self.show_history)
+        file_menu.add_command(label="同步未完成的任务", command=self.start_reconcile)
         file_menu.add_separator()
         file_menu.add_command(label="退出", command=self.root.quit)
         menubar.add_cascade(label="文件", menu=file_menu)
@@ -160,6 +4714,11 @@ class AliyunVideoGenerationApp:
         # Debug menu
         self.debug_menu = tk.Menu(menubar, tearoff=0)
         self.debug_menu.add_command(label="无调试信息", state=tk.DISABLED)
+        self.debug_menu.add_separator()
+        self.debug_menu.add_command(label="连接统计", command=self.show_connection_stats)
+        self.debug_menu.add_command(label="接口调用统计", command=self.show_api_stats)
+        self.debug_menu.add_command(label="任务耗时统计", command=self.show_task_timings)
+        self.debug_menu.add_command(label="本地视频库", command=self.show_video_usage)
         menubar.add_cascade(label="调试", menu=self.debug_menu)
 
         # Video menu
@@ -306,7 +4865,46 @@ class AliyunVideoGenerationApp:
         ttk.Button(toolbar, text="刷新", command=lambda: self.load_history_data(history_tree)).pack(side=tk.LEFT, padx=5)
         ttk.Button(toolbar, text="删除选中", command=lambda: self.delete_history_item(history_tree)).pack(side=tk.LEFT,
                                                                                                       padx=5)
-        ttk.Button(toolbar, text="导出记录", command=lambda: self.export_history()).pack(side=tk.LEFT, padx=5)
+        ttk.Button(toolbar, text="导出记录",
+                   command=lambda: self.export_history(history_tree.page_filters)).pack(side=tk.LEFT, padx=5)
+        ttk.Button(toolbar, text="导入记录",
+                   command=lambda: self.import_history(history_tree)).pack(side=tk.LEFT, padx=5)
+        ttk.Button(toolbar, text="固定/取消固定视频",
+                   command=lambda: self.toggle_video_pin(history_tree)).pack(side=tk.LEFT, padx=5)
+
+        history_count_var = tk.StringVar()
+        ttk.Label(toolbar, textvariable=history_count_var).pack(side=tk.RIGHT, padx=5)
+
+        # 搜索和筛选栏
+        search_bar = ttk.Frame(history_window)
+        search_bar.pack(fill=tk.X, padx=5, pady=(0, 5))
+
+        ttk.Label(search_bar, text="搜索提示词:").pack(side=tk.LEFT, padx=2)
+        search_var = tk.StringVar()
+        search_entry = ttk.Entry(search_bar, textvariable=search_var, width=30)
+        search_entry.pack(side=tk.LEFT, padx=2)
+
+        ttk.Label(search_bar, text="模型:").pack(side=tk.LEFT, padx=(10, 2))
+        model_filter_var = tk.StringVar(value="全部")
+        ttk.Combobox(search_bar, textvariable=model_filter_var, values=["全部"] + list(self.models.keys()),
+                     state="readonly", width=18).pack(side=tk.LEFT, padx=2)
+
+        ttk.Label(search_bar, text="状态:").pack(side=tk.LEFT, padx=(10, 2))
+        status_filter_var = tk.StringVar(value="全部")
+        ttk.Combobox(search_bar, textvariable=status_filter_var,
+                     values=["全部", "成功", "失败", "处理中", "等待中", "PENDING", "CANCELED", "UNKNOWN"],
+                     state="readonly", width=10).pack(side=tk.LEFT, padx=2)
+
+        def apply_search(event=None):
+            history_tree.page_filters = {
+                "text": search_var.get().strip(),
+                "model": None if model_filter_var.get() == "全部" else model_filter_var.get(),
+                "status": None if status_filter_var.get() == "全部" else status_filter_var.get()
+            }
+            self.load_history_data(history_tree)
+
+        search_entry.bind("<Return>", apply_search)
+        ttk.Button(search_bar, text="搜索", command=apply_search).pack(side=tk.LEFT, padx=5)
 
         # 创建TreeView显示历史记录
         columns = ("任务ID", "模型", "时间", "提示词", "状态", "操作")
@@ -323,9 +4921,12 @@ class AliyunVideoGenerationApp:
         for col in columns:
             history_tree.heading(col, text=col)
 
-        # 添加滚动条
+        # 添加滚动条，滚动到接近底部时加载下一页
         tree_scroll = ttk.Scrollbar(history_window, orient="vertical", command=history_tree.yview)
-        history_tree.configure(yscrollcommand=tree_scroll.set)
+        history_tree.configure(
+            yscrollcommand=lambda first, last: self.on_history_scroll(history_tree, tree_scroll, first, last))
+        history_tree.count_var = history_count_var
+        history_tree.page_filters = {"text": "", "model": None, "status": None}
 
         history_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         tree_scroll.pack(side=tk.RIGHT, fill=tk.Y)
@@ -344,31 +4945,94 @@ class AliyunVideoGenerationApp:
         self.load_history_data(history_tree)
 
     def load_history_data(self, tree):
-        """从数据库加载历史记录到树视图"""
+        """从数据库加载历史记录到树视图（分页加载，滚动时继续加载）"""
         # 清除现有项目
-        for item in tree.get_children():
-            tree.delete(item)
+        tree.delete(*tree.get_children())
+
+        # 分页状态保存在树视图上
+        tree.page_cursor = None  # 已加载的最后一行 (created_at, id)
+        tree.page_offset = 0  # 搜索结果按相关度排序，使用偏移分页
+        tree.page_loading = False
+        tree.page_exhausted = False
+        tree.page_generation = getattr(tree, "page_generation", 0) + 1  # 刷新后丢弃旧的插入批次
+
+        # 排队中的写操作提交后再读取第一页，保证列表是最新的（不在Tk主线程等待写线程）
+        tree.page_loading = True
+        generation = tree.page_generation
+
+        def load_first_page(future):
+            if not tree.winfo_exists() or tree.page_generation != generation:
+                return  # 窗口已关闭或已再次刷新
+            tree.page_loading = False
+            self.load_history_page(tree)
+
+        self.when_written(self.history.barrier(), load_first_page)
+
+    def when_written(self, future, callback):
+        """写操作完成后在Tk主线程调用 callback(future)"""
+        future.add_done_callback(lambda f: self.root.after(0, lambda: callback(f)))
+
+    def load_history_page(self, tree, page_size=200):
+        """读取下一页历史记录，分批插入树视图"""
+        if tree.page_loading or tree.page_exhausted:
+            return
 
+        filters = tree.page_filters
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
+            if filters["text"]:
+                rows = search_history(self.history.read(), filters["text"], filters["model"], filters["status"],
+                                      tree.page_offset, page_size)
+                tree.page_offset += len(rows)
+            else:
+                rows = fetch_history_page(self.history.read(), tree.page_cursor, page_size,
+                                          filters["model"], filters["status"])
+        except Exception as e:
+            messagebox.showerror("错误", f"加载历史记录失败: {str(e)}")
+            return
 
-            cursor.execute("SELECT task_id, model, timestamp, prompt, status FROM history ORDER BY timestamp DESC")
-            rows = cursor.fetchall()
+        if len(rows) < page_size:
+            tree.page_exhausted = True
+        if not rows:
+            self.update_history_count(tree)
+            return
 
-            for row in rows:
-                task_id, model, timestamp, prompt, status = row
+        tree.page_cursor = (rows[-1][2], rows[-1][5])
+        tree.page_loading = True
+        self.insert_history_rows(tree, rows, 0, tree.page_generation)
 
-                # 截断提示词
+    def insert_history_rows(self, tree, rows, start, generation, slice_size=50):
+        """每次after()只插入一小批，避免大量插入时界面卡顿"""
+        if generation != tree.page_generation or not tree.winfo_exists():
+            return
+
+        for task_id, model, created_at, prompt, status, _ in rows[start:start + slice_size]:
+            timestamp = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M:%S") if created_at else ""
+
+            # 截断提示词（搜索结果已是高亮片段）
+            prompt = prompt or ""
+            if tree.page_filters["text"]:
+                short_prompt = prompt
+            else:
                 short_prompt = prompt[:50] + "..." if len(prompt) > 50 else prompt
 
-                # 插入数据
-                tree.insert("", tk.END, values=(task_id, model, timestamp, short_prompt, status, "查看详情"))
+            # 插入数据
+            tree.insert("", tk.END, values=(task_id, model, timestamp, short_prompt, status, "查看详情"))
 
-            conn.close()
+        if start + slice_size < len(rows):
+            tree.after(1, lambda: self.insert_history_rows(tree, rows, start + slice_size, generation))
+        else:
+            tree.page_loading = False
+            self.update_history_count(tree)
 
-        except Exception as e:
-            messagebox.showerror("错误", f"加载历史记录失败: {str(e)}")
+    def update_history_count(self, tree):
+        suffix = "" if tree.page_exhausted else "（滚动加载更多）"
+        tree.count_var.set(f"已加载 {len(tree.get_children())} 条{suffix}")
+
+    def on_history_scroll(self, tree, scrollbar, first, last):
+        """同步滚动条，接近底部时加载下一页"""
+        scrollbar.set(first, last)
+        if float(last) > 0.9 and hasattr(tree, "page_cursor"):
+            tree.after_idle(lambda: self.load_history_page(tree))
 
     def show_history_details(self, tree):
         """显示选中历史记录的详细信息"""
@@ -380,17 +5044,17 @@ class AliyunVideoGenerationApp:
         task_id = tree.item(selected[0], "values")[0]
 
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
+            cursor = self.history.read().cursor()
 
             cursor.execute(
-                "SELECT model, prompt, status, video_url, request_json, response_json FROM history WHERE task_id = ?",
+                "SELECT model, prompt, status, video_url, request_json, response_json, local_path FROM history "
+                "WHERE task_id = ?",
                 (task_id,)
             )
             row = cursor.fetchone()
 
             if row:
-                model, prompt, status, video_url, request_json, response_json = row
+                model, prompt, status, video_url, request_json, response_json, local_path = row
 
                 # 清空并更新详情文本
                 self.details_text.delete(1.0, tk.END)
@@ -400,6 +5064,8 @@ class AliyunVideoGenerationApp:
                 details += f"状态: {status}\n\n"
                 details += f"提示词: {prompt}\n\n"
 
+                if local_path:
+                    details += f"本地文件: {local_path}\n"
                 if video_url:
                     details += f"视频URL: {video_url}\n\n"
 
@@ -424,31 +5090,29 @@ class AliyunVideoGenerationApp:
                     self.details_text.insert(tk.END, "\n\n")
 
                 details += "请求JSON:\n"
-                details += request_json + "\n\n"
+                details += format_json(request_json) + "\n\n"
                 details += "响应JSON:\n"
-                details += response_json
+                details += format_json(response_json)
 
                 self.details_text.insert(tk.END, details)
 
-            conn.close()
-
         except Exception as e:
             messagebox.showerror("错误", f"加载历史记录详情失败: {str(e)}")
 
-    def load_task_from_history(self, task_id):
+    def load_task_from_history(self, task_id, notify=True):
         """从历史记录加载任务到当前界面"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
+            cursor = self.history.read().cursor()
 
             cursor.execute(
-                "SELECT model, request_json, response_json, status, video_url FROM history WHERE task_id = ?",
+                "SELECT model, request_json, response_json, status, video_url, local_path FROM history "
+                "WHERE task_id = ?",
                 (task_id,)
             )
             row = cursor.fetchone()
 
             if row:
-                model, request_json, response_json, status, video_url = row
+                model, request_json, response_json, status, video_url, local_path = row
 
                 # 设置模型
                 self.current_model.set(model)
@@ -457,10 +5121,10 @@ class AliyunVideoGenerationApp:
 
                 # 填充请求和响应文本
                 self.request_text.delete(1.0, tk.END)
-                self.request_text.insert(tk.END, request_json)
+                self.request_text.insert(tk.END, format_json(request_json))
 
                 self.response_text.delete(1.0, tk.END)
-                self.response_text.insert(tk.END, response_json)
+                self.response_text.insert(tk.END, format_json(response_json))
 
                 # 设置任务ID和状态
                 self.current_task_id = task_id
@@ -470,10 +5134,10 @@ class AliyunVideoGenerationApp:
                 # 如果有视频URL，设置它
                 if video_url:
                     self.video_url_var.set(video_url)
-                    self.update_video_menu(video_url)
+                    self.update_video_menu(video_url, local_path)
 
                 # 填充输入字段
-                request_data = json.loads(request_json)
+                request_data = json.loads(request_json or "{}")
                 input_data = request_data.get("input", {})
 
                 # 根据不同模型填充不同字段
@@ -488,6 +5152,8 @@ class AliyunVideoGenerationApp:
                     if "last_frame_url" in input_data:
                         self.last_frame_entry.delete(0, tk.END)
                         self.last_frame_entry.insert(0, input_data["last_frame_url"])
+                    self.restore_preview(input_data.get("first_frame_url"), self.first_frame_preview)
+                    self.restore_preview(input_data.get("last_frame_url"), self.last_frame_preview)
 
                 elif model == "wanx2.1-t2v-turbo":
                     # 纯文本模式
@@ -503,10 +5169,10 @@ class AliyunVideoGenerationApp:
                     if "img_url" in input_data:
                         self.image_url_entry.delete(0, tk.END)
                         self.image_url_entry.insert(0, input_data["img_url"])
+                    self.restore_preview(input_data.get("img_url"), self.single_image_preview)
 
-                messagebox.showinfo("成功", f"已加载任务 {task_id}")
-
-            conn.close()
+                if notify:
+                    messagebox.showinfo("成功", f"已加载任务 {task_id}")
 
         except Exception as e:
             messagebox.showerror("错误", f"加载任务失败: {str(e)}")
@@ -519,102 +5185,161 @@ class AliyunVideoGenerationApp:
             return
 
         if messagebox.askyesno("确认", "确定要删除选中的历史记录吗？"):
-            for item in selected:
-                task_id = tree.item(item, "values")[0]
-
-                try:
-                    conn = sqlite3.connect(self.db_file)
-                    cursor = conn.cursor()
-
-                    cursor.execute("DELETE FROM history WHERE task_id = ?", (task_id,))
-                    conn.commit()
-                    conn.close()
+            task_ids = [tree.item(item, "values")[0] for item in selected]
 
+            def finish_delete(future):
+                if future.exception() is not None:
+                    messagebox.showerror("错误", f"删除记录失败: {str(future.exception())}")
+                elif tree.winfo_exists():
                     # 从树视图中删除
-                    tree.delete(item)
+                    tree.delete(*[item for item in selected if tree.exists(item)])
 
-                except Exception as e:
-                    messagebox.showerror("错误", f"删除记录失败: {str(e)}")
-
-    def export_history(self):
-        """导出历史记录到JSON文件"""
-        filepath = filedialog.asksaveasfilename(
-            defaultextension=".json",
-            filetypes=[("JSON文件", "*.json"), ("所有文件", "*.*")],
-            title="导出历史记录"
-        )
+            self.when_written(self.history.delete(*task_ids), finish_delete)
 
-        if not filepath:
+    def toggle_video_pin(self, tree):
+        """固定选中任务的本地视频（固定的视频不会因超过磁盘配额被删除），再次点击取消固定"""
+        selected = tree.selection()
+        if not selected:
+            messagebox.showinfo("提示", "请先选择一条历史记录")
             return
 
+        task_id = tree.item(selected[0], "values")[0]
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
+            row = self.history.read().execute(
+                "SELECT video_sha256 FROM history WHERE task_id = ?", (task_id,)).fetchone()
+            sha256 = row[0] if row else None
+            if not sha256 or not self.videos.lookup(sha256):
+                messagebox.showinfo("提示", "该任务的视频不在本地视频库中")
+                return
+
+            pinned = not self.videos.is_pinned(sha256)
+        except Exception as e:
+            messagebox.showerror("错误", f"更新视频固定状态失败: {str(e)}")
+            return
 
-            cursor.execute(
-                "SELECT task_id, model, timestamp, prompt, status, video_url, request_json, response_json FROM history"
+        def finish_pin(future):
+            if future.exception() is not None:
+                messagebox.showerror("错误", f"更新视频固定状态失败: {str(future.exception())}")
+            else:
+                messagebox.showinfo("成功", "视频已固定，不会被自动清理。" if pinned else "已取消固定。")
+
+        self.when_written(self.videos.pin(sha256, pinned), finish_pin)
+
+    def export_history(self, filters=None):
+        """导出历史记录（NDJSON/JSON/CSV/Parquet），可按日期、模型和状态筛选"""
+        filters = filters or {}
+
+        export_window = tk.Toplevel(self.root)
+        export_window.title("导出历史记录")
+        export_window.geometry("420x260")
+
+        form = ttk.Frame(export_window, padding="10")
+        form.pack(fill=tk.BOTH, expand=True)
+
+        ttk.Label(form, text="开始日期:").grid(row=0, column=0, sticky=tk.W, padx=5, pady=5)
+        since_var = tk.StringVar()
+        ttk.Entry(form, textvariable=since_var, width=15).grid(row=0, column=1, sticky=tk.W, padx=5, pady=5)
+
+        ttk.Label(form, text="结束日期:").grid(row=1, column=0, sticky=tk.W, padx=5, pady=5)
+        until_var = tk.StringVar()
+        ttk.Entry(form, textvariable=until_var, width=15).grid(row=1, column=1, sticky=tk.W, padx=5, pady=5)
+        ttk.Label(form, text="(YYYY-MM-DD，可留空)").grid(row=0, column=2, rowspan=2, sticky=tk.W)
+
+        ttk.Label(form, text="模型:").grid(row=2, column=0, sticky=tk.W, padx=5, pady=5)
+        model_var = tk.StringVar(value=filters.get("model") or "全部")
+        ttk.Combobox(form, textvariable=model_var, values=["全部"] + list(self.models.keys()),
+                     state="readonly", width=18).grid(row=2, column=1, columnspan=2, sticky=tk.W, padx=5, pady=5)
+
+        ttk.Label(form, text="状态:").grid(row=3, column=0, sticky=tk.W, padx=5, pady=5)
+        status_var = tk.StringVar(value=filters.get("status") or "全部")
+        ttk.Combobox(form, textvariable=status_var,
+                     values=["全部", "成功", "失败", "处理中", "等待中", "PENDING", "CANCELED", "UNKNOWN"],
+                     state="readonly", width=10).grid(row=3, column=1, sticky=tk.W, padx=5, pady=5)
+
+        progress_bar = ttk.Progressbar(form, mode="determinate", maximum=100)
+        progress_bar.grid(row=4, column=0, columnspan=3, sticky=tk.W + tk.E, padx=5, pady=10)
+        progress_text = tk.StringVar()
+        ttk.Label(form, textvariable=progress_text).grid(row=5, column=0, columnspan=3, sticky=tk.W, padx=5)
+
+        def start_export():
+            try:
+                since = parse_date(since_var.get().strip())
+                until = parse_date(until_var.get().strip(), end=True)
+            except ValueError:
+                messagebox.showerror("错误", "日期格式应为YYYY-MM-DD", parent=export_window)
+                return
+
+            filepath = filedialog.asksaveasfilename(
+                parent=export_window,
+                defaultextension=".ndjson",
+                filetypes=[("NDJSON文件", "*.ndjson"), ("JSON文件", "*.json"), ("CSV文件", "*.csv"),
+                           ("Parquet文件", "*.parquet"), ("所有文件", "*.*")],
+                title="导出历史记录"
             )
-            rows = cursor.fetchall()
+            if not filepath:
+                return
 
-            history_data = []
-            for row in rows:
-                task_id, model, timestamp, prompt, status, video_url, request_json, response_json = row
+            export_btn.config(state=tk.DISABLED)
+            model = None if model_var.get() == "全部" else model_var.get()
+            status = None if status_var.get() == "全部" else status_var.get()
 
-                history_item = {
-                    "task_id": task_id,
-                    "model": model,
-                    "timestamp": timestamp,
-                    "prompt": prompt,
-                    "status": status,
-                    "video_url": video_url,
-                    "request_json": json.loads(request_json) if request_json else None,
-                    "response_json": json.loads(response_json) if response_json else None
-                }
+            def on_progress(done, total):
+                percent = done * 100 / total if total else 100
+                self.root.after(0, lambda: progress_bar.config(value=percent))
+                self.root.after(0, lambda: progress_text.set(f"已导出 {done}/{total} 条"))
 
-                history_data.append(history_item)
+            def run():
+                # 在后台线程中导出，使用该线程自己的读连接
+                try:
+                    self.history.flush(timeout=1)
+                    count = export_history_file(self.history.read(), filepath, since=since, until=until,
+                                                model=model, status=status, progress=on_progress)
+                    self.root.after(0, lambda: messagebox.showinfo(
+                        "成功", f"已导出 {count} 条历史记录到 {filepath}", parent=export_window))
+                except Exception as e:
+                    error = str(e)
+                    self.root.after(0, lambda: messagebox.showerror(
+                        "错误", f"导出历史记录失败: {error}", parent=export_window))
+                finally:
+                    self.history.release_read()
+                    self.root.after(0, lambda: export_btn.config(state=tk.NORMAL))
+
+            threading.Thread(target=run, daemon=True).start()
+
+        export_btn = ttk.Button(form, text="选择文件并导出", command=start_export)
+        export_btn.grid(row=6, column=0, columnspan=3, pady=5)
+
+    def import_history(self, tree):
+        """从导出文件（NDJSON/JSON）批量导入并合并历史记录"""
+        filepath = filedialog.askopenfilename(
+            filetypes=[("NDJSON文件", "*.ndjson *.jsonl"), ("JSON文件", "*.json"), ("所有文件", "*.*")],
+            title="导入历史记录"
+        )
+        if not filepath:
+            return
 
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(history_data, f, ensure_ascii=False, indent=2)
+        count_var = tree.count_var
 
-            messagebox.showinfo("成功", f"历史记录已导出到 {filepath}")
+        def on_progress(read, written):
+            self.root.after(0, lambda: count_var.set(f"正在导入: 已读取 {read} 条，已写入 {written} 条"))
 
-            conn.close()
+        def run():
+            try:
+                read, written = import_history_file(self.history, filepath, progress=on_progress)
+                self.root.after(0, lambda: self.load_history_data(tree))
+                self.root.after(0, lambda: messagebox.showinfo(
+                    "成功", f"读取 {read} 条记录，新增或更新 {written} 条"))
+            except Exception as e:
+                error = str(e)
+                self.root.after(0, lambda: messagebox.showerror("错误", f"导入历史记录失败: {error}"))
 
-        except Exception as e:
-            messagebox.showerror("错误", f"导出历史记录失败: {str(e)}")
+        threading.Thread(target=run, daemon=True).start()
 
-    def save_to_history(self, task_id, model, prompt, status, video_url="", request_json="", response_json=""):
-        """保存任务到历史记录数据库"""
+    def save_to_history(self, task_id, model, prompt, status, video_url="", request=None, response=None,
+                        api_key_name=None):
+        """保存任务到历史记录数据库（排队给写线程，不阻塞界面）"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-            # 检查任务是否已存在
-            cursor.execute("SELECT id FROM history WHERE task_id = ?", (task_id,))
-            existing = cursor.fetchone()
-
-            if existing:
-                # 更新现有记录
-                cursor.execute(
-                    """UPDATE history SET 
-                    model = ?, timestamp = ?, prompt = ?, status = ?, 
-                    video_url = ?, request_json = ?, response_json = ? 
-                    WHERE task_id = ?""",
-                    (model, timestamp, prompt, status, video_url, request_json, response_json, task_id)
-                )
-            else:
-                # 插入新记录
-                cursor.execute(
-                    """INSERT INTO history 
-                    (task_id, model, timestamp, prompt, status, video_url, request_json, response_json)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (task_id, model, timestamp, prompt, status, video_url, request_json, response_json)
-                )
-
-            conn.commit()
-            conn.close()
+            self.history.save(task_id, model, prompt, status, video_url, request, response, api_key_name)
 
         except Exception as e:
             print(f"保存历史记录失败: {str(e)}")
@@ -700,6 +5425,10 @@ class AliyunVideoGenerationApp:
         self.generate_btn = ttk.Button(bottom_frame, text="生成视频", command=self.generate_video)
         self.generate_btn.pack(side=tk.LEFT, padx=5)
 
+        # 默认复用相同请求的任务，勾选后总是提交新任务
+        self.force_new_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(bottom_frame, text="强制重新生成", variable=self.force_new_var).pack(side=tk.LEFT, padx=5)
+
         self.check_btn = ttk.Button(bottom_frame, text="检查任务状态", command=self.check_task_status, state=tk.DISABLED)
         self.check_btn.pack(side=tk.LEFT, padx=5)
 
@@ -777,7 +5506,13 @@ class AliyunVideoGenerationApp:
         self.first_frame_entry.pack(fill=tk.X, padx=5, pady=5)
 
         ttk.Button(first_frame_container, text="测试URL有效性",
-                   command=lambda: self.test_image_url(self.first_frame_entry.get(), self.first_frame_preview)).pack(
+                   command=lambda: self.test_image_url(self.first_frame_entry.get(), self.first_frame_entry,
+                                                       self.first_frame_preview)).pack(pady=5, padx=5)
+        ttk.Button(first_frame_container, text="预览图片",
+                   command=lambda: self.preview_image_url(self.first_frame_entry.get(), self.first_frame_preview)).pack(
+            pady=5, padx=5)
+        ttk.Button(first_frame_container, text="选择本地图片",
+                   command=lambda: self.choose_local_image(self.first_frame_entry, self.first_frame_preview)).pack(
             pady=5, padx=5)
 
         # Frame for the image preview
@@ -796,7 +5531,15 @@ class AliyunVideoGenerationApp:
         self.last_frame_entry.pack(fill=tk.X, padx=5, pady=5)
 
         ttk.Button(last_frame_container, text="测试URL有效性",
-                   command=lambda: self.test_image_url(self.last_frame_entry.get(), self.last_frame_preview)).pack(
+                   command=lambda: self.test_image_url(self.last_frame_entry.get(), self.last_frame_entry,
+                                                       self.last_frame_preview, self.first_frame_entry)).pack(
+            pady=5, padx=5)
+        ttk.Button(last_frame_container, text="预览图片",
+                   command=lambda: self.preview_image_url(self.last_frame_entry.get(), self.last_frame_preview)).pack(
+            pady=5, padx=5)
+        ttk.Button(last_frame_container, text="选择本地图片",
+                   command=lambda: self.choose_local_image(self.last_frame_entry, self.last_frame_preview,
+                                                           self.first_frame_entry)).pack(
             pady=5, padx=5)
 
         # Frame for the image preview
@@ -959,7 +5702,14 @@ class AliyunVideoGenerationApp:
         self.image_url_entry.insert(0, "https://cdn.translate.alibaba.com/r/wanx-demo-1.png")  # 默认示例图片
 
         ttk.Button(image_url_frame, text="测试URL有效性",
-                   command=lambda: self.test_image_url(self.image_url_entry.get(), self.single_image_preview)).pack(
+                   command=lambda: self.test_image_url(self.image_url_entry.get(), self.image_url_entry,
+                                                       self.single_image_preview)).pack(
+            side=tk.LEFT, pady=5, padx=5)
+        ttk.Button(image_url_frame, text="预览图片",
+                   command=lambda: self.preview_image_url(self.image_url_entry.get(), self.single_image_preview)).pack(
+            side=tk.LEFT, pady=5, padx=5)
+        ttk.Button(image_url_frame, text="选择本地图片",
+                   command=lambda: self.choose_local_image(self.image_url_entry, self.single_image_preview)).pack(
             side=tk.LEFT, pady=5, padx=5)
 
         # 图片预览
@@ -1083,7 +5833,11 @@ class AliyunVideoGenerationApp:
         ttk.Button(btn_frame, text="在浏览器中打开", command=self.open_video).pack(side=tk.LEFT, padx=5)
         ttk.Label(btn_frame, text="(注意：视频URL仅保存24小时，请及时下载！)", foreground="red").pack(side=tk.LEFT, padx=5)
 
-    def test_image_url(self, url, preview_label):
+    def test_image_url(self, url, entry=None, preview_label=None, match_entry=None):
+        """检查图片URL（在后台线程中只读取文件头，不下载整张图片）
+
+        给出 entry 时，图片超出API限制可以选择自动调整后重新上传（见 fix_image_url）。
+        """
         if not url:
             messagebox.showerror("错误", "请输入图片URL")
             return
@@ -1095,70 +5849,164 @@ class AliyunVideoGenerationApp:
             return
 
         self.progress_var.set("正在测试URL有效性...")
-        self.root.update()
 
-        try:
-            # 尝试下载图片
-            temp_file = os.path.join(self.temp_dir, "temp_image.jpg")
-
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            req = urllib.request.Request(url, headers=headers)
-            with urllib.request.urlopen(req, timeout=10) as response:
-                content_type = response.info().get_content_type()
-                if not content_type.startswith('image/'):
-                    messagebox.showerror("错误", f"URL不是图片链接（内容类型: {content_type}）")
-                    self.progress_var.set("URL测试失败: 不是图片链接")
-                    return
+        def run():
+            try:
+                info = probe_image_url(url)
+            except requests.RequestException as e:
+                error = f"无法访问URL: {str(e)}"
+                self.root.after(0, lambda: self.finish_image_test(None, error, "无法访问"))
+            except Exception as e:
+                error = str(e)
+                self.root.after(0, lambda: self.finish_image_test(None, error, error))
+            else:
+                self.root.after(0, lambda: self.finish_image_test(info, on_fix=on_fix))
+
+        on_fix = partial(self.fix_image_url, url, entry, preview_label, match_entry) if entry else None
+        threading.Thread(target=run, daemon=True).start()
+
+    def finish_image_test(self, info, error=None, reason=None, on_fix=None):
+        """在Tk主线程显示图片URL的检查结果"""
+        if error:
+            messagebox.showerror("错误", error)
+            self.progress_var.set(f"URL测试失败: {reason}")
+            return
+
+        warnings = check_image_limits(info)
+        if warnings and on_fix is not None and self.ingestor.normalizer is not None:
+            if messagebox.askyesno("图片不符合要求", "\n".join(warnings) + "\n\n是否自动调整图片并重新上传？"):
+                on_fix()
+                return
+        else:
+            for warning in warnings:
+                messagebox.showwarning("警告", warning)
 
-                with open(temp_file, 'wb') as out_file:
-                    out_file.write(response.read())
+        self.progress_var.set(f"URL测试成功！（{info['format']} {info['width']}x{info['height']}，"
+                              f"读取 {info['transferred'] / 1024:.1f} KB）")
+        messagebox.showinfo("成功", "图片URL有效，可以正常访问。")
 
-            # 显示预览
-            self.update_image_preview(temp_file, preview_label)
+    def preview_image_url(self, url, preview_label):
+        """显示图片预览：内存中已有时立即显示，否则在后台线程从缩略图缓存（条件请求）获取"""
+        if not url:
+            messagebox.showerror("错误", "请输入图片URL")
+            return
+
+        photo = self.preview_photos.get(url)
+        if photo is not None:
+            self.preview_photos.move_to_end(url)
+            self.set_preview(preview_label, photo)
+            self.progress_var.set("图片预览已加载")
+            return
 
-            # 检查图片大小
-            file_size = os.path.getsize(temp_file) / (1024 * 1024)  # 转换为MB
-            if file_size > 10:
-                messagebox.showwarning("警告", f"图片大小为{file_size:.2f}MB，超过10MB可能会导致API拒绝")
+        self.progress_var.set("正在加载图片预览...")
 
-            # 检查图片分辨率
-            img = Image.open(temp_file)
-            width, height = img.size
-            if width < 360 or height < 360:
-                messagebox.showwarning("警告", f"图片分辨率({width}x{height})小于最小要求(360x360)")
-            elif width > 2000 or height > 2000:
-                messagebox.showwarning("警告", f"图片分辨率({width}x{height})超过最大限制(2000x2000)")
+        def run():
+            try:
+                img = self.thumbnails.get(url)
+            except Exception as e:
+                error = str(e)
+                self.root.after(0, lambda: messagebox.showerror("错误", f"加载图像预览失败: {error}"))
+                self.root.after(0, lambda: self.progress_var.set("图片预览加载失败"))
+                return
 
-            self.progress_var.set("URL测试成功！")
-            messagebox.showinfo("成功", "图片URL有效，可以正常访问。")
+            self.root.after(0, lambda: self.show_image_preview(url, img, preview_label))
+            self.root.after(0, lambda: self.progress_var.set("图片预览已加载"))
 
-        except urllib.error.URLError as e:
-            messagebox.showerror("错误", f"无法访问URL: {str(e)}")
-            self.progress_var.set("URL测试失败: 无法访问")
-        except Exception as e:
-            messagebox.showerror("错误", f"测试URL时发生错误: {str(e)}")
-            self.progress_var.set(f"URL测试失败: {str(e)}")
+        threading.Thread(target=run, daemon=True).start()
 
-    def update_image_preview(self, filepath, preview_label):
+    def choose_local_image(self, entry, preview_label, match_entry=None):
+        """选择本地图片，在后台调整和上传（已上传过的文件直接复用URL），完成后把URL填入输入框
+
+        match_entry 为首帧输入框时，尾帧调整到与首帧（调整后）相同的尺寸。
+        """
+        path = filedialog.askopenfilename(
+            title="选择本地图片",
+            filetypes=[("图片文件", "*.png *.jpg *.jpeg *.bmp *.webp *.gif"), ("所有文件", "*.*")])
+        if not path:
+            return
+
+        self.progress_var.set(f"正在上传 {os.path.basename(path)}...")
+        self.ingest_image_async(lambda: path, entry, preview_label, match_entry)
+
+    def fix_image_url(self, url, entry, preview_label, match_entry=None):
+        """下载超出API限制的图片，调整后重新上传，并用新URL替换输入框中的URL"""
+        self.progress_var.set("正在下载并调整图片...")
+
+        def fetch():
+            response = http_client().get(url, timeout=60)
+            response.raise_for_status()
+            name = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16] + Path(urlsplit(url).path).suffix.lower()
+            path = os.path.join(self.temp_dir, name)
+            with open(path, "wb") as f:
+                f.write(response.content)
+            return path
+
+        self.ingest_image_async(fetch, entry, preview_label, match_entry)
+
+    def frame_target(self, match_entry):
+        """从输入框中的图片URL读取宽高（只读取文件头），返回调整到API限制内后的尺寸，无法读取时返回None"""
+        url = match_entry.get().strip() if match_entry is not None else ""
+        if not url or is_local_image(url):
+            return None
         try:
-            img = Image.open(filepath)
-            aspect_ratio = img.width / img.height
+            info = probe_image_url(url)
+        except Exception:
+            return None
+        return normalized_size(info["width"], info["height"])
+
+    def ingest_image_async(self, get_path, entry, preview_label, match_entry=None):
+        """在后台线程取得本地文件（get_path）并交给图片导入器，完成后把URL填入输入框"""
+        def run():
+            try:
+                target = self.frame_target(match_entry) if self.ingestor.normalizer else None
+                url = self.ingestor.ingest(get_path(), target)
+            except Exception as e:
+                error = str(e)
+                self.root.after(0, lambda: messagebox.showerror("错误", f"上传本地图片失败: {error}"))
+                self.root.after(0, lambda: self.progress_var.set("上传本地图片失败"))
+                return
+
+            self.root.after(0, lambda: self.finish_local_image(url, entry, preview_label))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def finish_local_image(self, url, entry, preview_label):
+        entry.delete(0, tk.END)
+        entry.insert(0, url)
+        self.progress_var.set(f"本地图片已上传: {url}")
+        self.preview_image_url(url, preview_label)
+
+    def restore_preview(self, url, preview_label):
+        """加载历史任务时恢复预览，只使用内存和磁盘缓存，不访问网络"""
+        photo = self.preview_photos.get(url) if url else None
+        if photo is not None:
+            self.preview_photos.move_to_end(url)
+            self.set_preview(preview_label, photo)
+            return
+
+        self.set_preview(preview_label, None)
+        if not url:
+            return
 
-            # Resize for preview while maintaining aspect ratio
-            preview_width = 200
-            preview_height = int(preview_width / aspect_ratio)
+        def run():
+            img = self.thumbnails.cached(url)
+            if img is not None:
+                self.root.after(0, lambda: self.show_image_preview(url, img, preview_label))
 
-            if preview_height > 200:
-                preview_height = 200
-                preview_width = int(preview_height * aspect_ratio)
+        threading.Thread(target=run, daemon=True).start()
 
-            img = img.resize((preview_width, preview_height), Image.LANCZOS)
-            photo_img = ImageTk.PhotoImage(img)
+    def show_image_preview(self, url, img, preview_label):
+        """在Tk主线程把缩略图转换为PhotoImage，放入内存LRU并显示"""
+        photo = ImageTk.PhotoImage(img)
+        self.preview_photos[url] = photo
+        self.preview_photos.move_to_end(url)
+        while len(self.preview_photos) > PREVIEW_CACHE_SIZE:
+            self.preview_photos.popitem(last=False)
+        self.set_preview(preview_label, photo)
 
-            preview_label.config(image=photo_img)
-            preview_label.image = photo_img  # Keep a reference
-        except Exception as e:
-            messagebox.showerror("错误", f"加载图像预览失败: {str(e)}")
+    def set_preview(self, preview_label, photo):
+        preview_label.config(image=photo if photo is not None else "")
+        preview_label.image = photo  # Keep a reference
 
     def update_debug_menu(self, success=True, message=""):
         self.debug_menu.delete(0, tk.END)
@@ -1169,14 +6017,54 @@ class AliyunVideoGenerationApp:
         else:
             self.debug_menu.add_command(label=f"✗ {timestamp} - 错误: {message}", state=tk.DISABLED)
 
-    def update_video_menu(self, video_url=None):
+        self.debug_menu.add_separator()
+        self.debug_menu.add_command(label="连接统计", command=self.show_connection_stats)
+        self.debug_menu.add_command(label="接口调用统计", command=self.show_api_stats)
+        self.debug_menu.add_command(label="任务耗时统计", command=self.show_task_timings)
+        self.debug_menu.add_command(label="本地视频库", command=self.show_video_usage)
+
+    def show_connection_stats(self):
+        """显示共享HTTP连接池的复用情况"""
+        messagebox.showinfo("连接统计", format_connection_stats(http_client().connection_stats()))
+
+    def show_api_stats(self):
+        """显示各接口的调用结果计数（成功、重试、限流、错误、熔断）和熔断器状态，以及Key池中各Key的负载"""
+        message = format_api_stats()
+        if len(self.key_pool) > 1:
+            message += "\n\nAPI Key池:\n" + self.key_pool.describe()
+        messagebox.showinfo("接口调用统计", message)
+
+    def show_task_timings(self):
+        """按模型显示排队时间和生成时间（来自任务状态转换记录）"""
+        try:
+            summary = summarize_task_timings(self.history.read())
+        except Exception as e:
+            messagebox.showerror("错误", f"读取任务耗时失败: {str(e)}")
+            return
+        messagebox.showinfo("任务耗时统计", format_task_timings(summary))
+
+    def show_video_usage(self):
+        """显示本地视频库的占用空间和配额"""
+        total_size, count = self.videos.usage()
+        quota = f"{self.videos.quota / 1024 ** 3:.1f} GB" if self.videos.quota else "不限"
+        messagebox.showinfo("本地视频库", f"目录: {self.videos.root}\n视频: {count} 个\n"
+                                        f"占用: {total_size / 1024 ** 3:.2f} GB（配额: {quota}）")
+
+    def update_video_menu(self, video_url=None, local_path=None):
         self.video_menu.delete(0, tk.END)
+        if local_path and os.path.exists(local_path):
+            self.video_menu.add_command(label="打开本地视频", command=lambda: self.open_local_video(local_path))
         if video_url:
             self.video_menu.add_command(label="在浏览器中打开视频", command=lambda: webbrowser.open(video_url))
             self.video_menu.add_command(label="复制视频URL", command=self.copy_url)
         else:
             self.video_menu.add_command(label="无可用视频", state=tk.DISABLED)
 
+    def open_local_video(self, local_path):
+        """打开视频库中的本地文件，并更新其最近访问时间"""
+        webbrowser.open(Path(local_path).as_uri())
+        self.videos.touch(Path(local_path).stem)
+
     def copy_url(self):
         url = self.video_url_var.get()
         if url:
@@ -1192,8 +6080,7 @@ class AliyunVideoGenerationApp:
             messagebox.showerror("错误", "请输入任务ID")
             return
 
-        api_key = self.api_key_entry.get()
-        if not api_key:
+        if not self.sync_default_key():
             messagebox.showerror("错误", "请输入有效的API Key")
             return
 
@@ -1202,9 +6089,8 @@ class AliyunVideoGenerationApp:
         self.check_task_status()
 
     def validate_inputs(self):
-        # API Key check
-        api_key = self.api_key_entry.get()
-        if not api_key:
+        # API Key check（配置文件中配置了Key池时可以不填）
+        if not self.sync_default_key():
             messagebox.showerror("错误", "请输入有效的DashScope API Key。")
             return False
 
@@ -1282,6 +6168,7 @@ class AliyunVideoGenerationApp:
 
         # Disable UI during processing
         self.generate_btn.config(state=tk.DISABLED)
+        submitted = False
         self.progress_var.set("处理请求中...")
         self.root.update()
 
@@ -1292,98 +6179,77 @@ class AliyunVideoGenerationApp:
         self.task_id_var.set("")
         self.status_var.set("创建任务中...")
 
-        api_key = self.api_key_entry.get()
         model = self.current_model.get()
 
         try:
             # 根据不同模型准备请求数据
-            if model == "wanx2.1-kf2v-plus":  # 首尾帧模式
-                # 准备接口URL
-                api_url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/image2video/video-synthesis"
-
-                prompt = self.prompt_text.get(1.0, tk.END).strip()
-
-                # Prepare input data
-                input_data = {
-                    "prompt": prompt,
-                    "first_frame_url": self.first_frame_entry.get().strip(),
-                    "last_frame_url": self.last_frame_entry.get().strip()
-                }
-
-                # Prepare parameters
-                parameters = {
-                    "resolution": self.kf2v_resolution_var.get(),
-                    "prompt_extend": self.kf2v_prompt_extend_var.get()
-                }
-
-                # Add seed if provided
-                if self.kf2v_seed_var.get():
-                    parameters["seed"] = int(self.kf2v_seed_var.get())
-
-            elif model == "wanx2.1-t2v-turbo":  # 文本生成模式
-                # 准备接口URL
-                api_url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/video-generation/video-synthesis"
-
-                prompt = self.text_prompt.get(1.0, tk.END).strip()
-
-                # Prepare input data
-                input_data = {
-                    "prompt": prompt
-                }
-
-                # Prepare parameters
-                parameters = {
-                    "size": self.t2v_size_var.get()
-                }
-
-            elif model == "wanx2.1-i2v-turbo":  # 单图生成模式
-                # 准备接口URL
-                api_url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/video-generation/video-synthesis"
-
-                prompt = self.image_prompt.get(1.0, tk.END).strip()
-
-                # Prepare input data
-                input_data = {
-                    "prompt": prompt,
-                    "img_url": self.image_url_entry.get().strip()
-                }
-
-                # Prepare parameters
-                parameters = {
-                    "resolution": self.i2v_resolution_var.get(),
-                    "prompt_extend": self.i2v_prompt_extend_var.get()
-                }
-
-            else:
-                raise ValueError(f"不支持的模型: {model}")
-
-            # Build complete request body
-            request_body = {
-                "model": model,
-                "input": input_data,
-                "parameters": parameters
-            }
+            prompt = self.get_current_prompt()
+            api_url, request_body = build_video_request(
+                model=model,
+                prompt=prompt,
+                first_frame_url=self.first_frame_entry.get().strip(),
+                last_frame_url=self.last_frame_entry.get().strip(),
+                img_url=self.image_url_entry.get().strip(),
+                resolution=self.i2v_resolution_var.get() if model == "wanx2.1-i2v-turbo" else self.kf2v_resolution_var.get(),
+                prompt_extend=(self.i2v_prompt_extend_var.get() if model == "wanx2.1-i2v-turbo"
+                               else self.kf2v_prompt_extend_var.get()),
+                seed=self.kf2v_seed_var.get(),
+                size=self.t2v_size_var.get()
+            )
 
             # Show request parameters in UI
             request_json = json.dumps(request_body, indent=2, ensure_ascii=False)
             self.request_text.insert(tk.END, request_json)
 
-            # Create request headers - 使用用户输入的API key
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}",
-                "X-DashScope-Async": "enable"
-            }
+            # 相同请求已经成功或仍在处理中时直接复用，不再提交新的付费任务
+            if not self.force_new_var.get() and self.reuse_matching_task(request_body):
+                return
 
             self.progress_var.set("正在创建任务...")
-            self.root.update()
 
-            # Make the API request to create task
-            response = requests.post(
-                api_url,
-                json=request_body,
-                headers=headers
-            )
+            # 先写入持久化队列（并持有租约），程序在提交过程中退出时下次启动会重新提交
+            job_future = self.jobs.enqueue("gui", None, api_url, request_body, claim=True, context={
+                "model": model, "prompt": prompt, "resolution": self.get_current_resolution()})
+
+            # 在后台线程提交（网络错误和5xx会按退避重试，额度不足时换用Key池中的其他Key），
+            # 完成后回到Tk主线程处理响应
+            threading.Thread(target=self.create_task_in_background,
+                             args=(api_url, model, prompt, request_body, job_future), daemon=True).start()
+            submitted = True
+
+        except Exception as e:
+            self.response_text.insert(tk.END, f"错误: {str(e)}")
+            self.update_debug_menu(False, str(e))
+            self.progress_var.set(f"错误: {str(e)}")
+            self.status_var.set("创建失败")
+            messagebox.showerror("错误", f"生成视频失败: {str(e)}")
+
+        finally:
+            # 提交完成前保持按钮禁用，避免重复提交
+            if not submitted:
+                self.generate_btn.config(state=tk.NORMAL)
+
+    def create_task_in_background(self, api_url, model, prompt, request_body, job_future):
+        job = None
+        try:
+            job = {"id": job_future.result(), "attempts": 1}
+            key, response = create_task_with_pool(self.key_pool, api_url, request_body)
+        except Exception as e:
+            error = e
+            self.root.after(0, lambda: self.finish_create_task(None, model, prompt, request_body, None, error, job))
+        else:
+            self.root.after(0, lambda: self.finish_create_task(key, model, prompt, request_body, response, job=job))
+
+    def finish_create_task(self, key, model, prompt, request_body, response, error=None, job=None):
+        """在Tk主线程处理创建任务的结果
+
+        key 为分配到的Key池成员，job 为持久化队列中的任务，任务开始轮询后由轮询结束时归还名额和更新队列。
+        """
+        polling = False
+        failure = ""  # 创建失败的原因，记录到持久化队列
+        try:
+            if error is not None:
+                raise error
 
             # Process the response
             if response.status_code in [200, 201, 202]:
@@ -1408,25 +6274,31 @@ class AliyunVideoGenerationApp:
                             model=model,
                             prompt=prompt,
                             status="等待中",
-                            request_json=request_json,
-                            response_json=response_text
+                            request=request_body,
+                            response=response_json,
+                            api_key_name=key.name
                         )
 
                         # Enable check button and start polling
                         self.check_btn.config(state=tk.NORMAL)
 
                         # Start polling thread
-                        self.start_polling(task_id, api_key)
+                        if job is not None:
+                            self.jobs.mark_submitted(job, task_id, key.name)
+                        self.start_polling(task_id, key, job)
+                        polling = True
 
                     else:
-                        self.update_debug_menu(False, "响应中没有任务ID")
+                        failure = "响应中没有任务ID"
+                        self.update_debug_menu(False, failure)
                         self.progress_var.set("API调用成功但未返回任务ID。")
                         self.status_var.set("创建失败")
                         messagebox.showwarning("警告", "API调用成功但未返回任务ID。")
 
                 except json.JSONDecodeError:
+                    failure = "无法将响应解析为JSON"
                     self.response_text.insert(tk.END, response.text)
-                    self.update_debug_menu(False, "无法将响应解析为JSON")
+                    self.update_debug_menu(False, failure)
                     self.progress_var.set("无法解析API响应。")
                     self.status_var.set("创建失败")
                     messagebox.showerror("错误", "无法将API响应解析为JSON。")
@@ -1435,31 +6307,15 @@ class AliyunVideoGenerationApp:
                 self.response_text.insert(tk.END, error_text)
 
                 # 解析错误信息，提供更友好的提示
-                try:
-                    error_json = response.json()
-                    error_code = error_json.get("code", "")
-                    error_message = error_json.get("message", "")
-
-                    if error_code == "InvalidParameter.DataInspection":
-                        specific_error = "无法下载图片资源，请确保URL可直接访问。不要使用Google Drive等需要授权的链接。"
-                    elif error_code == "IPInfringementSuspect":
-                        specific_error = "输入数据（提示词或图像）涉嫌知识产权侵权，请修改内容。"
-                    elif error_code == "DataInspectionFailed":
-                        specific_error = "输入数据（提示词或图像）可能包含敏感内容，请修改内容。"
-                    else:
-                        specific_error = f"{error_code}: {error_message}"
-
-                    self.update_debug_menu(False, specific_error)
-                    self.progress_var.set(f"API请求失败: {specific_error}")
-                    messagebox.showerror("错误", f"API请求失败: {specific_error}")
-                except:
-                    self.update_debug_menu(False, f"HTTP错误 {response.status_code}")
-                    self.progress_var.set(f"API请求失败: HTTP {response.status_code}")
-                    messagebox.showerror("错误", f"API请求失败，状态码: {response.status_code}")
+                specific_error = failure = describe_create_error(response)
+                self.update_debug_menu(False, specific_error)
+                self.progress_var.set(f"API请求失败: {specific_error}")
+                messagebox.showerror("错误", f"API请求失败: {specific_error}")
 
                 self.status_var.set("创建失败")
 
         except Exception as e:
+            failure = str(e)
             self.response_text.insert(tk.END, f"错误: {str(e)}")
             self.update_debug_menu(False, str(e))
             self.progress_var.set(f"错误: {str(e)}")
@@ -1467,159 +6323,280 @@ class AliyunVideoGenerationApp:
             messagebox.showerror("错误", f"生成视频失败: {str(e)}")
 
         finally:
+            if key is not None and not polling:
+                self.key_pool.release(key)
+            if job is not None and not polling:
+                self.jobs.finish(job, "CREATE_FAILED", failure)
             # Re-enable UI
             self.generate_btn.config(state=tk.NORMAL)
 
-    def start_polling(self, task_id, api_key):
-        # Set up polling status
-        self.polling_active = True
-        self.cancel_btn.config(state=tk.NORMAL)
+    def sync_default_key(self):
+        """把界面输入的API Key同步到Key池，返回池中是否有可用的Key"""
+        self.key_pool.set_default(self.api_key_entry.get().strip(), rate_limit_settings(self.config)["max_tasks"])
+        return len(self.key_pool) > 0
 
-        # Start polling thread
-        polling_thread = threading.Thread(
-            target=self.poll_task_status,
-            args=(task_id, api_key),
-            daemon=True
+    def api_key_for_task(self, task_id):
+        """返回查询该任务应使用的API Key（创建任务时分配的Key）"""
+        key = self.key_pool.key_for_task(self.history.read(), task_id)
+        return key.api_key if key else ""
+
+    def reuse_matching_task(self, request_body):
+        """查找请求指纹相同的任务并加载到界面，仍在处理中的任务接着轮询；没有可复用的任务时返回False"""
+        match = find_matching_task(self.history.read(), request_fingerprint(request_body))
+        if match is None:
+            return False
+
+        task_id = match["task_id"]
+        self.load_task_from_history(task_id, notify=False)
+        if match["in_flight"]:
+            self.check_btn.config(state=tk.NORMAL)
+            if task_id not in self.poll_scheduler:
+                self.start_polling(task_id, self.key_pool.claim(match["api_key_name"]))
+            self.progress_var.set(f"相同请求的任务 {task_id} 仍在处理中，已继续跟踪（勾选“强制重新生成”可重新提交）")
+        else:
+            where = "本地视频" if match["local_path"] else "视频URL"
+            self.progress_var.set(f"已复用相同请求的任务 {task_id} 的{where}（勾选“强制重新生成”可重新提交）")
+        return True
+
+    def start_polling(self, task_id, key, job=None, model=None, resolution=None, prompt=None):
+        """用创建任务的Key轮询，轮询结束前该任务占用Key的一个任务名额
+
+        model/resolution/prompt 默认取当前界面（恢复上次未完成的任务时由队列中的任务提供）。
+        """
+        self.stop_tracking(task_id)
+        self.task_keys[task_id] = key
+        if job is not None:
+            self.task_jobs[task_id] = job
+
+        # 记录任务创建时的模型和提示词，切换界面后历史记录仍然正确
+        self.poll_scheduler.add(
+            task_id,
+            key.api_key,
+            model=self.current_model.get() if model is None else model,
+            resolution=self.get_current_resolution() if resolution is None else resolution,
+            context={"prompt": self.get_current_prompt() if prompt is None else prompt},
+            callback=self.on_poll_result
         )
-        polling_thread.start()
+        self.cancel_btn.config(state=tk.NORMAL)
 
-    def poll_task_status(self, task_id, api_key):
-        polling_interval = 30  # seconds between checks
-        max_attempts = 30  # about 15 minutes max
-        attempts = 0
+    def run_for_task(self, task_id, func):
+        """在Tk主线程执行界面更新，仅当该任务仍是当前任务时生效"""
+        def run():
+            if task_id == self.current_task_id:
+                func()
 
-        while self.polling_active and attempts < max_attempts:
-            # Wait for polling interval
-            time.sleep(polling_interval)
+        self.root.after(0, run)
 
-            # Check if polling has been cancelled
-            if not self.polling_active:
-                break
+    def on_poll_result(self, record, event, payload):
+        """轮询调度器的回调（在工作线程中执行），整个处理转交Tk主线程，
+        task_keys、task_jobs 等只在主线程中修改"""
+        def run():
+            if not record.cancelled:  # 排队期间已取消或被新的轮询替换
+                self.handle_poll_result(record, event, payload)
 
-            attempts += 1
+        self.root.after(0, run)
 
-            try:
-                # Update UI from thread
-                self.root.after(0, lambda: self.progress_var.set(f"检查任务状态... (尝试 {attempts}/{max_attempts})"))
+    def handle_poll_result(self, record, event, payload):
+        """在Tk主线程处理轮询结果"""
+        task_id = record.task_id
+        elapsed = int(time.time() - record.started)
 
-                # Check task status
-                url = f"https://dashscope.aliyuncs.com/api/v1/tasks/{task_id}"
-                headers = {
-                    "Authorization": f"Bearer {api_key}",
-                    "Content-Type": "application/json"
-                }
+        if event == "error":
+            error_msg = f"检查任务状态时发生错误: {payload}"
+            self.run_for_task(task_id, lambda: self.progress_var.set(error_msg))
+            return
 
-                response = requests.get(url, headers=headers)
+        if event == "http_error":
+            error_msg = f"查询任务状态失败: HTTP {payload.status_code}"
+            self.run_for_task(task_id, lambda: self.response_text.delete(1.0, tk.END))
+            self.run_for_task(task_id, lambda text=payload.text: self.response_text.insert(tk.END, text))
+            self.run_for_task(task_id, lambda: self.progress_var.set(error_msg))
+            return
 
-                if response.status_code == 200:
-                    response_data = response.json()
-                    response_text = json.dumps(response_data, indent=2, ensure_ascii=False)
+        if event == "timeout":
+            self.run_for_task(task_id, lambda: self.progress_var.set("超过最长等待时间，请手动检查任务状态。"))
+            self.run_for_task(task_id, lambda: messagebox.showinfo("提示", "超过最长等待时间，请使用任务ID手动检查状态。"))
+            self.stop_tracking(task_id)  # 队列中的任务保持未结束，下次启动时继续轮询
+            self.root.after(0, self.finish_polling)
+            return
 
-                    # Update UI with response data
-                    self.root.after(0, lambda: self.response_text.delete(1.0, tk.END))
-                    self.root.after(0, lambda: self.response_text.insert(tk.END, response_text))
+        response_data = payload
+        response_text = json.dumps(response_data, indent=2, ensure_ascii=False)
+
+        # Update UI with response data
+        self.run_for_task(task_id, lambda: self.response_text.delete(1.0, tk.END))
+        self.run_for_task(task_id, lambda: self.response_text.insert(tk.END, response_text))
+
+        # Get task status
+        task_status, video_url, error_info = parse_task_response(response_data)
+        status_label = STATUS_LABELS.get(task_status, task_status)
+
+        job = self.task_jobs.get(task_id)
+        if job is not None and task_status not in TERMINAL_STATUSES and job.get("state") != "polling":
+            job["state"] = "polling"
+            self.jobs.mark_polling(job)
+
+        # 更新历史记录（写操作排队给写线程，可直接在工作线程调用）
+        self.save_to_history(
+            task_id=task_id,
+            model=record.model,
+            prompt=record.context["prompt"],
+            status=status_label,
+            video_url=video_url,
+            response=response_data
+        )
 
-                    # Get task status
-                    task_status = response_data.get("output", {}).get("task_status", "")
+        # Update status in UI
+        self.run_for_task(task_id, lambda: self.status_var.set(status_label))
 
-                    # Update status in UI
-                    if task_status == "FAILED":
-                        self.root.after(0, lambda: self.status_var.set("失败"))
-                        self.root.after(0, lambda: self.progress_var.set("任务处理失败。"))
+        if task_status == "FAILED":
+            self.run_for_task(task_id, lambda: self.progress_var.set("任务处理失败。"))
+            self.run_for_task(task_id, lambda: messagebox.showerror("错误", f"视频生成任务失败: {error_info}"))
 
-                        # 更新历史记录
-                        self.root.after(0, lambda: self.save_to_history(
-                            task_id=task_id,
-                            model=self.current_model.get(),
-                            prompt=self.get_current_prompt(),
-                            status="失败",
-                            response_json=response_text
-                        ))
-
-                        # 获取错误信息
-                        error_code = response_data.get("code", "")
-                        error_message = response_data.get("message", "")
-                        if error_code and error_message:
-                            error_info = f"{error_code}: {error_message}"
-                        else:
-                            error_info = "未知错误"
+        elif task_status == "SUCCEEDED":
+            self.run_for_task(task_id, lambda: self.progress_var.set("视频生成成功！"))
 
-                        self.root.after(0, lambda msg=error_info: messagebox.showerror("错误", f"视频生成任务失败: {msg}"))
-                        self.polling_active = False
-                        break
+            if video_url:
+                if self.auto_download:
+                    self.downloader.add(task_id, video_url, response_data)
+                self.run_for_task(task_id, lambda: self.video_url_var.set(video_url))
+                self.run_for_task(task_id, lambda: self.update_video_menu(video_url))
+                self.run_for_task(task_id, lambda: messagebox.showinfo("成功", "视频已成功生成！请在24小时内下载保存。"))
+            else:
+                self.run_for_task(task_id, lambda: messagebox.showwarning("警告", "任务成功但未返回视频URL。"))
 
-                    elif task_status == "SUCCEEDED":
-                        self.root.after(0, lambda: self.status_var.set("成功"))
-                        self.root.after(0, lambda: self.progress_var.set("视频生成成功！"))
+        elif task_status == "RUNNING":
+            self.run_for_task(task_id, lambda: self.progress_var.set(f"视频正在生成中... (已等待 {elapsed} 秒)"))
 
-                        # Extract video URL
-                        video_url = response_data.get("output", {}).get("video_url", "")
+        else:  # PENDING or other
+            self.run_for_task(task_id, lambda: self.progress_var.set(f"任务状态: {task_status} (已等待 {elapsed} 秒)"))
 
-                        if video_url:
-                            self.root.after(0, lambda: self.video_url_var.set(video_url))
-                            self.root.after(0, lambda: self.update_video_menu(video_url))
-
-                            # 更新历史记录
-                            self.root.after(0, lambda: self.save_to_history(
-                                task_id=task_id,
-                                model=self.current_model.get(),
-                                prompt=self.get_current_prompt(),
-                                status="成功",
-                                video_url=video_url,
-                                response_json=response_text
-                            ))
-
-                            self.root.after(0, lambda: messagebox.showinfo("成功", "视频已成功生成！请在24小时内下载保存。"))
-                        else:
-                            self.root.after(0, lambda: messagebox.showwarning("警告", "任务成功但未返回视频URL。"))
+        if task_status in TERMINAL_STATUSES:
+            self.stop_tracking(task_id, task_status, error_info)
+            self.root.after(0, self.finish_polling)
 
-                        self.polling_active = False
-                        break
+    def handle_download_update(self, job, event, payload):
+        """视频下载器的回调（在下载线程中执行），界面更新转交Tk主线程"""
+        task_id = job.task_id
 
-                    elif task_status == "RUNNING":
-                        self.root.after(0, lambda: self.status_var.set("处理中"))
-                        self.root.after(0, lambda: self.progress_var.set(f"视频正在生成中... (尝试 {attempts}/{max_attempts})"))
+        if event == "progress":
+            done, total = payload
+            if total:
+                message = f"正在下载视频... {done * 100 // total}%（{done / 1048576:.1f}/{total / 1048576:.1f} MB）"
+            else:
+                message = f"正在下载视频... {done / 1048576:.1f} MB"
+            self.run_for_task(task_id, lambda: self.progress_var.set(message))
 
-                        # 更新历史记录状态
-                        self.root.after(0, lambda: self.save_to_history(
-                            task_id=task_id,
-                            model=self.current_model.get(),
-                            prompt=self.get_current_prompt(),
-                            status="处理中",
-                            response_json=response_text
-                        ))
-
-                    else:  # PENDING or other
-                        self.root.after(0, lambda: self.status_var.set(task_status))
-                        self.root.after(0, lambda: self.progress_var.set(
-                            f"任务状态: {task_status} (尝试 {attempts}/{max_attempts})"))
-
-                        # 更新历史记录状态
-                        self.root.after(0, lambda: self.save_to_history(
-                            task_id=task_id,
-                            model=self.current_model.get(),
-                            prompt=self.get_current_prompt(),
-                            status=task_status,
-                            response_json=response_text
-                        ))
+        elif event == "done":
+            self.run_for_task(task_id, lambda: self.progress_var.set(f"视频已保存到: {payload}"))
+            self.run_for_task(task_id, lambda: self.update_video_menu(job.video_url, payload))
 
-                else:
-                    error_msg = f"查询任务状态失败: HTTP {response.status_code}"
-                    self.root.after(0, lambda: self.response_text.delete(1.0, tk.END))
-                    self.root.after(0, lambda: self.response_text.insert(tk.END, response.text))
-                    self.root.after(0, lambda: self.progress_var.set(error_msg))
+        elif event == "error":
+            print(f"视频 {task_id} 下载失败: {payload}")
+            self.run_for_task(task_id, lambda: self.progress_var.set(f"视频下载失败: {payload}，请在24小时内手动下载。"))
 
-            except Exception as e:
-                error_msg = f"检查任务状态时发生错误: {str(e)}"
-                self.root.after(0, lambda: self.progress_var.set(error_msg))
+    def stop_tracking(self, task_id, result=None, error=""):
+        """任务结束或不再轮询时归还其API Key的任务名额（在Tk主线程调用）
+
+        result 为终态时把队列中的任务标记为结束，否则只归还租约，下次启动时继续轮询。
+        """
+        key = self.task_keys.pop(task_id, None)
+        if key is not None:
+            self.key_pool.release(key)
+        job = self.task_jobs.pop(task_id, None)
+        if job is not None:
+            if result:
+                self.jobs.finish(job, result, error)
+            else:
+                self.jobs.release(job)
+
+    def resume_jobs(self):
+        """继续上次退出时未完成的任务：已提交的接着轮询，未提交的在后台重新提交"""
+        if not self.sync_default_key():
+            return  # 没有API Key，任务留在队列中
+        try:
+            jobs = self.jobs.claim("gui", 1000)
+        except Exception as e:
+            print(f"读取未完成的任务失败: {str(e)}")
+            return
+
+        resubmit = []
+        for job in jobs:
+            context = job["context"]
+            if job["task_id"]:
+                self.start_polling(job["task_id"], self.key_pool.claim(job["api_key_name"]), job,
+                                   context.get("model", ""), context.get("resolution", ""), context.get("prompt", ""))
+            elif job["attempts"] > self.jobs.max_attempts:
+                self.jobs.finish(job, "ERROR", f"已提交 {job['attempts'] - 1} 次仍未得到任务ID")
+            else:
+                resubmit.append(job)
+
+        if resubmit:
+            threading.Thread(target=self.resubmit_jobs, args=(resubmit,), daemon=True).start()
+        if jobs:
+            self.progress_var.set(f"已继续上次未完成的 {len(jobs)} 个任务（结果保存在历史记录中）")
 
-        # After polling ends
-        self.root.after(0, lambda: self.cancel_btn.config(state=tk.DISABLED))
+    def start_reconcile(self, startup=False):
+        """在后台查询历史记录中所有未完成任务的最新状态（启动时自动执行，也可从菜单执行）"""
+        if self.reconciling:
+            return
+        if not self.sync_default_key():
+            if not startup:
+                messagebox.showerror("错误", "请输入有效的API Key")
+            return
+        self.reconciling = True
+        threading.Thread(target=self.reconcile_in_background, args=(set(self.task_keys), startup),
+                         daemon=True).start()
+
+    def reconcile_in_background(self, exclude, startup):
+        # 启动时的对账不显示进度，只在有任务状态变化时提示
+        progress = None if startup else (lambda done, total: self.root.after(
+            0, lambda: self.progress_var.set(f"正在同步未完成的任务 {done}/{total}...")))
+        try:
+            counts = reconcile_tasks(self.history, self.key_pool, self.downloader if self.auto_download else None,
+                                     exclude=exclude, progress=progress)
+        except Exception as e:
+            message = f"同步未完成的任务失败: {str(e)}"
+        else:
+            message = format_reconcile_counts(counts) if counts["updated"] or not startup else ""
+        finally:
+            self.reconciling = False
+        if message:
+            print(message)
+            self.root.after(0, lambda: self.progress_var.set(message))
+
+    def resubmit_jobs(self, jobs):
+        """在后台线程重新提交上次未提交成功的任务，成功后转交Tk主线程开始轮询"""
+        for job in jobs:
+            context = job["context"]
+            try:
+                key, response = create_task_with_pool(self.key_pool, job["api_url"], job["request"])
+            except Exception as e:
+                self.jobs.finish(job, "ERROR", str(e))
+                continue
 
-        if attempts >= max_attempts and self.polling_active:
-            self.root.after(0, lambda: self.progress_var.set("达到最大尝试次数，请手动检查任务状态。"))
-            self.root.after(0, lambda: messagebox.showinfo("提示", "达到最大尝试次数，请使用任务ID手动检查状态。"))
-            self.polling_active = False
+            try:
+                response_json = response.json()
+                task_id = response_json["output"]["task_id"] if response.status_code in [200, 201, 202] else None
+            except (ValueError, KeyError, TypeError):
+                task_id = None
+            if not task_id:
+                self.key_pool.release(key)
+                self.jobs.finish(job, "CREATE_FAILED", describe_create_error(response))
+                continue
+
+            self.jobs.mark_submitted(job, task_id, key.name)
+            self.save_to_history(task_id, context.get("model", ""), context.get("prompt", ""), "等待中",
+                                 request=job["request"], response=response_json, api_key_name=key.name)
+            print(f"已重新提交上次未完成的任务: {task_id}")
+            self.root.after(0, lambda task_id=task_id, key=key, job=job, context=context: self.start_polling(
+                task_id, key, job, context.get("model", ""), context.get("resolution", ""),
+                context.get("prompt", "")))
+
+    def finish_polling(self):
+        """任务轮询结束后刷新取消按钮"""
+        if self.current_task_id not in self.poll_scheduler:
+            self.cancel_btn.config(state=tk.DISABLED)
 
     def get_current_prompt(self):
         """获取当前模型的提示词"""
@@ -1632,12 +6609,23 @@ class AliyunVideoGenerationApp:
             return self.image_prompt.get(1.0, tk.END).strip()
         return ""
 
+    def get_current_resolution(self):
+        """获取当前模型的分辨率设置"""
+        model = self.current_model.get()
+        if model == "wanx2.1-kf2v-plus":
+            return self.kf2v_resolution_var.get()
+        elif model == "wanx2.1-t2v-turbo":
+            return self.t2v_size_var.get()
+        elif model == "wanx2.1-i2v-turbo":
+            return self.i2v_resolution_var.get()
+        return ""
+
     def check_task_status(self):
         if not self.current_task_id:
             messagebox.showinfo("提示", "没有活动的任务ID。")
             return
 
-        api_key = self.api_key_entry.get()
+        api_key = self.api_key_for_task(self.current_task_id) if self.sync_default_key() else ""
         if not api_key:
             messagebox.showerror("错误", "请输入有效的API Key。")
             return
@@ -1645,90 +6633,85 @@ class AliyunVideoGenerationApp:
         self.progress_var.set("正在检查任务状态...")
         self.check_btn.config(state=tk.DISABLED)
 
-        try:
-            url = f"https://dashscope.aliyuncs.com/api/v1/tasks/{self.current_task_id}"
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
-
-            response = requests.get(url, headers=headers)
-
-            if response.status_code == 200:
-                response_data = response.json()
-                response_text = json.dumps(response_data, indent=2, ensure_ascii=False)
-                self.response_text.delete(1.0, tk.END)
-                self.response_text.insert(tk.END, response_text)
-
-                # Get task status
-                task_status = response_data.get("output", {}).get("task_status", "")
-                self.status_var.set(task_status)
-
-                # 更新历史记录
-                self.save_to_history(
-                    task_id=self.current_task_id,
-                    model=self.current_model.get(),
-                    prompt=self.get_current_prompt(),
-                    status=task_status,
-                    response_json=response_text
-                )
-
-                if task_status == "SUCCEEDED":
-                    # Extract video URL
-                    video_url = response_data.get("output", {}).get("video_url", "")
-
-                    if video_url:
-                        self.video_url_var.set(video_url)
-                        self.update_video_menu(video_url)
-                        self.progress_var.set("视频生成成功！")
-
-                        # 更新历史记录
-                        self.save_to_history(
-                            task_id=self.current_task_id,
-                            model=self.current_model.get(),
-                            prompt=self.get_current_prompt(),
-                            status="成功",
-                            video_url=video_url,
-                            response_json=response_text
-                        )
+        # 查询带限速和重试，可能需要较长时间，在后台线程执行；记录发起时的任务信息，切换任务后历史记录仍然正确
+        threading.Thread(target=self.check_task_in_background,
+                         args=(self.current_task_id, api_key, self.current_model.get(), self.get_current_prompt()),
+                         daemon=True).start()
 
-                        messagebox.showinfo("成功", "视频已成功生成！请在24小时内下载保存。")
-                    else:
-                        self.progress_var.set("任务成功但未返回视频URL。")
-                        messagebox.showwarning("警告", "任务成功但未返回视频URL。")
-
-                elif task_status == "FAILED":
-                    # 获取错误信息
-                    error_code = response_data.get("code", "")
-                    error_message = response_data.get("message", "")
-                    if error_code and error_message:
-                        error_info = f"{error_code}: {error_message}"
-                    else:
-                        error_info = "未知错误"
+    def check_task_in_background(self, task_id, api_key, model, prompt):
+        try:
+            response = query_task(api_key, task_id)
+            response_data = response.json() if response.status_code == 200 else None
+        except Exception as e:
+            error = e
+            self.root.after(0, lambda: self.finish_check_task(task_id, model, prompt, None, None, error))
+        else:
+            self.root.after(0, lambda: self.finish_check_task(task_id, model, prompt, response, response_data))
 
-                    self.progress_var.set(f"任务处理失败: {error_info}")
-                    messagebox.showerror("错误", f"视频生成任务失败: {error_info}")
+    def finish_check_task(self, task_id, model, prompt, response, response_data, error=None):
+        """在Tk主线程处理手动检查的结果；已切换到其他任务时只更新历史记录和下载队列"""
+        self.check_btn.config(state=tk.NORMAL)
+        current = task_id == self.current_task_id
 
-                else:
-                    self.progress_var.set(f"任务状态: {task_status}")
-                    messagebox.showinfo("任务状态", f"当前任务状态: {task_status}\n\n处理需要7-10分钟，请耐心等待。")
+        if error is not None:
+            if current:
+                self.progress_var.set(f"检查任务状态时发生错误: {str(error)}")
+                messagebox.showerror("错误", f"检查任务状态时发生错误: {str(error)}")
+            return
 
-            else:
+        if response_data is None:
+            if current:
                 self.response_text.delete(1.0, tk.END)
                 self.response_text.insert(tk.END, response.text)
                 self.progress_var.set(f"查询任务状态失败: HTTP {response.status_code}")
                 messagebox.showerror("错误", f"查询任务状态失败: HTTP {response.status_code}")
+            return
 
-        except Exception as e:
-            self.progress_var.set(f"检查任务状态时发生错误: {str(e)}")
-            messagebox.showerror("错误", f"检查任务状态时发生错误: {str(e)}")
+        # Get task status
+        task_status, video_url, error_info = parse_task_response(response_data)
+
+        # 更新历史记录
+        self.save_to_history(
+            task_id=task_id,
+            model=model,
+            prompt=prompt,
+            status="成功" if task_status == "SUCCEEDED" and video_url else task_status,
+            video_url=video_url,
+            response=response_data
+        )
+        if task_status == "SUCCEEDED" and video_url and self.auto_download:
+            self.downloader.add(task_id, video_url, response_data)
 
-        finally:
-            self.check_btn.config(state=tk.NORMAL)
+        if not current:
+            return
+
+        response_text = json.dumps(response_data, indent=2, ensure_ascii=False)
+        self.response_text.delete(1.0, tk.END)
+        self.response_text.insert(tk.END, response_text)
+        self.status_var.set(task_status)
+
+        if task_status == "SUCCEEDED":
+            if video_url:
+                self.video_url_var.set(video_url)
+                self.update_video_menu(video_url)
+                self.progress_var.set("视频生成成功！")
+                messagebox.showinfo("成功", "视频已成功生成！请在24小时内下载保存。")
+            else:
+                self.progress_var.set("任务成功但未返回视频URL。")
+                messagebox.showwarning("警告", "任务成功但未返回视频URL。")
+
+        elif task_status == "FAILED":
+            self.progress_var.set(f"任务处理失败: {error_info}")
+            messagebox.showerror("错误", f"视频生成任务失败: {error_info}")
+
+        else:
+            self.progress_var.set(f"任务状态: {task_status}")
+            messagebox.showinfo("任务状态", f"当前任务状态: {task_status}\n\n处理需要7-10分钟，请耐心等待。")
 
     def cancel_polling(self):
-        if self.polling_active:
-            self.polling_active = False
+        """取消当前任务的自动轮询，其他任务继续轮询"""
+        if self.poll_scheduler.cancel(self.current_task_id):
+            self.stop_tracking(self.current_task_id, "CANCELLED", "已取消自动检查")
             self.cancel_btn.config(state=tk.DISABLED)
             self.progress_var.set("自动任务检查已取消。")
 
@@ -1739,6 +6722,14 @@ class AliyunVideoGenerationApp:
         else:
             messagebox.showinfo("提示", "无可用的视频URL。")
 
+    def close(self):
+        """退出前停止轮询和下载，归还未完成任务的租约（下次启动立即继续），并在限定时间内把未提交的写操作写入磁盘"""
+        self.poll_scheduler.shutdown()
+        self.downloader.shutdown()
+        self.ingestor.shutdown()
+        self.jobs.close(timeout=2)
+        self.history.close(timeout=5)
+
     def __del__(self):
         # 清理临时目录
         try:
@@ -1750,9 +6741,139 @@ class AliyunVideoGenerationApp:
 
 
 def main():
+    parser = argparse.ArgumentParser(description="阿里云智能视频生成工具")
+    parser.add_argument("--batch", metavar="MANIFEST", help="无界面批量模式：CSV或JSONL任务清单路径")
+    parser.add_argument("--output", metavar="RESULTS", help="批量结果输出文件（JSONL，默认: <清单>.results.jsonl）")
+    parser.add_argument("--export", metavar="PATH", help="导出历史记录（按扩展名选择ndjson/json/csv/parquet格式）")
+    parser.add_argument("--import", dest="import_path", metavar="PATH",
+                        help="导入并合并历史记录（NDJSON或JSON导出文件）")
+    parser.add_argument("--since", help="导出筛选：开始日期 YYYY-MM-DD")
+    parser.add_argument("--until", help="导出筛选：结束日期 YYYY-MM-DD（含当天）")
+    parser.add_argument("--model", help="导出筛选：模型")
+    parser.add_argument("--status", help="导出筛选：状态")
+    parser.add_argument("--api-key", help="DashScope API Key（默认读取环境变量DASHSCOPE_API_KEY或配置文件）")
+    parser.add_argument("--max-in-flight", type=int, default=50, help="同时处理的最大任务数")
+    parser.add_argument("--pool-size", type=int, default=None, help="HTTP连接池大小（默认取配置文件或32）")
+    parser.add_argument("--connect-timeout", type=float, default=None, help="连接超时（秒）")
+    parser.add_argument("--read-timeout", type=float, default=None, help="读取超时（秒）")
+    parser.add_argument("--create-qps", type=float, default=None, help="每个API Key每秒最多创建的任务数")
+    parser.add_argument("--query-qps", type=float, default=None, help="每个API Key每秒最多查询任务状态的次数")
+    parser.add_argument("--max-tasks", type=int, default=None,
+                        help="每个API Key同时在服务端处理中的最大任务数（0为不限，[ApiKey:名称]中单独配置的优先）")
+    parser.add_argument("--download-dir", default=None, help="视频自动下载目录（默认取配置文件或~/Videos）")
+    parser.add_argument("--no-download", action="store_true", help="批量模式下不自动下载视频")
+    parser.add_argument("--max-download-rate", type=int, default=None, help="下载总带宽上限（KB/s）")
+    parser.add_argument("--skip-image-check", action="store_true", help="批量模式下提交前不检查图片URL")
+    parser.add_argument("--validate-only", action="store_true", help="只检查清单中的图片URL，不提交任务")
+    parser.add_argument("--upload-backend", default=None,
+                        help=f"清单中本地图片的上传后端（可选: {', '.join(IMAGE_UPLOADERS)}，默认取配置文件或local）")
+    parser.add_argument("--public-url", default=None, help="本地文件服务器的公网访问地址（local后端）")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="查询历史记录中所有未完成任务的最新状态并下载新成功的视频，然后退出")
+    parser.add_argument("--force", action="store_true",
+                        help="总是提交新任务，不复用历史记录中请求相同的已成功或处理中的任务")
+    parser.add_argument("--max-wait", type=int, default=None,
+                        help="单个任务最长等待时间（秒，默认按历史耗时为每个模型估算）")
+    args = parser.parse_args()
+
+    if args.export:
+        store = HistoryStore(DB_FILE)
+        try:
+            count = export_history_file(
+                store.read(), args.export, since=parse_date(args.since), until=parse_date(args.until, end=True),
+                model=args.model, status=args.status,
+                progress=lambda done, total: print(f"\r已导出 {done}/{total} 条", end="", flush=True))
+        finally:
+            store.close()
+        print(f"\n已导出 {count} 条历史记录到 {args.export}")
+        return
+
+    if args.import_path:
+        store = HistoryStore(DB_FILE)
+        try:
+            read, written = import_history_file(
+                store, args.import_path,
+                progress=lambda done, changed: print(f"\r已读取 {done} 条，写入 {changed} 条", end="", flush=True))
+        finally:
+            store.close()
+        print(f"\n导入完成: 读取 {read} 条，新增或更新 {written} 条")
+        return
+
+    if args.batch or args.reconcile:
+        config = configparser.ConfigParser()
+        config.read(CONFIG_FILE)
+        settings = network_settings(config)
+        if args.pool_size:
+            settings["pool_maxsize"] = args.pool_size
+        if args.connect_timeout:
+            settings["connect_timeout"] = args.connect_timeout
+        if args.read_timeout:
+            settings["read_timeout"] = args.read_timeout
+        configure_http_client(**settings)
+
+        rates = rate_limit_settings(config)
+        if args.create_qps:
+            rates["create_qps"] = args.create_qps
+        if args.query_qps:
+            rates["query_qps"] = args.query_qps
+        if args.max_tasks is not None:
+            rates["max_tasks"] = args.max_tasks
+        configure_rate_limits(**rates)
+
+        api_key = args.api_key or os.environ.get("DASHSCOPE_API_KEY") or load_saved_api_key()
+        keys = create_key_pool(config, api_key, max_tasks=rates["max_tasks"])
+        if not len(keys) and not args.validate_only:
+            parser.error("请通过--api-key、环境变量DASHSCOPE_API_KEY或配置文件提供API Key（或在配置文件中配置[ApiKey:名称]）")
+
+        download = download_settings(config)
+        if args.download_dir:
+            download["download_dir"] = args.download_dir
+        if args.max_download_rate:
+            download["max_rate"] = args.max_download_rate * 1024
+        if args.no_download or not download["enabled"]:
+            download = None
+
+        if args.reconcile:
+            counts = run_reconcile(keys, download=download)
+            print(format_reconcile_counts(counts))
+            if counts["downloads"]:
+                print(f"已下载 {counts['downloaded']} 个视频")
+            print(format_api_stats())
+            return
+
+        upload = upload_settings(config)
+        if args.upload_backend:
+            upload["backend"] = args.upload_backend
+        if args.public_url:
+            upload["options"]["public_url"] = args.public_url
+
+        output_path = args.output or args.batch + ".results.jsonl"
+        try:
+            counts = run_batch(args.batch, output_path, keys, max_in_flight=args.max_in_flight,
+                               max_wait=args.max_wait, download=download, check_images=not args.skip_image_check,
+                               validate_only=args.validate_only, upload=upload, force=args.force)
+        except ValueError as e:
+            parser.error(str(e))  # 配置错误，如未知的上传后端或缺少 public_url
+        if args.validate_only:
+            print(f"图片检查结果: 通过 {counts['passed']} 个任务，未通过 {counts['failed']} 个")
+            print(f"结果已写入 {output_path}")
+            return
+
+        print(f"批量任务完成: 提交 {counts['submitted']}，继续上次 {counts['resumed']}，复用 {counts['reused']}，"
+              f"成功 {counts['succeeded']}，失败 {counts['failed']}，已下载 {counts['downloaded']}")
+        print(format_connection_stats(http_client().connection_stats()))
+        print(format_api_stats())
+        if len(keys) > 1:
+            print(keys.describe())
+        print(f"结果已写入 {output_path}")
+        return
+
     root = tk.Tk()
     app = AliyunVideoGenerationApp(root)
-    root.mainloop()
+    try:
+        root.mainloop()
+    finally:
+        app.close()
 
 
 if __name__ == "__main__":